@@ -0,0 +1,156 @@
+"""Benchmark of `combine_candidates` against its previous per-group implementation
+on a synthetic input shaped like `sequences_{output_size}.jsonl`"""
+
+import gc
+import timeit
+import tracemalloc
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+from .combine_checkpoints_results import combine_candidates, normalize
+
+# Config
+num_rows = 1_000_000
+num_checkpoints = 5
+output_size = 100
+hunks_per_bug = 2
+distinct_patches = 150
+seed = 42
+
+
+def make_synthetic_candidates() -> pd.DataFrame:
+    """Rows are ordered by checkpoint, then by (bug, hunk), then by beam output"""
+
+    rng = np.random.default_rng(seed)
+    num_hunks = num_rows // (num_checkpoints * output_size)
+    bugids = np.array([f"Project {i // hunks_per_bug}" for i in range(num_hunks)])
+    hunks = np.arange(num_hunks) % hunks_per_bug
+    sources = np.array([f"int x{i} = y + {i} ;" for i in range(num_hunks)])
+
+    hunk_ids = np.tile(np.repeat(np.arange(num_hunks), output_size), num_checkpoints)
+    patch_ids = rng.integers(0, distinct_patches, size=len(hunk_ids))
+    spacing = rng.integers(0, 3, size=len(hunk_ids))
+
+    decoded_sequences = []
+    for hunk_id, patch_id, spaces in zip(hunk_ids, patch_ids, spacing):
+        if patch_id == 0:
+            decoded_sequences.append("")
+        elif patch_id == 1:
+            decoded_sequences.append(sources[hunk_id])
+        else:
+            decoded_sequences.append(f"int x{hunk_id} ={' ' * spaces}y - {patch_id} ;")
+
+    df = pd.DataFrame(
+        {
+            "checkpoint": np.repeat(
+                [f"checkpoint-{(i + 1) * 1000}" for i in range(num_checkpoints)],
+                num_hunks * output_size,
+            ),
+            "bugid": bugids[hunk_ids],
+            "hunk": hunks[hunk_ids],
+            "decoded_sequences": decoded_sequences,
+            "sequences_scores": -rng.random(len(hunk_ids)),
+            "source": sources[hunk_ids],
+            "target": sources[hunk_ids],
+        }
+    )
+    return normalize(df)
+
+
+def create_empty_patch(patch_sample: pd.Series) -> pd.DataFrame:
+    patch_sample.loc["decoded_sequences"] = ""
+    patch_sample.loc["sequences_scores"] = 0
+    patch_sample.loc["normalized_patch"] = ""
+    patch_sample.loc["checkpoint"] = "manual"
+    patch_sample.loc["rank"] = 0
+
+    return pd.DataFrame([patch_sample])
+
+
+def legacy_combine_candidates(df: pd.DataFrame) -> pd.DataFrame:
+    """The previous implementation with Python loops over the groups"""
+
+    dfs = []
+    for _, subset_df in df.groupby(["bugid", "hunk", "checkpoint"]):
+        subset_df["rank"] = subset_df.reset_index(drop=True).index
+        dfs.append(subset_df)
+
+    ranked_df = pd.concat(dfs)
+
+    ranked_df.loc[df["normalized_patch"] == "", ["rank", "sequences_scores"]] = [0, 0]
+
+    sorted_df = ranked_df.sort_values(
+        by=["bugid", "hunk", "rank", "sequences_scores"],
+        ascending=[True, True, True, False],
+        inplace=False,
+        ignore_index=True,
+    )
+
+    src_neq_df = sorted_df.loc[
+        sorted_df["normalized_patch"] != sorted_df["normalized_source"]
+    ]
+    sorted_df = src_neq_df.copy()
+
+    deduped_df = sorted_df.drop_duplicates(
+        subset=["bugid", "hunk", "normalized_patch"],
+        inplace=False,
+        ignore_index=True,
+    )
+
+    concat_dfs = []
+    grouped_df = deduped_df.groupby(["bugid", "hunk"])
+    for _, group_df in grouped_df:
+        if (
+            "" not in group_df["normalized_patch"].values
+            and group_df["normalized_source"].values[0]
+        ):
+            empty_patch = create_empty_patch(group_df.iloc[-1].copy())
+            concat_dfs.append(pd.concat([empty_patch, group_df], ignore_index=True))
+        else:
+            concat_dfs.append(group_df)
+
+    return pd.concat(concat_dfs, ignore_index=True)
+
+
+def measure(
+    func: Callable[[pd.DataFrame], pd.DataFrame], df: pd.DataFrame
+) -> tuple[pd.DataFrame, float, float]:
+    """Returns the result, the run time in seconds and the peak memory in MiB.
+    Time and memory are measured in separate runs as tracing slows down the run.
+    """
+
+    gc.collect()
+    start_timer = timeit.default_timer()
+    result = func(df.copy())
+    end_timer = timeit.default_timer()
+
+    gc.collect()
+    tracemalloc.start()
+    func(df.copy())
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, end_timer - start_timer, peak_memory / 2**20
+
+
+def main():
+    df = make_synthetic_candidates()
+    print("Rows:", len(df))
+
+    legacy_df, legacy_time, legacy_memory = measure(legacy_combine_candidates, df)
+    combined_df, combined_time, combined_memory = measure(combine_candidates, df)
+
+    pd.testing.assert_frame_equal(
+        combined_df, legacy_df[combined_df.columns], check_dtype=False
+    )
+    print("Combined rows:", len(combined_df))
+
+    print(f"{'':<12}{'time (s)':>12}{'peak (MiB)':>12}")
+    print(f"{'legacy':<12}{legacy_time:>12.2f}{legacy_memory:>12.1f}")
+    print(f"{'columnar':<12}{combined_time:>12.2f}{combined_memory:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
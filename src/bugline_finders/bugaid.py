@@ -16,6 +16,7 @@ from tree_sitter import Language, Parser
 from unidiff import PatchSet
 
 from .. import rag_utils
+from ..columnar import write_hunks
 from ..configs import bugaid_data_dir, bugaid_gen_dir
 
 javascript_language = Language(tsjs.language())
@@ -190,6 +191,12 @@ def generate_data(bug_hunks: dict[str, list[DiffHunk]]) -> None:
             addfile.writelines(prepare(h.added_lines) + "\n" for h in hunks)
             ctxfile.writelines(prepare(h.source_context[0]) + "\n" for h in hunks)
 
+    write_hunks(
+        bugaid_gen_dir / "BugAID.parquet",
+        {bugid: [asdict(h) for h in hunks] for bugid, hunks in bug_hunks.items()},
+        prepare,
+    )
+
 
 def cleanup(program: str, source: str, target: str) -> tuple[str, str]:
     """Clean up inconsistencies in some files to detect changes more accurately"""
@@ -18,6 +18,7 @@ from tree_sitter import Language, Parser
 from unidiff import PatchSet
 
 from .. import rag_utils
+from ..columnar import write_hunks
 from ..configs import (
     bugsinpy_bin_dir,
     bugsinpy_gen_dir,
@@ -220,6 +221,12 @@ def generate_data(bug_hunks: dict[str, list[DiffHunk]]) -> None:
             addfile.writelines(prepare(h.added_lines) + "\n" for h in hunks)
             ctxfile.writelines(prepare(h.source_context[0]) + "\n" for h in hunks)
 
+    write_hunks(
+        bugsinpy_gen_dir / "BugsInPy.parquet",
+        {bugid: [asdict(h) for h in hunks] for bugid, hunks in bug_hunks.items()},
+        prepare,
+    )
+
 
 def get_file_path(dir_path: Path, project_id: str, file_path: str) -> Path:
     return dir_path / f"{project_id}/{file_path}"
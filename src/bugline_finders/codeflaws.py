@@ -17,6 +17,7 @@ from tree_sitter import Language, Parser
 from unidiff import PatchSet
 
 from .. import rag_utils
+from ..columnar import write_hunks
 from ..configs import codeflaws_data_dir, codeflaws_gen_dir
 
 c_language = Language(tsc.language())
@@ -231,6 +232,12 @@ def generate_data(bug_hunks: dict[str, list[DiffHunk]]) -> None:
             addfile.writelines(prepare(h.added_lines) + "\n" for h in hunks)
             ctxfile.writelines(prepare(h.source_context[0]) + "\n" for h in hunks)
 
+    write_hunks(
+        codeflaws_gen_dir / "Codeflaws.parquet",
+        {bugid: [asdict(h) for h in hunks] for bugid, hunks in bug_hunks.items()},
+        prepare,
+    )
+
 
 def get_file_path(dir_path: Path, file_name: str) -> Path:
     return dir_path / f"{file_name}.c"
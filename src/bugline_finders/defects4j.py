@@ -24,7 +24,9 @@ from tree_sitter import Language, Parser
 from unidiff import PatchSet
 
 from .. import rag_utils
+from ..columnar import write_hunks
 from ..configs import d4j_bin, d4j_gen_dir, d4j_tmp_dir
+from ..defects4j_properties import load_properties
 
 java_language = Language(tsjava.language())
 parser = Parser(java_language)
@@ -350,6 +352,12 @@ def generate_data(bug_hunks: dict[str, list[DiffHunk]]) -> None:
             addfile.writelines(prepare(h.added_lines) + "\n" for h in hunks)
             ctxfile.writelines(prepare(h.source_context[0]) + "\n" for h in hunks)
 
+    write_hunks(
+        d4j_gen_dir / "Defects4J.parquet",
+        {bugid: [asdict(h) for h in hunks] for bugid, hunks in bug_hunks.items()},
+        prepare,
+    )
+
 
 def get_file_path(dir_path: Path, class_name: str) -> Path:
     return dir_path / f"{class_name.replace('.', '/')}.java"
@@ -429,10 +437,9 @@ def worker_func(project_id: str, bug_id: str) -> tuple[str, list[DiffHunk]]:
     # Checkout buggy and fixed versions of the source code
     checkout_source(project_id, bug_id, True, buggy_checkout_dir)
     checkout_source(project_id, bug_id, False, fixed_checkout_dir)
-    source_dir_name = run_d4j_cmd(f"export -p dir.src.classes -w {buggy_checkout_dir}")
-    modified_classes: list[str] = run_d4j_cmd(
-        f"export -p classes.modified -w {buggy_checkout_dir}"
-    ).splitlines()
+    properties = load_properties(f"{project_id} {bug_id}", buggy_checkout_dir)
+    source_dir_name = properties["dir.src.classes"]
+    modified_classes: list[str] = properties["classes.modified"].splitlines()
 
     hunks: list[DiffHunk] = []
 
@@ -15,6 +15,7 @@ from tree_sitter import Language, Parser
 from unidiff import PatchSet
 
 from .. import rag_utils
+from ..columnar import write_hunks
 from ..configs import (
     quixbugs_genjava_dir,
     quixbugs_java_buggy_dir,
@@ -199,6 +200,12 @@ def generate_data(programs_hunks: dict[str, list[DiffHunk]]) -> None:
             addfile.writelines(prepare(h.added_lines) + "\n" for h in hunks)
             ctxfile.writelines(prepare(h.source_context[0]) + "\n" for h in hunks)
 
+    write_hunks(
+        quixbugs_genjava_dir / "QuixBugs_Java.parquet",
+        {bugid: [asdict(h) for h in hunks] for bugid, hunks in programs_hunks.items()},
+        prepare,
+    )
+
 
 def cleanup(program: str, source: str, target: str) -> tuple[str, str]:
     """Clean up inconsistencies in some files to detect changes more accurately"""
@@ -15,6 +15,7 @@ from tree_sitter import Language, Parser
 from unidiff import PatchSet
 
 from .. import rag_utils
+from ..columnar import write_hunks
 from ..configs import (
     quixbugs_genpy_dir,
     quixbugs_programs,
@@ -187,6 +188,12 @@ def generate_data(programs_hunks: dict[str, list[DiffHunk]]) -> None:
             addfile.writelines(prepare(h.added_lines) + "\n" for h in hunks)
             ctxfile.writelines(prepare(h.source_context[0]) + "\n" for h in hunks)
 
+    write_hunks(
+        quixbugs_genpy_dir / "QuixBugs_Python.parquet",
+        {bugid: [asdict(h) for h in hunks] for bugid, hunks in programs_hunks.items()},
+        prepare,
+    )
+
 
 def remove_context_from_source(
     hunk: DiffHunk, buggy_source_file: Path
@@ -0,0 +1,270 @@
+"""Arrow schemas and Parquet readers/writers for the files handed between the
+pipeline stages. The JSON Lines files are still written next to them."""
+
+import os
+import socket
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Candidates of a bug are stored contiguously, so small row groups let readers
+# that filter on `bugid` skip most of the file
+row_group_size = 10_000
+
+CANDIDATE_FIELDS = {
+    "bugid": pa.string(),
+    "hunk": pa.int64(),
+    "checkpoint": pa.string(),
+    "decoded_sequences": pa.string(),
+    "sequences_scores": pa.float64(),
+    "source": pa.string(),
+    "target": pa.string(),
+    "normalized_patch": pa.string(),
+    "normalized_source": pa.string(),
+    "normalized_target": pa.string(),
+    "rank": pa.int64(),
+    "exact_match": pa.bool_(),
+    "correct": pa.bool_(),
+    "plausible": pa.bool_(),
+    "compilable": pa.bool_(),
+    "parsable": pa.bool_(),
+    "timeout": pa.bool_(),
+    "timeout_limit": pa.float64(),
+    "resource_limit": pa.bool_(),
+    "validation_time": pa.float64(),
+}
+
+# Fields of a multi-hunk candidate that hold one value per hunk
+PER_HUNK_FIELDS = {
+    "hunk",
+    "checkpoint",
+    "decoded_sequences",
+    "sequences_scores",
+    "source",
+    "target",
+    "normalized_patch",
+    "normalized_source",
+    "normalized_target",
+    "rank",
+    "exact_match",
+}
+
+HUNK_SCHEMA = pa.schema(
+    [
+        ("bugid", pa.string()),
+        ("hunk", pa.int64()),
+        ("source_path", pa.string()),
+        ("removed_lines", pa.string()),
+        ("added_lines", pa.string()),
+        ("removed_line_numbers_range", pa.list_(pa.int64(), 2)),
+        ("added_line_numbers_range", pa.list_(pa.int64(), 2)),
+        (
+            "source_context",
+            pa.struct(
+                [
+                    ("text", pa.string()),
+                    ("start_line", pa.int64()),
+                    ("end_line", pa.int64()),
+                ]
+            ),
+        ),
+        ("source_before", pa.string()),
+        ("source_after", pa.string()),
+        # Model input and expected output of the hunk (previously rem.txt/add.txt)
+        ("source", pa.string()),
+        ("target", pa.string()),
+        ("context", pa.string()),
+    ]
+)
+
+# Columns of the hunks table that are not part of the hunk metadata
+HUNK_DERIVED_COLUMNS = ["bugid", "hunk", "source", "target", "context"]
+
+
+def candidate_schema(columns: Iterable[str]) -> pa.Schema:
+    return pa.schema([(col, CANDIDATE_FIELDS[col]) for col in columns])
+
+
+def plausible_candidate_schema(columns: Iterable[str]) -> pa.Schema:
+    """Per-hunk fields are lists, so single- and multi-hunk candidates share a schema"""
+
+    return pa.schema(
+        [
+            (col, pa.list_(CANDIDATE_FIELDS[col]))
+            if col in PER_HUNK_FIELDS
+            else (col, CANDIDATE_FIELDS[col])
+            for col in columns
+        ]
+    )
+
+
+def get_bugid_filters(bugids: Optional[Iterable[str]]) -> Optional[list]:
+    return None if bugids is None else [("bugid", "in", list(bugids))]
+
+
+def write_candidates(df: pd.DataFrame, file_path: Path) -> None:
+    table = pa.Table.from_pandas(
+        df, schema=candidate_schema(df.columns), preserve_index=False
+    )
+    pq.write_table(table, file_path, row_group_size=row_group_size)
+
+
+def read_candidates(
+    file_path: Path,
+    columns: Optional[list[str]] = None,
+    bugids: Optional[Iterable[str]] = None,
+) -> pd.DataFrame:
+    """Reads only the given columns and the row groups of the given bugs"""
+
+    table = pq.read_table(file_path, columns=columns, filters=get_bugid_filters(bugids))
+    return table.to_pandas()
+
+
+@dataclass(frozen=True)
+class CandidateSlice:
+    """Candidates of a bug in an Arrow IPC file, cheap to send to worker processes"""
+
+    file_path: Path
+    offset: int
+    length: int
+
+    def load(self) -> pd.DataFrame:
+        """Memory-maps the file and copies out only the rows of this slice, unmapping
+        the file afterwards"""
+
+        with pa.memory_map(str(self.file_path)) as source:
+            table = pa.ipc.open_file(source).read_all()
+            # `take` copies the rows into memory, so no column of the result points
+            # into the mapping (slices and pandas copies of Arrow strings would)
+            rows = table.take(np.arange(self.offset, self.offset + self.length))
+        return rows.to_pandas()
+
+
+def get_temp_path(file_path: Path) -> Path:
+    """Path to write a file at before moving it in place, so that processes on any
+    host reading or writing it at the same time never see a partial file"""
+
+    return file_path.with_name(
+        f"{file_path.name}.{socket.gethostname()}-{os.getpid()}.tmp"
+    )
+
+
+def write_candidate_slices(
+    df: pd.DataFrame, bugids: Iterable[str], file_path: Path
+) -> dict[str, CandidateSlice]:
+    """Writes the candidates grouped by bugid (keeping their order and index) to an
+    Arrow IPC file and returns the slice of each bug in `bugids`"""
+
+    sorted_df = df.sort_values("bugid", kind="stable")
+    table = pa.Table.from_pandas(sorted_df, preserve_index=True)
+    temp_file_path = get_temp_path(file_path)
+    with pa.ipc.new_file(str(temp_file_path), table.schema) as writer:
+        writer.write_table(table)
+    os.replace(temp_file_path, file_path)
+
+    unique_bugids, offsets, lengths = np.unique(
+        sorted_df["bugid"].to_numpy(), return_index=True, return_counts=True
+    )
+    bug_offsets = {
+        bugid: (int(offset), int(length))
+        for bugid, offset, length in zip(unique_bugids, offsets, lengths)
+    }
+
+    return {
+        bugid: CandidateSlice(file_path, *bug_offsets.get(bugid, (0, 0)))
+        for bugid in bugids
+    }
+
+
+def write_plausible_candidates(records: Iterator[dict], file_path: Path) -> None:
+    """Writes validated candidates, wrapping per-hunk fields of single-hunk
+    candidates in one-element lists"""
+
+    writer = None
+    batch = []
+    for record in records:
+        if writer is None:
+            schema = plausible_candidate_schema(record)
+            temp_file_path = get_temp_path(file_path)
+            writer = pq.ParquetWriter(temp_file_path, schema)
+
+        batch.append(
+            {
+                col: [value]
+                if col in PER_HUNK_FIELDS and not isinstance(value, list)
+                else value
+                for col, value in record.items()
+            }
+        )
+        if len(batch) == row_group_size:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            batch = []
+
+    if writer is None:
+        return
+
+    if batch:
+        writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+    writer.close()
+    os.replace(temp_file_path, file_path)
+
+
+def write_hunks(
+    file_path: Path, bug_hunks: dict[str, list[dict]], prepare: Callable[[str], str]
+) -> None:
+    rows = []
+    for bugid, hunks in bug_hunks.items():
+        for h, hunk in enumerate(hunks):
+            text, start_line, end_line = hunk["source_context"]
+            rows.append(
+                hunk
+                | {
+                    "bugid": bugid,
+                    "hunk": h,
+                    "source_context": {
+                        "text": text,
+                        "start_line": start_line,
+                        "end_line": end_line,
+                    },
+                    "source": prepare(hunk["removed_lines"]),
+                    "target": prepare(hunk["added_lines"]),
+                    "context": prepare(text),
+                }
+            )
+
+    pq.write_table(pa.Table.from_pylist(rows, schema=HUNK_SCHEMA), file_path)
+
+
+def read_hunks(
+    file_path: Path, bugids: Optional[Iterable[str]] = None
+) -> dict[str, list[dict]]:
+    """Reads the hunks metadata of bugs in the same shape as the JSON Lines file"""
+
+    table = pq.read_table(file_path, filters=get_bugid_filters(bugids))
+
+    bug_hunks: dict[str, list[dict]] = {}
+    for row in table.to_pylist():
+        hunk = {
+            col: value
+            for col, value in row.items()
+            if col not in HUNK_DERIVED_COLUMNS
+            and not (col == "source_path" and value is None)
+        }
+        context = hunk["source_context"]
+        hunk["source_context"] = [
+            context["text"],
+            context["start_line"],
+            context["end_line"],
+        ]
+        bug_hunks.setdefault(row["bugid"], []).append(hunk)
+
+    return bug_hunks
+
+
+def read_hunk_columns(file_path: Path, columns: list[str]) -> pd.DataFrame:
+    return pq.read_table(file_path, columns=columns).to_pandas()
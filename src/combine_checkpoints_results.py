@@ -1,7 +1,7 @@
-from itertools import chain
-
+import numpy as np
 import pandas as pd
 
+from .columnar import read_candidates, read_hunk_columns, write_candidates
 from .configs import (
     bugaid_gen_dir,
     bugsinpy_gen_dir,
@@ -18,25 +18,25 @@ model = "multimend"
 
 if dataset == "QuixBugs-Python":
     gen_dir = quixbugs_genpy_dir
-    bugs_metadata_file = "QuixBugs_Python.jsonl"
+    bugs_metadata_file = "QuixBugs_Python.parquet"
 elif dataset == "QuixBugs-Java":
     gen_dir = quixbugs_genjava_dir
-    bugs_metadata_file = "QuixBugs_Java.jsonl"
+    bugs_metadata_file = "QuixBugs_Java.parquet"
 elif dataset == "Defects4J":
     gen_dir = d4j_gen_dir
-    bugs_metadata_file = "Defects4J.jsonl"
+    bugs_metadata_file = "Defects4J.parquet"
 elif dataset == "BugAID":
     gen_dir = bugaid_gen_dir
-    bugs_metadata_file = "BugAID.jsonl"
+    bugs_metadata_file = "BugAID.parquet"
 elif dataset == "Codeflaws":
     gen_dir = codeflaws_gen_dir
-    bugs_metadata_file = "Codeflaws.jsonl"
+    bugs_metadata_file = "Codeflaws.parquet"
 elif dataset == "BugsInPy":
     gen_dir = bugsinpy_gen_dir
-    bugs_metadata_file = "BugsInPy.jsonl"
+    bugs_metadata_file = "BugsInPy.parquet"
 elif dataset == "RunBugRun-JS":
     gen_dir = runbugrunjs_gen_dir
-    bugs_metadata_file = "RunBugRun-JS.jsonl"
+    bugs_metadata_file = "RunBugRun-JS.parquet"
 else:
     raise ValueError("Wrong dataset name")
 
@@ -46,36 +46,20 @@ output_dir = gen_dir / f"outputs-{model}"
 output_size = 100
 num_checkpoints = 5
 
-rem_file_path = gen_dir / "rem.txt"
-add_file_path = gen_dir / "add.txt"
-
-with (
-    open(rem_file_path) as rem_file,
-    open(add_file_path) as add_file,
-):
-    sources = [src.strip() for src in rem_file]
-    targets = [tgt.strip() for tgt in add_file]
-
 
 def add_source_target(df: pd.DataFrame) -> pd.DataFrame:
-    rem_file_path = gen_dir / "rem.txt"
-    add_file_path = gen_dir / "add.txt"
-
-    with (
-        open(rem_file_path) as rem_file,
-        open(add_file_path) as add_file,
-    ):
-        sources = [src.strip() for src in rem_file]
-        targets = [tgt.strip() for tgt in add_file]
-
     checkpoints_num = len(df.value_counts("checkpoint"))
     assert checkpoints_num == num_checkpoints
 
-    df["source"] = list(chain(*[[s] * output_size for s in sources])) * num_checkpoints
-    df["target"] = list(chain(*[[t] * output_size for t in targets])) * num_checkpoints
+    hunks_df = read_hunk_columns(
+        gen_dir / bugs_metadata_file, ["bugid", "hunk", "source", "target"]
+    )
+    df = df.merge(hunks_df, on=["bugid", "hunk"], how="left", validate="many_to_one")
 
-    for bugid, group in df.groupby("bugid"):
-        assert len(group["target"].unique()) <= len(group["hunk"].unique())
+    unique_counts = df.groupby("bugid").agg(
+        targets=("target", "nunique"), hunks=("hunk", "nunique")
+    )
+    assert (unique_counts["targets"] <= unique_counts["hunks"]).all()
 
     return df
 
@@ -88,61 +72,62 @@ def normalize(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
-def create_empty_patch(patch_sample: pd.Series) -> pd.DataFrame:
-    patch_sample.loc["decoded_sequences"] = ""
-    patch_sample.loc["sequences_scores"] = 0
-    patch_sample.loc["normalized_patch"] = ""
-    patch_sample.loc["checkpoint"] = "manual"
-    patch_sample.loc["rank"] = 0
-
-    return pd.DataFrame([patch_sample])
-
-
 def combine_candidates(df: pd.DataFrame) -> pd.DataFrame:
     """deduplicate, sort and combine candidate patches of different checkpoints"""
 
-    dfs = []
-    for _, subset_df in df.groupby(["bugid", "hunk", "checkpoint"]):
-        subset_df["rank"] = subset_df.reset_index(drop=True).index
-        dfs.append(subset_df)
+    group_keys = ["bugid", "hunk"]
 
-    ranked_df = pd.concat(dfs)
+    # Rank of each candidate in the beam output of its checkpoint
+    df["rank"] = df.groupby([*group_keys, "checkpoint"]).cumcount()
+    df.loc[df["normalized_patch"] == "", ["rank", "sequences_scores"]] = 0
 
-    ranked_df.loc[df["normalized_patch"] == "", ["rank", "sequences_scores"]] = [0, 0]
-
-    # Should sort based on scores before deduplication for `keep=first` to take effect
-    sorted_df = ranked_df.sort_values(
-        by=["bugid", "hunk", "rank", "sequences_scores"],
-        ascending=[True, True, True, False],
-        inplace=False,
+    # Should sort based on scores before deduplication for `keep=first` to take effect.
+    # Ties are broken by checkpoint and then by beam order (the sort is stable).
+    sorted_df = df.loc[df["normalized_patch"] != df["normalized_source"]].sort_values(
+        by=[*group_keys, "rank", "sequences_scores", "checkpoint"],
+        ascending=[True, True, True, False, True],
+        kind="stable",
         ignore_index=True,
     )
 
-    src_neq_df = sorted_df.loc[
-        sorted_df["normalized_patch"] != sorted_df["normalized_source"]
-    ]
-    sorted_df = src_neq_df.copy()
+    # Compare 64-bit hashes instead of the patch strings themselves
+    patch_hashes = pd.util.hash_pandas_object(
+        sorted_df["normalized_patch"], index=False
+    )
+    duplicated = pd.DataFrame(
+        {"bugid": sorted_df["bugid"], "hunk": sorted_df["hunk"], "hash": patch_hashes}
+    ).duplicated()
+    deduped_df = sorted_df.loc[~duplicated.to_numpy()].reset_index(drop=True)
+
+    # Adding empty patch to the beginning of hunks without one, copying the last
+    # candidate of the hunk for the other columns
+    is_first = ~deduped_df.duplicated(subset=group_keys).to_numpy()
+    is_last = ~deduped_df.duplicated(subset=group_keys, keep="last").to_numpy()
+    first_positions = np.flatnonzero(is_first)
+    has_empty = np.logical_or.reduceat(
+        (deduped_df["normalized_patch"] == "").to_numpy(), first_positions
+    )
+    needs_empty = (
+        ~has_empty & (deduped_df["normalized_source"] != "").to_numpy()[is_first]
+    )
 
-    deduped_df = sorted_df.drop_duplicates(
-        subset=["bugid", "hunk", "normalized_patch"],
-        inplace=False,
-        ignore_index=True,
+    order = np.insert(
+        np.arange(len(deduped_df)),
+        first_positions[needs_empty],
+        np.flatnonzero(is_last)[needs_empty],
+    )
+    is_empty_patch = np.insert(
+        np.zeros(len(deduped_df), dtype=bool), first_positions[needs_empty], True
     )
 
-    # Adding empty patch to hunks
-    concat_dfs = []
-    grouped_df = deduped_df.groupby(["bugid", "hunk"])
-    for _, group_df in grouped_df:
-        if (
-            "" not in group_df["normalized_patch"].values
-            and group_df["normalized_source"].values[0]
-        ):
-            empty_patch = create_empty_patch(group_df.iloc[-1].copy())
-            concat_dfs.append(pd.concat([empty_patch, group_df], ignore_index=True))
-        else:
-            concat_dfs.append(group_df)
+    combined_df = deduped_df.take(order).reset_index(drop=True)
+    combined_df.loc[is_empty_patch, "decoded_sequences"] = ""
+    combined_df.loc[is_empty_patch, "sequences_scores"] = 0
+    combined_df.loc[is_empty_patch, "normalized_patch"] = ""
+    combined_df.loc[is_empty_patch, "checkpoint"] = "manual"
+    combined_df.loc[is_empty_patch, "rank"] = 0
 
-    return pd.concat(concat_dfs, ignore_index=True)
+    return combined_df
 
 
 def set_exact_matches(df: pd.DataFrame) -> pd.DataFrame:
@@ -153,11 +138,13 @@ def set_exact_matches(df: pd.DataFrame) -> pd.DataFrame:
 
 
 def main():
-    checkpoints_results = pd.read_json(
-        output_dir / f"sequences_{output_size}.jsonl",
-        orient="records",
-        lines=True,
-    )
+    sequences_file_path = output_dir / f"sequences_{output_size}.parquet"
+    if sequences_file_path.exists():
+        checkpoints_results = read_candidates(sequences_file_path)
+    else:
+        checkpoints_results = pd.read_json(
+            sequences_file_path.with_suffix(".jsonl"), orient="records", lines=True
+        )
 
     assert len(checkpoints_results.value_counts("checkpoint")) == num_checkpoints
 
@@ -168,12 +155,13 @@ def main():
 
     checkpoints_results = checkpoints_results[column_index]
     print("All:", len(checkpoints_results))
-    add_source_target(checkpoints_results)
+    checkpoints_results = add_source_target(checkpoints_results)
 
     deduped_df = combine_candidates(normalize(checkpoints_results))
     print("Deduped:", len(deduped_df))
     set_exact_matches(deduped_df)
 
+    write_candidates(deduped_df, output_dir / f"final_candidates_{output_size}.parquet")
     deduped_df.to_json(
         output_dir / f"final_candidates_{output_size}.jsonl",
         orient="records",
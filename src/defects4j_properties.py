@@ -0,0 +1,138 @@
+"""Index of the `defects4j export` properties of each bug.
+
+Every export is a Perl and Ant launch, so the properties of a bug are exported once
+from a checkout of its buggy version and stored in `properties/<bugid>.json` under
+the Defects4J output directory. The bugline finder and the validator read them from
+there.
+"""
+
+import contextlib
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import threading
+from pathlib import Path
+from typing import Optional
+
+import joblib
+from joblib import Parallel, delayed
+from tqdm import tqdm
+
+from .configs import d4j_bin, d4j_gen_dir, d4j_tmp_dir
+
+properties_dir = d4j_gen_dir / "properties"
+
+# Properties that don't need the project to be compiled first
+property_names = [
+    "classes.modified",
+    "classes.relevant",
+    "dir.bin.classes",
+    "dir.bin.tests",
+    "dir.src.classes",
+    "dir.src.tests",
+    "tests.relevant",
+    "tests.trigger",
+]
+
+
+def run_d4j_cmd(cmd: str) -> str:
+    d4j_cmd = f"perl {d4j_bin} {cmd}"
+    args = shlex.split(d4j_cmd)
+    result = subprocess.run(args, capture_output=True, check=True, text=True)
+    return result.stdout
+
+
+def get_properties_file_path(bugid: str) -> Path:
+    return properties_dir / f"{bugid.replace(' ', '-')}.json"
+
+
+def export_properties(bugid: str, checkout_dir: Path) -> dict[str, str]:
+    """Exports the properties of a bug from a checkout of its buggy version and
+    stores them in the index"""
+
+    properties = {
+        name: run_d4j_cmd(f"export -p {name} -w {checkout_dir}")
+        for name in property_names
+    }
+
+    # Write to a temporary file first, so concurrent readers never see a partial file
+    properties_file_path = get_properties_file_path(bugid)
+    properties_file_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_file_path = properties_file_path.with_suffix(
+        f".{os.getpid()}-{threading.get_ident()}.tmp"
+    )
+    with open(temp_file_path, "w") as file:
+        json.dump({"bugid": bugid, "properties": properties}, file)
+    os.replace(temp_file_path, properties_file_path)
+
+    return properties
+
+
+def load_properties(bugid: str, checkout_dir: Optional[Path] = None) -> dict[str, str]:
+    """Loads the indexed properties of a bug. If the bug is not indexed yet, they are
+    exported from `checkout_dir`, which should hold a checkout of its buggy version."""
+
+    properties_file_path = get_properties_file_path(bugid)
+    if properties_file_path.exists():
+        with open(properties_file_path) as file:
+            return json.load(file)["properties"]
+
+    if checkout_dir is None:
+        raise FileNotFoundError(f"Properties of {bugid} are not indexed")
+
+    return export_properties(bugid, checkout_dir)
+
+
+@contextlib.contextmanager
+def tqdm_joblib(tqdm_object):
+    """Context manager to patch joblib to report into tqdm progress bar given as argument"""
+
+    def tqdm_print_progress(self):
+        if self.n_completed_tasks > tqdm_object.n:
+            n_completed = self.n_completed_tasks - tqdm_object.n
+            tqdm_object.update(n=n_completed)
+
+    original_print_progress = joblib.parallel.Parallel.print_progress
+    joblib.parallel.Parallel.print_progress = tqdm_print_progress
+
+    try:
+        yield tqdm_object
+    finally:
+        joblib.parallel.Parallel.print_progress = original_print_progress
+        tqdm_object.close()
+
+
+def index_bug(project_id: str, bug_id: str) -> None:
+    bugid = f"{project_id} {bug_id}"
+    if get_properties_file_path(bugid).exists():
+        return
+
+    checkout_dir = d4j_tmp_dir / f"{threading.get_ident()}/properties"
+    checkout_dir.mkdir(parents=True, exist_ok=True)
+    run_d4j_cmd(f"checkout -p {project_id} -v {bug_id}b -w {checkout_dir}")
+
+    try:
+        export_properties(bugid, checkout_dir)
+    finally:
+        shutil.rmtree(checkout_dir, ignore_errors=True)
+
+
+def main():
+    n_jobs = 6
+
+    bugs = [
+        (project_id, bug_id)
+        for project_id in run_d4j_cmd("pids").splitlines()
+        for bug_id in run_d4j_cmd(f"bids -p {project_id}").splitlines()
+    ]
+
+    with tqdm_joblib(tqdm(total=len(bugs))):
+        Parallel(n_jobs=n_jobs, backend="threading")(
+            delayed(index_bug)(project_id, bug_id) for project_id, bug_id in bugs
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,5 @@
-import json
 import string
-from collections import ChainMap, defaultdict
+from collections import defaultdict
 from itertools import chain
 from pathlib import Path
 
@@ -12,6 +11,7 @@ from transformers import (
     set_seed,
 )
 
+from .columnar import read_hunks, write_candidates
 from .configs import (
     bugaid_gen_dir,
     bugsinpy_gen_dir,
@@ -63,8 +63,7 @@ def load_test_input_from_meta(prefix: str) -> Dataset:
     rag = RAG(dataset.split("_")[0])
     test_data = defaultdict(list)
 
-    with open(gen_dir / bugs_metadata_file) as meta_file:
-        bugs_metadata = ChainMap(*[json.loads(line) for line in meta_file][::-1])
+    bugs_metadata = read_hunks(gen_dir / bugs_metadata_file)
 
     print("# RAG retrievals...")
     for bugid, hunks in bugs_metadata.items():
@@ -137,8 +136,7 @@ def generate_candidates(examples, model, ch_name):
 def save_results(checkpoints_results: list[Dataset]) -> None:
     concatenated_results = concatenate_datasets(checkpoints_results)
 
-    with open(gen_dir / bugs_metadata_file) as meta_file:
-        bugs_metadata = ChainMap(*[json.loads(line) for line in meta_file][::-1])
+    bugs_metadata = read_hunks(gen_dir / bugs_metadata_file)
 
     # Create bugid and hunks for a single checkpoint
     input_bugs_hunks = defaultdict(list)
@@ -155,36 +153,39 @@ def save_results(checkpoints_results: list[Dataset]) -> None:
     bugid_added = concatenated_results.add_column("bugid", input_bugs_hunks["bugid"])
     hunk_added = bugid_added.add_column("hunk", input_bugs_hunks["hunk"])
 
+    write_candidates(
+        hunk_added.to_pandas(), output_dir / f"sequences_{beam_size}.parquet"
+    )
     hunk_added.to_json(output_dir / f"sequences_{beam_size}.jsonl")
 
 
 if dataset == "QuixBugs-Python":
     gen_dir = quixbugs_genpy_dir
-    bugs_metadata_file = "QuixBugs_Python.jsonl"
+    bugs_metadata_file = "QuixBugs_Python.parquet"
     prefix = "Python"
 elif dataset == "QuixBugs-Java":
     gen_dir = quixbugs_genjava_dir
-    bugs_metadata_file = "QuixBugs_Java.jsonl"
+    bugs_metadata_file = "QuixBugs_Java.parquet"
     prefix = "Java"
 elif dataset == "Defects4J":
     gen_dir = d4j_gen_dir
-    bugs_metadata_file = "Defects4J.jsonl"
+    bugs_metadata_file = "Defects4J.parquet"
     prefix = "Java"
 elif dataset == "BugAID":
     gen_dir = bugaid_gen_dir
-    bugs_metadata_file = "BugAID.jsonl"
+    bugs_metadata_file = "BugAID.parquet"
     prefix = "JavaScript"
 elif dataset == "Codeflaws":
     gen_dir = codeflaws_gen_dir
-    bugs_metadata_file = "Codeflaws.jsonl"
+    bugs_metadata_file = "Codeflaws.parquet"
     prefix = "C"
 elif dataset == "BugsInPy":
     gen_dir = bugsinpy_gen_dir
-    bugs_metadata_file = "BugsInPy.jsonl"
+    bugs_metadata_file = "BugsInPy.parquet"
     prefix = "Python"
 elif dataset == "RunBugRun-JS":
     gen_dir = runbugrunjs_gen_dir
-    bugs_metadata_file = "RunBugRun-JS.jsonl"
+    bugs_metadata_file = "RunBugRun-JS.parquet"
     prefix = "JavaScript"
 else:
     raise ValueError("Wrong dataset name")
@@ -0,0 +1,348 @@
+"""Reranking of the combined candidates before validation.
+
+Each candidate is scored by a logistic model over features that are cheap to compute
+on CPU: the model's score and beam rank, the token similarity and length change from
+the buggy line, the share of its identifiers that appear in neither the buggy line
+nor its context, the number of checkpoints that generated it, and whether it deletes
+the line. The candidates of each hunk are then written in decreasing score order
+(ties keep the combined order) to `reranked_candidates_{output_size}.parquet`, which
+the validators read with `candidates_order = "reranked"`.
+
+The model is trained on the single-hunk bugs with a plausible patch in `results_dir`,
+whose first plausible patch (the file with the lowest index) is the positive and all
+other candidates of the bug are negatives. Candidates after the plausible one were
+never validated, so a few of them may be plausible too. The report gives, for each
+benchmark, the median number of candidates validated before the first plausible one
+in the combined order and in the reranked order of a model trained without that
+benchmark. The reranked numbers are upper bounds, since candidates that move ahead of
+the plausible one haven't been validated.
+
+The candidates of `dataset` are likewise reranked by a model trained without its
+benchmarks, so its own plausible patches don't decide which patch is found first.
+"""
+
+import difflib
+import json
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .columnar import read_candidates, read_hunk_columns, write_candidates
+from .configs import (
+    bugaid_gen_dir,
+    bugsinpy_gen_dir,
+    codeflaws_gen_dir,
+    d4j_gen_dir,
+    outputs_root,
+    quixbugs_genjava_dir,
+    quixbugs_genpy_dir,
+    results_dir,
+    runbugrunjs_gen_dir,
+)
+
+# Config
+dataset = "QuixBugs-Python"
+model = "multimend"
+output_size = 100
+reranker_path = outputs_root / f"reranker-{model}-{dataset}.json"
+
+# Generation directory and bugs metadata file of each dataset
+datasets = {
+    "QuixBugs-Python": (quixbugs_genpy_dir, "QuixBugs_Python.parquet"),
+    "QuixBugs-Java": (quixbugs_genjava_dir, "QuixBugs_Java.parquet"),
+    "Defects4J": (d4j_gen_dir, "Defects4J.parquet"),
+    "BugAID": (bugaid_gen_dir, "BugAID.parquet"),
+    "Codeflaws": (codeflaws_gen_dir, "Codeflaws.parquet"),
+    "BugsInPy": (bugsinpy_gen_dir, "BugsInPy.parquet"),
+    "RunBugRun-JS": (runbugrunjs_gen_dir, "RunBugRun-JS.parquet"),
+}
+# Datasets whose results are reported as separate benchmarks
+results_benchmarks = {"Defects4J": ["Defects4J-v1.2", "Defects4J-v2.0"]}
+
+# Full-batch gradient descent on the standardized features
+learning_rate = 0.5
+num_iterations = 500
+l2_penalty = 1e-3
+
+FEATURES = [
+    "sequences_scores",
+    "log_rank",
+    "source_similarity",
+    "length_change",
+    "new_identifiers",
+    "checkpoint_votes",
+    "is_deletion",
+]
+
+identifier_pattern = re.compile(r"[A-Za-z_]\w*")
+
+
+def read_checkpoint_votes(output_dir: Path) -> pd.DataFrame:
+    """Number of checkpoints that generated each normalized patch of a hunk"""
+
+    sequences_file_path = output_dir / f"sequences_{output_size}.parquet"
+    columns = ["bugid", "hunk", "checkpoint", "decoded_sequences"]
+    if sequences_file_path.exists():
+        sequences = read_candidates(sequences_file_path, columns)
+    else:
+        sequences = pd.read_json(
+            sequences_file_path.with_suffix(".jsonl"), orient="records", lines=True
+        )[columns]
+
+    sequences["normalized_patch"] = (
+        sequences["decoded_sequences"].str.split().str.join(sep=" ")
+    )
+    return (
+        sequences.groupby(["bugid", "hunk", "normalized_patch"])["checkpoint"]
+        .nunique()
+        .rename("checkpoint_votes")
+        .reset_index()
+    )
+
+
+def read_dataset(name: str) -> pd.DataFrame:
+    """Combined candidates of a dataset, with the columns the features need"""
+
+    gen_dir, bugs_metadata_file = datasets[name]
+    output_dir = gen_dir / f"outputs-{model}"
+
+    df = read_candidates(output_dir / f"final_candidates_{output_size}.parquet")
+    df = df.merge(
+        read_checkpoint_votes(output_dir),
+        on=["bugid", "hunk", "normalized_patch"],
+        how="left",
+        validate="many_to_one",
+    )
+    # The empty patches added by `combine_candidates` weren't generated
+    df["checkpoint_votes"] = df["checkpoint_votes"].fillna(0)
+
+    contexts = read_hunk_columns(
+        gen_dir / bugs_metadata_file, ["bugid", "hunk", "context"]
+    )
+    return df.merge(contexts, on=["bugid", "hunk"], how="left", validate="many_to_one")
+
+
+def get_patch_features(patch: str, source: str, context: str) -> tuple:
+    patch_tokens, source_tokens = patch.split(), source.split()
+    patch_identifiers = set(identifier_pattern.findall(patch))
+    known_identifiers = set(identifier_pattern.findall(f"{source} {context}"))
+
+    return (
+        difflib.SequenceMatcher(None, patch_tokens, source_tokens).ratio(),
+        (len(patch_tokens) - len(source_tokens)) / max(len(source_tokens), 1),
+        len(patch_identifiers - known_identifiers) / len(patch_identifiers)
+        if patch_identifiers
+        else 0.0,
+    )
+
+
+def get_features(df: pd.DataFrame) -> np.ndarray:
+    patch_features = np.array(
+        [
+            get_patch_features(patch, source, context or "")
+            for patch, source, context in zip(
+                df["normalized_patch"], df["normalized_source"], df["context"]
+            )
+        ],
+        dtype=float,
+    ).reshape(-1, 3)
+
+    return np.column_stack(
+        [
+            df["sequences_scores"].to_numpy(dtype=float),
+            np.log1p(df["rank"].to_numpy(dtype=float)),
+            patch_features,
+            df["checkpoint_votes"].to_numpy(dtype=float),
+            (df["normalized_patch"] == "").to_numpy(dtype=float),
+        ]
+    )
+
+
+def read_first_plausible_patches(benchmark: str) -> dict[str, str]:
+    """Normalized first plausible patch of each single-hunk bug of a benchmark"""
+
+    patches_dir = (
+        results_dir
+        / benchmark
+        / f"outputs-{model}"
+        / f"plausible_patches_{output_size}"
+    )
+
+    first_plausible_patches = {}
+    for bug_dir in patches_dir.iterdir():
+        patch_file_path = min(bug_dir.glob("*.json"), default=None)
+        if patch_file_path is None:
+            continue
+        with open(patch_file_path) as file:
+            hunks = json.load(file)["hunks"]
+        if len(hunks) == 1:
+            first_plausible_patches[bug_dir.name] = " ".join(hunks[0]["patch"].split())
+
+    return first_plausible_patches
+
+
+def get_labels(df: pd.DataFrame, first_plausible_patches: dict[str, str]) -> pd.Series:
+    """Marks the first plausible candidate of each bug. Returns `NaN` for the bugs
+    that aren't labeled: those without a single-hunk plausible patch, or without a
+    candidate matching it."""
+
+    plausible_patches = df["bugid"].map(first_plausible_patches)
+    is_plausible = (df["normalized_patch"] == plausible_patches) & (df["hunk"] == 0)
+    is_first = is_plausible & ~is_plausible.groupby(df["bugid"]).cumsum().gt(1)
+
+    hunk_counts = df.groupby("bugid")["hunk"].transform("nunique")
+    is_labeled = (hunk_counts == 1) & is_first.groupby(df["bugid"]).transform("any")
+    return is_first.astype(float).where(is_labeled)
+
+
+def get_positions(
+    bugids: pd.Series, labels: np.ndarray, scores: np.ndarray
+) -> np.ndarray:
+    """Number of candidates before the plausible one of each bug, in the order of
+    decreasing `scores` (ties keep the original order)"""
+
+    order = pd.DataFrame({"bugid": bugids.to_numpy(), "score": scores, "label": labels})
+    order = order.sort_values(
+        ["bugid", "score"], ascending=[True, False], kind="stable"
+    )
+    positions = order.groupby("bugid").cumcount()
+    return positions[order["label"] == 1].to_numpy()
+
+
+def sigmoid(x: np.ndarray) -> np.ndarray:
+    return 1 / (1 + np.exp(-x))
+
+
+def train(features: np.ndarray, labels: np.ndarray, bugids: pd.Series) -> dict:
+    """Logistic regression where every bug has the same total weight"""
+
+    mean = features.mean(axis=0)
+    std = features.std(axis=0)
+    std[std == 0] = 1
+    x = (features - mean) / std
+
+    sample_weights = 1 / bugids.map(bugids.value_counts()).to_numpy(dtype=float)
+    sample_weights /= sample_weights.sum()
+
+    weights = np.zeros(x.shape[1])
+    bias = 0.0
+    for _ in range(num_iterations):
+        errors = sample_weights * (sigmoid(x @ weights + bias) - labels)
+        weights -= learning_rate * (x.T @ errors + l2_penalty * weights)
+        bias -= learning_rate * errors.sum()
+
+    return {
+        "features": FEATURES,
+        "mean": mean.tolist(),
+        "std": std.tolist(),
+        "weights": weights.tolist(),
+        "bias": bias,
+    }
+
+
+def score(reranker: dict, features: np.ndarray) -> np.ndarray:
+    x = (features - np.array(reranker["mean"])) / np.array(reranker["std"])
+    return x @ np.array(reranker["weights"]) + reranker["bias"]
+
+
+def rerank(df: pd.DataFrame, scores: np.ndarray) -> pd.DataFrame:
+    """Sorts the candidates of each hunk by decreasing score"""
+
+    df = df.assign(rerank_score=scores).sort_values(
+        ["bugid", "hunk", "rerank_score"],
+        ascending=[True, True, False],
+        kind="stable",
+        ignore_index=True,
+    )
+    return df.drop(columns="rerank_score")
+
+
+def main():
+    examples = []
+    for name in datasets:
+        gen_dir, _ = datasets[name]
+        if not (
+            gen_dir / f"outputs-{model}" / f"final_candidates_{output_size}.parquet"
+        ).exists():
+            print("Skipped, no candidates:", name)
+            continue
+
+        df = read_dataset(name)
+        features = get_features(df)
+        for benchmark in results_benchmarks.get(name, [name]):
+            labels = get_labels(df, read_first_plausible_patches(benchmark))
+            is_labeled = labels.notna().to_numpy()
+            examples.append(
+                (
+                    benchmark,
+                    features[is_labeled],
+                    labels[is_labeled].to_numpy(),
+                    df["bugid"][is_labeled].reset_index(drop=True),
+                )
+            )
+
+    if not examples:
+        raise ValueError("No candidates to train the reranker on")
+
+    # Each benchmark is reranked by a model trained on the others
+    report = []
+    for benchmark, features, labels, bugids in examples:
+        others = [example for example in examples if example[0] != benchmark]
+        if not others:
+            continue
+
+        reranker = train(
+            np.concatenate([example[1] for example in others]),
+            np.concatenate([example[2] for example in others]),
+            pd.concat([example[3] for example in others], ignore_index=True),
+        )
+        before = get_positions(bugids, labels, np.zeros(len(labels)))
+        after = get_positions(bugids, labels, score(reranker, features))
+        report.append(
+            {
+                "benchmark": benchmark,
+                "bugs": len(before),
+                "median_before": np.median(before),
+                "median_after": np.median(after),
+                "mean_before": before.mean(),
+                "mean_after": after.mean(),
+            }
+        )
+    print(pd.DataFrame(report).to_string(index=False))
+
+    # Reranked by a model trained on the other datasets, like in the report
+    dataset_benchmarks = results_benchmarks.get(dataset, [dataset])
+    others = [example for example in examples if example[0] not in dataset_benchmarks]
+    if not others:
+        raise ValueError(f"No candidates of other datasets to train on: {dataset}")
+
+    reranker = train(
+        np.concatenate([example[1] for example in others]),
+        np.concatenate([example[2] for example in others]),
+        pd.concat([example[3] for example in others], ignore_index=True),
+    )
+    print({f: round(w, 3) for f, w in zip(FEATURES, reranker["weights"])})
+    reranker_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(reranker_path, "w") as file:
+        json.dump(reranker, file, indent=2)
+
+    gen_dir, _ = datasets[dataset]
+    output_dir = gen_dir / f"outputs-{model}"
+    df = read_dataset(dataset)
+    reranked_df = rerank(df, score(reranker, get_features(df)))
+    reranked_df = reranked_df.drop(columns=["checkpoint_votes", "context"])
+
+    write_candidates(
+        reranked_df, output_dir / f"reranked_candidates_{output_size}.parquet"
+    )
+    reranked_df.to_json(
+        output_dir / f"reranked_candidates_{output_size}.jsonl",
+        orient="records",
+        lines=True,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
-from math import ceil
+from pathlib import Path
+from typing import Optional
 
 import torch
-from datasets import concatenate_datasets, load_dataset
+from torch.utils.data import DataLoader
+from torchdata.stateful_dataloader import StatefulDataLoader
 from transformers import (
     AutoModelForSeq2SeqLM,
     AutoTokenizer,
@@ -9,9 +11,16 @@ from transformers import (
     GenerationConfig,
     Seq2SeqTrainer,
     Seq2SeqTrainingArguments,
+    TrainerCallback,
 )
 
 from .configs import models_root
+from .training_data import (
+    TokenBudgetBatchSampler,
+    get_lengths,
+    load_streaming_dataset,
+    load_tokenized_dataset,
+)
 
 print("CUDA available:", torch.cuda.is_available())
 print("CUDA version:", torch.version.cuda)
@@ -30,70 +39,34 @@ dataset_names = {
     "C": "h4iku/coconut_c2005_preprocessed",
 }
 
-raw_datasets = {
-    prefix: load_dataset(data, split="train") for prefix, data in dataset_names.items()
-}
-print(raw_datasets)
-
 # Tokenize data
 max_input_length = 512
 max_target_length = 256
 
-
-def preprocess_function(prefix, examples):
-    inputs = [
-        f"{prefix} {ex.strip()} :".replace(tokenizer.eos_token, tokenizer.unk_token)
-        for ex in examples["rem"]
-    ]
-    targets = [
-        ex.strip().replace(tokenizer.eos_token, tokenizer.unk_token)
-        for ex in examples["add"]
-    ]
-    contexts = [
-        " ".join(ex.split()).replace(tokenizer.eos_token, tokenizer.unk_token)
-        for ex in examples["context"]
-    ]
-
-    inputs_contexts = [f"{src} {ctx}" for src, ctx in zip(inputs, contexts)]
-
-    model_inputs = tokenizer(
-        inputs_contexts, max_length=max_input_length, truncation=True
+# Stream the training data instead of tokenizing and caching the whole corpus first.
+# A stream has no length, so an epoch is `streaming_epoch_steps` batches of
+# `streaming_batch_size` examples. The stream position is saved with each checkpoint.
+streaming = False
+# Sampling probability of each language in the stream, in turns if `None`
+streaming_probabilities: Optional[dict[str, float]] = None
+streaming_batch_size = 8
+streaming_epoch_steps = 100_000
+# Workers that tokenize the stream, up to the number of shards of the datasets
+streaming_num_workers = 4
+
+if streaming:
+    train_dataset = load_streaming_dataset(
+        tokenizer,
+        dataset_names,
+        max_input_length,
+        max_target_length,
+        streaming_probabilities,
     )
-    model_inputs["inputs_only"] = tokenizer(inputs).input_ids
-
-    labels = tokenizer(targets)
-
-    model_inputs["labels"] = labels["input_ids"]
-
-    return model_inputs
-
-
-tokenized_datasets = [
-    raw_dataset.map(
-        lambda ex: preprocess_function(prefix, ex),
-        batched=True,
-        remove_columns=raw_dataset.column_names,
+else:
+    train_dataset = load_tokenized_dataset(
+        tokenizer, dataset_names, max_input_length, max_target_length
     )
-    for prefix, raw_dataset in raw_datasets.items()
-]
-
-
-# Filter data
-def allowed_length(example):
-    """Filter out long samples and samples with empty target"""
-    return (
-        len(example["inputs_only"]) <= max_input_length
-        and 2 < len(example["labels"]) <= max_target_length
-    )
-
-
-filtered_datasets = [
-    td.filter(allowed_length).remove_columns(["inputs_only"])
-    for td in tokenized_datasets
-]
-
-concatenated_dataset = concatenate_datasets(filtered_datasets)
-print(concatenated_dataset)
+print(train_dataset)
 
 
 # Setting generate hyperparameters
@@ -105,23 +78,38 @@ generation_config = GenerationConfig(
 )
 
 # Training
-train_batch_size = 8
+# Training batches group examples of similar lengths up to a budget of input and
+# label tokens including padding. The budget fits 8 examples of the max lengths.
+train_max_tokens = 8 * (max_input_length + max_target_length)
+train_max_batch_size = 64
 eval_batch_size = 16
 model_name = model_checkpoint.split("/")[-1]
 epochs = 2
 lr = 1e-4
 
 output_dir = models_root / f"multimend-{model_name}"
+# Checkpoint directory to resume training from, e.g., `output_dir / "checkpoint-1000"`
+resume_from_checkpoint: Optional[Path] = None
+
+if streaming:
+    epoch_steps = streaming_epoch_steps
+else:
+    batch_sampler = TokenBudgetBatchSampler(
+        get_lengths(train_dataset, "input_ids"),
+        get_lengths(train_dataset, "labels"),
+        train_max_tokens,
+        train_max_batch_size,
+    )
+    epoch_steps = len(batch_sampler)
 
 checkpoints_each_epoch = 5
-epoch_steps = ceil(len(concatenated_dataset) / train_batch_size)
 train_steps = epoch_steps * epochs
 save_steps = epoch_steps // checkpoints_each_epoch
+print("Steps per epoch:", epoch_steps)
 
 args = Seq2SeqTrainingArguments(
     output_dir,
     learning_rate=lr,
-    per_device_train_batch_size=train_batch_size,
     per_device_eval_batch_size=eval_batch_size,
     save_total_limit=epochs * checkpoints_each_epoch,
     max_steps=train_steps,
@@ -131,16 +119,65 @@ args = Seq2SeqTrainingArguments(
     lr_scheduler_type="constant",
     generation_config=generation_config,
     report_to="tensorboard",
+    # A resumed stream continues from its saved position instead
+    ignore_data_skip=streaming,
+)
+
+# Batches are padded to their longest example
+data_collator = DataCollatorForSeq2Seq(
+    tokenizer=tokenizer, model=model, pad_to_multiple_of=8
 )
 
-data_collator = DataCollatorForSeq2Seq(tokenizer=tokenizer, model=model)
 
-trainer = Seq2SeqTrainer(
+# Position of the stream in a checkpoint directory
+stream_state_file = "stream_state.pt"
+
+
+class SaveStreamStateCallback(TrainerCallback):
+    def on_save(self, args, state, control, train_dataloader=None, **kwargs):
+        checkpoint_dir = Path(args.output_dir) / f"checkpoint-{state.global_step}"
+        torch.save(train_dataloader.state_dict(), checkpoint_dir / stream_state_file)
+
+
+class BatchSamplerTrainer(Seq2SeqTrainer):
+    def get_train_dataloader(self) -> DataLoader:
+        if streaming:
+            # Not prepared by accelerate, which would drop the stream position, so
+            # streaming trains on a single device
+            train_dataloader = StatefulDataLoader(
+                self.train_dataset,
+                batch_size=streaming_batch_size,
+                collate_fn=self.data_collator,
+                num_workers=streaming_num_workers,
+                pin_memory=self.args.dataloader_pin_memory,
+            )
+            if resume_from_checkpoint is not None:
+                train_dataloader.load_state_dict(
+                    torch.load(resume_from_checkpoint / stream_state_file)
+                )
+            return train_dataloader
+
+        train_dataloader = DataLoader(
+            self.train_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+        return self.accelerator.prepare(train_dataloader)
+
+
+trainer = BatchSamplerTrainer(
     model,
     args,
-    train_dataset=concatenated_dataset,
+    train_dataset=train_dataset,
     data_collator=data_collator,
     tokenizer=tokenizer,
+    callbacks=[SaveStreamStateCallback()] if streaming else None,
 )
 
-trainer.train(resume_from_checkpoint=False)
+trainer.train(
+    resume_from_checkpoint=str(resume_from_checkpoint)
+    if resume_from_checkpoint is not None
+    else False
+)
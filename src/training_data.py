@@ -0,0 +1,324 @@
+"""Tokenized CoCoNuT training data, cached on disk or streamed.
+
+Examples are tokenized once by `num_proc` workers and filtered by length in the same
+pass. The result is saved as Arrow files under a directory named by a fingerprint of
+the preprocessing version, the tokenizer, the datasets and the max lengths, so later
+training runs memory-map it instead of tokenizing again. Exact duplicates and pairs
+that leak benchmark hunks are dropped before tokenization. Corpora too large for
+caching can be streamed instead, with only the leaked pairs dropped.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from typing import Iterator, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow.compute as pc
+from datasets import (
+    Dataset,
+    IterableDataset,
+    concatenate_datasets,
+    interleave_datasets,
+    load_dataset,
+    load_from_disk,
+)
+from torch.utils.data import Sampler
+from transformers import PreTrainedTokenizerFast
+
+from .configs import coconut_data_dir
+from .training_dedup import (
+    LeakageIndex,
+    dedup_version,
+    get_dedup_keys,
+    get_kept_indices,
+    read_benchmark_hunks,
+)
+
+# Bump when `preprocess_function` changes, so stale caches aren't reused
+preprocessing_version = 1
+
+tokenized_data_dir = coconut_data_dir / "Tokenized"
+num_proc = os.cpu_count()
+dedup_report_file = "dedup_report.json"
+
+
+def preprocess_function(
+    examples: dict[str, list],
+    prefix: str,
+    tokenizer: PreTrainedTokenizerFast,
+    max_input_length: int,
+    max_target_length: int,
+) -> dict[str, list]:
+    """Tokenizes a batch of examples and drops the ones whose input without the
+    context is longer than `max_input_length` or whose target is empty or longer than
+    `max_target_length`"""
+
+    inputs = [
+        f"{prefix} {ex.strip()} :".replace(tokenizer.eos_token, tokenizer.unk_token)
+        for ex in examples["rem"]
+    ]
+    targets = [
+        ex.strip().replace(tokenizer.eos_token, tokenizer.unk_token)
+        for ex in examples["add"]
+    ]
+    contexts = [
+        " ".join(ex.split()).replace(tokenizer.eos_token, tokenizer.unk_token)
+        for ex in examples["context"]
+    ]
+
+    inputs_contexts = [f"{src} {ctx}" for src, ctx in zip(inputs, contexts)]
+
+    # Not truncated here, as the length of the input without its context is counted
+    # from the offsets of the tokens that end before the context starts
+    encodings = tokenizer(
+        inputs_contexts,
+        return_offsets_mapping=True,
+        return_special_tokens_mask=True,
+    )
+    labels = tokenizer(targets)["input_ids"]
+
+    model_inputs = {"input_ids": [], "attention_mask": [], "labels": []}
+    for src, input_ids, offsets, special_tokens_mask, label_ids in zip(
+        inputs,
+        encodings["input_ids"],
+        encodings["offset_mapping"],
+        encodings["special_tokens_mask"],
+        labels,
+    ):
+        num_special_tokens = sum(special_tokens_mask)
+        inputs_only_length = num_special_tokens + sum(
+            1
+            for (_, end), special in zip(offsets, special_tokens_mask)
+            if not special and end <= len(src)
+        )
+        if not (
+            inputs_only_length <= max_input_length
+            and 2 < len(label_ids) <= max_target_length
+        ):
+            continue
+
+        # Same as the tokenizer's truncation, which keeps the final special token
+        if len(input_ids) > max_input_length:
+            input_ids = input_ids[: max_input_length - 1] + input_ids[-1:]
+
+        model_inputs["input_ids"].append(input_ids)
+        model_inputs["attention_mask"].append([1] * len(input_ids))
+        model_inputs["labels"].append(label_ids)
+
+    return model_inputs
+
+
+def get_fingerprint(
+    tokenizer: PreTrainedTokenizerFast,
+    dataset_names: dict[str, str],
+    max_input_length: int,
+    max_target_length: int,
+    leakage_index: LeakageIndex,
+) -> str:
+    config = {
+        "preprocessing_version": preprocessing_version,
+        "dedup_version": dedup_version,
+        "benchmark_hunks": leakage_index.get_fingerprint(),
+        "tokenizer": tokenizer.name_or_path,
+        "vocabulary": hashlib.sha256(
+            tokenizer.backend_tokenizer.to_str().encode()
+        ).hexdigest(),
+        "datasets": dataset_names,
+        "max_input_length": max_input_length,
+        "max_target_length": max_target_length,
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def load_tokenized_dataset(
+    tokenizer: PreTrainedTokenizerFast,
+    dataset_names: dict[str, str],
+    max_input_length: int,
+    max_target_length: int,
+) -> Dataset:
+    """Loads the tokenized and concatenated datasets, which are prefixed by their
+    language in `dataset_names`, building the cache on the first call"""
+
+    leakage_index = LeakageIndex(read_benchmark_hunks())
+    cache_dir = tokenized_data_dir / get_fingerprint(
+        tokenizer, dataset_names, max_input_length, max_target_length, leakage_index
+    )
+    if cache_dir.exists():
+        print(pd.read_json(cache_dir / dedup_report_file))
+        return load_from_disk(str(cache_dir))
+
+    dedup_report = []
+    tokenized_datasets = []
+    for prefix, data in dataset_names.items():
+        raw_dataset = load_dataset(data, split="train")
+
+        dedup_keys = raw_dataset.map(
+            get_dedup_keys,
+            batched=True,
+            num_proc=num_proc,
+            remove_columns=raw_dataset.column_names,
+            fn_kwargs={"leakage_index": leakage_index},
+            desc=f"Hashing {prefix}",
+        )
+        kept_indices, duplicates, leaks = get_kept_indices(
+            dedup_keys["exact_key"], dedup_keys["leaked"], set()
+        )
+        dedup_report.append(
+            {
+                "language": prefix,
+                "pairs": len(raw_dataset),
+                "duplicates": duplicates,
+                "leaked": leaks,
+                "kept": len(kept_indices),
+            }
+        )
+        raw_dataset = raw_dataset.select(kept_indices)
+
+        tokenized_datasets.append(
+            raw_dataset.map(
+                preprocess_function,
+                batched=True,
+                num_proc=num_proc,
+                remove_columns=raw_dataset.column_names,
+                fn_kwargs={
+                    "prefix": prefix,
+                    "tokenizer": tokenizer,
+                    "max_input_length": max_input_length,
+                    "max_target_length": max_target_length,
+                },
+                desc=f"Tokenizing {prefix}",
+            )
+        )
+
+    dedup_report_df = pd.DataFrame(dedup_report)
+    print(dedup_report_df)
+
+    # Saved to a temporary directory first, so an interrupted run isn't a cache hit
+    temp_dir = cache_dir.with_name(f"{cache_dir.name}.tmp")
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    concatenate_datasets(tokenized_datasets).save_to_disk(str(temp_dir))
+    dedup_report_df.to_json(temp_dir / dedup_report_file, orient="records", indent=2)
+    temp_dir.rename(cache_dir)
+
+    return load_from_disk(str(cache_dir))
+
+
+def is_not_leaked(example: dict, leakage_index: LeakageIndex) -> bool:
+    return not leakage_index.is_leaked(example["rem"], example["add"])
+
+
+def load_streaming_dataset(
+    tokenizer: PreTrainedTokenizerFast,
+    dataset_names: dict[str, str],
+    max_input_length: int,
+    max_target_length: int,
+    probabilities: Optional[dict[str, float]] = None,
+    seed: int = 42,
+) -> IterableDataset:
+    """Streams the datasets without downloading them first, interleaved by sampling
+    each language with its probability, or in turns if `probabilities` is `None`.
+
+    Examples are tokenized and filtered lazily, in the workers of the data loader
+    that iterates the stream. Pairs that leak benchmark hunks are dropped, but exact
+    duplicates aren't, as that needs the keys of the whole stream. The stream
+    restarts a language when it runs out until every language is exhausted.
+    """
+
+    leakage_index = LeakageIndex(read_benchmark_hunks())
+
+    streams = []
+    for prefix, data in dataset_names.items():
+        raw_stream = load_dataset(data, split="train", streaming=True)
+        streams.append(
+            raw_stream.filter(
+                is_not_leaked, fn_kwargs={"leakage_index": leakage_index}
+            ).map(
+                preprocess_function,
+                batched=True,
+                remove_columns=raw_stream.column_names,
+                fn_kwargs={
+                    "prefix": prefix,
+                    "tokenizer": tokenizer,
+                    "max_input_length": max_input_length,
+                    "max_target_length": max_target_length,
+                },
+            )
+        )
+
+    if probabilities is not None:
+        total = sum(probabilities.values())
+        probabilities = [probabilities[prefix] / total for prefix in dataset_names]
+
+    return interleave_datasets(
+        streams,
+        probabilities=probabilities,
+        seed=seed,
+        stopping_strategy="all_exhausted",
+    )
+
+
+def get_lengths(dataset: Dataset, column: str) -> np.ndarray:
+    """Token counts of a column, read from the Arrow list offsets without decoding"""
+
+    return pc.list_value_length(dataset.data.column(column)).to_numpy()
+
+
+class TokenBudgetBatchSampler(Sampler[list[int]]):
+    """Batches of examples with similar input and label lengths, each with at most
+    `max_tokens` input and label tokens including padding and at most
+    `max_batch_size` examples.
+
+    Batches are built once from the examples sorted by length, with ties broken
+    randomly, so their number is known before training. Each epoch visits them in a
+    different random order, so training isn't ordered by length.
+    """
+
+    def __init__(
+        self,
+        input_lengths: np.ndarray,
+        label_lengths: np.ndarray,
+        max_tokens: int,
+        max_batch_size: int,
+        seed: int = 42,
+    ):
+        self.seed = seed
+        self.epoch = 0
+
+        tie_breaks = np.random.default_rng(seed).random(len(input_lengths))
+        order = np.lexsort((tie_breaks, label_lengths, input_lengths))
+
+        self.batches: list[list[int]] = []
+        batch: list[int] = []
+        max_input_length = max_label_length = 0
+        for index in order.tolist():
+            input_length = max(max_input_length, input_lengths[index])
+            label_length = max(max_label_length, label_lengths[index])
+            if batch and (
+                len(batch) == max_batch_size
+                or (len(batch) + 1) * (input_length + label_length) > max_tokens
+            ):
+                self.batches.append(batch)
+                batch = []
+                input_length = input_lengths[index]
+                label_length = label_lengths[index]
+
+            batch.append(index)
+            max_input_length, max_label_length = input_length, label_length
+
+        if batch:
+            self.batches.append(batch)
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+    def __iter__(self) -> Iterator[list[int]]:
+        rng = np.random.default_rng((self.seed, self.epoch))
+        self.epoch += 1
+        for b in rng.permutation(len(self.batches)):
+            yield self.batches[b]
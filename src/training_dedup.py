@@ -0,0 +1,205 @@
+"""Deduplication of the CoCoNuT training pairs and filtering of benchmark leakage.
+
+Pairs are compared after collapsing whitespace. A pair whose `(rem, add, context)`
+was already seen is an exact duplicate. A pair is leaked when the MinHash estimate
+of the Jaccard similarity between its `rem`/`add` token shingles and those of any
+benchmark hunk in `rem.txt`/`add.txt` is at least `leakage_threshold`. Candidate
+hunks are found with locality-sensitive hashing over bands of the signatures.
+"""
+
+import hashlib
+import re
+from collections import defaultdict
+from pathlib import Path
+from typing import Iterable, Optional
+
+import numpy as np
+
+from .configs import (
+    bugaid_gen_dir,
+    bugsinpy_gen_dir,
+    codeflaws_gen_dir,
+    d4j_gen_dir,
+    quixbugs_genjava_dir,
+    quixbugs_genpy_dir,
+    runbugrunjs_gen_dir,
+)
+
+# Bump when the normalization or the hashing changes
+dedup_version = 1
+
+# Outputs of the bugline finders holding `rem.txt` and `add.txt`
+benchmark_gen_dirs = [
+    quixbugs_genpy_dir,
+    quixbugs_genjava_dir,
+    d4j_gen_dir,
+    codeflaws_gen_dir,
+    bugaid_gen_dir,
+    bugsinpy_gen_dir,
+    runbugrunjs_gen_dir,
+]
+
+shingle_size = 3
+num_perm = 128
+# `num_bands * rows_per_band == num_perm`. A pair with Jaccard similarity s shares a
+# band with a hunk with probability 1 - (1 - s**8)**16, 0.9 at s = 0.8.
+num_bands = 16
+rows_per_band = 8
+leakage_threshold = 0.8
+
+mersenne_prime = (1 << 61) - 1
+max_hash = (1 << 32) - 1
+
+# Arrays of `num_perm` hash functions `(a * x + b) % mersenne_prime`, with `a` and
+# `x` below 2**31 and 2**32 so the products don't overflow 64 bits
+_rng = np.random.default_rng(1)
+perm_a = _rng.integers(1, 1 << 31, num_perm, dtype=np.uint64)
+perm_b = _rng.integers(0, 1 << 31, num_perm, dtype=np.uint64)
+
+token_pattern = re.compile(r"\w+|[^\w\s]")
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.split())
+
+
+def get_exact_key(rem: str, add: str, context: str) -> bytes:
+    text = "\0".join((normalize(rem), normalize(add), normalize(context)))
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+def get_shingles(rem: str, add: str) -> set[str]:
+    """Token n-grams of `rem` and `add`, tagged so shingles don't match across them"""
+
+    shingles = set()
+    for tag, text in (("-", rem), ("+", add)):
+        tokens = token_pattern.findall(text)
+        if len(tokens) < shingle_size:
+            shingles.add(f"{tag} {' '.join(tokens)}")
+            continue
+        for i in range(len(tokens) - shingle_size + 1):
+            shingles.add(f"{tag} {' '.join(tokens[i : i + shingle_size])}")
+    return shingles
+
+
+def get_minhash(shingles: Iterable[str]) -> np.ndarray:
+    hashes = np.fromiter(
+        (
+            int.from_bytes(
+                hashlib.blake2b(s.encode(), digest_size=4).digest(), "little"
+            )
+            for s in shingles
+        ),
+        dtype=np.uint64,
+    )
+    if not len(hashes):
+        return np.full(num_perm, max_hash, dtype=np.uint64)
+
+    permuted = (np.outer(hashes, perm_a) + perm_b) % mersenne_prime & max_hash
+    return permuted.min(axis=0)
+
+
+def get_band_keys(signature: np.ndarray) -> list[bytes]:
+    return [band.tobytes() for band in signature.reshape(num_bands, rows_per_band)]
+
+
+class LeakageIndex:
+    """LSH index of the MinHash signatures of the benchmark hunks"""
+
+    def __init__(self, hunks: list[tuple[str, str]]):
+        self.hunks = hunks
+        self.signatures = np.array(
+            [get_minhash(get_shingles(rem, add)) for rem, add in hunks],
+            dtype=np.uint64,
+        ).reshape(len(hunks), num_perm)
+
+        self.buckets: list[dict[bytes, list[int]]] = [
+            defaultdict(list) for _ in range(num_bands)
+        ]
+        for i, signature in enumerate(self.signatures):
+            for band, key in enumerate(get_band_keys(signature)):
+                self.buckets[band][key].append(i)
+
+    def __len__(self) -> int:
+        return len(self.hunks)
+
+    def get_fingerprint(self) -> str:
+        return hashlib.sha256(self.signatures.tobytes()).hexdigest()[:16]
+
+    def is_leaked(self, rem: str, add: str) -> bool:
+        signature = get_minhash(get_shingles(rem, add))
+        candidates = {
+            i
+            for band, key in enumerate(get_band_keys(signature))
+            for i in self.buckets[band].get(key, ())
+        }
+        if not candidates:
+            return False
+
+        similarities = (self.signatures[list(candidates)] == signature).mean(axis=1)
+        return bool(similarities.max() >= leakage_threshold)
+
+
+def read_benchmark_hunks(
+    gen_dirs: Optional[list[Path]] = None,
+) -> list[tuple[str, str]]:
+    """Removed and added lines of the hunks of the benchmarks whose bugline finders
+    have run"""
+
+    hunks = set()
+    for gen_dir in benchmark_gen_dirs if gen_dirs is None else gen_dirs:
+        rem_file_path = gen_dir / "rem.txt"
+        add_file_path = gen_dir / "add.txt"
+        if not (rem_file_path.exists() and add_file_path.exists()):
+            continue
+
+        with (
+            open(rem_file_path, encoding="utf-8") as remfile,
+            open(add_file_path, encoding="utf-8") as addfile,
+        ):
+            for rem, add in zip(remfile, addfile):
+                hunks.add((normalize(rem), normalize(add)))
+
+    return sorted(hunks)
+
+
+def get_dedup_keys(
+    examples: dict[str, list], leakage_index: LeakageIndex
+) -> dict[str, list]:
+    """Batched `datasets` map that adds the exact key and the leakage flag of each
+    pair, so they are computed in parallel before a sequential pass drops the
+    duplicates"""
+
+    return {
+        "exact_key": [
+            get_exact_key(rem, add, context)
+            for rem, add, context in zip(
+                examples["rem"], examples["add"], examples["context"]
+            )
+        ],
+        "leaked": [
+            leakage_index.is_leaked(rem, add)
+            for rem, add in zip(examples["rem"], examples["add"])
+        ],
+    }
+
+
+def get_kept_indices(
+    exact_keys: Iterable[bytes], leaked: Iterable[bool], seen: set[bytes]
+) -> tuple[list[int], int, int]:
+    """Indices of the first occurrence of each pair that is not leaked, and the
+    numbers of duplicates and leaked pairs. `seen` is updated with the kept keys, so
+    it can be shared across datasets."""
+
+    kept = []
+    duplicates = leaks = 0
+    for i, (key, is_leaked) in enumerate(zip(exact_keys, leaked)):
+        if is_leaked:
+            leaks += 1
+        elif key in seen:
+            duplicates += 1
+        else:
+            seen.add(key)
+            kept.append(i)
+
+    return kept, duplicates, leaks
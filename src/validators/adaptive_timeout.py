@@ -0,0 +1,39 @@
+"""Test timeouts derived from the measured runtime of a reference program"""
+
+import json
+from pathlib import Path
+from typing import Callable, Optional
+
+
+def get_timeout(
+    reference_runtime: Optional[float], factor: float, floor: float, ceiling: float
+) -> float:
+    """Returns `factor` times the reference runtime clamped to [`floor`, `ceiling`].
+
+    An unknown reference runtime (e.g., the reference program itself timed out)
+    gets the `ceiling`.
+    """
+
+    if reference_runtime is None:
+        return ceiling
+
+    return min(max(reference_runtime * factor, floor), ceiling)
+
+
+def get_reference_runtime(
+    runtimes_dir: Path, bugid: str, measure: Callable[[], Optional[float]]
+) -> Optional[float]:
+    """Returns the stored reference runtime of a bug, measuring and storing it on first use"""
+
+    runtime_file_path = runtimes_dir / f"{bugid}.json"
+    if runtime_file_path.exists():
+        with open(runtime_file_path) as file:
+            return json.load(file)["runtime"]
+
+    runtime = measure()
+
+    runtimes_dir.mkdir(parents=True, exist_ok=True)
+    with open(runtime_file_path, "w") as file:
+        json.dump({"bugid": bugid, "runtime": runtime}, file)
+
+    return runtime
@@ -1,7 +1,92 @@
 import ast
 import codeop
+import hashlib
+import keyword
+import sqlite3
+import sys
 import tokenize
+from functools import lru_cache
 from io import BytesIO
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+from joblib import Parallel, delayed
+
+# Batches with more uncached snippets than this are checked in a process pool
+parallel_threshold = 2_000
+
+# Keywords that end an operand or a complete statement, like a name does
+operand_keywords = {"True", "False", "None", "pass", "break", "continue"}
+# Statements starting with these can't parse before the ":" of their header, where
+# `format_python_code` splits them
+header_keywords = {
+    "if",
+    "for",
+    "while",
+    "def",
+    "class",
+    "with",
+    "try",
+    "except",
+    "elif",
+    "else",
+    "finally",
+}
+# Token types that end an operand (`FSTRING_END` is new in Python 3.12)
+operand_types = {
+    tokenize.NUMBER,
+    tokenize.STRING,
+    getattr(tokenize, "FSTRING_END", tokenize.STRING),
+}
+operand_exact_types = {tokenize.RPAR, tokenize.RSQB, tokenize.RBRACE, tokenize.ELLIPSIS}
+
+
+@lru_cache(maxsize=2**16)
+def is_parsable(text: str) -> bool:
+    """Memoized, as candidates of the same hunk share most of their statements"""
+
+    try:
+        ast.parse(text)
+    except SyntaxError:
+        return False
+    return True
+
+
+def ends_operand(tokens: list[tokenize.TokenInfo], k: int) -> bool:
+    """Whether `tokens[k]` can end a complete statement, e.g., a name, a literal or a
+    closing bracket, but not an operator or a keyword that needs an operand"""
+
+    token = tokens[k]
+    if token.type == tokenize.NAME:
+        return not keyword.iskeyword(token.string) or token.string in operand_keywords
+    if token.type in operand_types or token.exact_type in operand_exact_types:
+        return True
+    # `from x import *`
+    return (
+        token.exact_type == tokenize.STAR and k > 0 and tokens[k - 1].string == "import"
+    )
+
+
+def starts_header(token: tokenize.TokenInfo) -> bool:
+    """Whether a statement starting with `token` can't parse until it's split, like
+    block headers and decorators"""
+
+    return token.string in header_keywords or token.exact_type == tokenize.AT
+
+
+def get_ternary_flags(tokens: list[tokenize.TokenInfo]) -> list[bool]:
+    """Whether an `else` comes before the next `:` at or after each token, in a
+    single backward pass over the tokens"""
+
+    flags = [False] * (len(tokens) + 1)
+    for k in range(len(tokens) - 1, -1, -1):
+        if tokens[k].exact_type == tokenize.COLON:
+            flags[k] = False
+        elif tokens[k].string == "else":
+            flags[k] = True
+        else:
+            flags[k] = flags[k + 1]
+    return flags
 
 
 def format_python_code(code_str):
@@ -212,10 +297,17 @@ def format_python_code(code_str):
 
         return "".join(result)
 
+    ternary_flags = get_ternary_flags(meaningful_tokens)
+
     i = 0
     while i < len(meaningful_tokens):
         token = meaningful_tokens[i]
+        if not current_stmt:
+            is_incomplete = starts_header(token)
         current_stmt.append(token)
+        # Stray characters (e.g., `$`) make the rest of the statement invalid
+        if token.type == tokenize.ERRORTOKEN:
+            is_incomplete = True
 
         # Track parenthesis/bracket nesting level
         if token.exact_type in (tokenize.LPAR, tokenize.LSQB, tokenize.LBRACE):
@@ -249,16 +341,8 @@ def format_python_code(code_str):
 
                     # Exception 1: Ternary 'if' (x = 1 if y else z)
                     if next_tok.string == "if":
-                        is_ternary = False
-                        # Scan ahead for 'else' before ':'
-                        for k in range(i + 2, len(meaningful_tokens)):
-                            tk = meaningful_tokens[k]
-                            if tk.string == ":" and tk.exact_type == tokenize.COLON:
-                                break
-                            if tk.string == "else":
-                                is_ternary = True
-                                break
-                        if is_ternary:
+                        # Ternary if there is an 'else' before the next ':'
+                        if ternary_flags[min(i + 2, len(meaningful_tokens))]:
                             should_split = False
 
                     # Exception 2: 'import' following 'from' (from x import y)
@@ -279,24 +363,26 @@ def format_python_code(code_str):
 
                 # General Syntax Check
                 # If "Current + Next" is invalid syntax, but "Current" is valid, split.
+                # Current is never valid when it's a header without its ":" yet or has
+                # a stray character. Otherwise, a name can only make it invalid when
+                # it ends with an operand, while keywords like `as` or `await` always
+                # do, so it's only parsed at these boundaries.
                 elif next_tok.type == tokenize.NAME:
                     # Don't split if next token is a continuation keyword
                     if next_tok.string in continuation_keywords:
                         pass
-                    else:
-                        try:
-                            curr_text = " ".join([t.string for t in current_stmt])
-                            ast.parse(curr_text)
-                            is_curr_valid = True
-                        except SyntaxError:
-                            is_curr_valid = False
-
-                        if is_curr_valid:
-                            try:
-                                ext_text = curr_text + " " + next_tok.string
-                                ast.parse(ext_text)
-                            except SyntaxError:
-                                split_here = True
+                    elif not is_incomplete and (
+                        ends_operand(meaningful_tokens, i)
+                        or (
+                            keyword.iskeyword(next_tok.string)
+                            and next_tok.string not in operand_keywords
+                        )
+                    ):
+                        curr_text = " ".join([t.string for t in current_stmt])
+                        if is_parsable(curr_text) and not is_parsable(
+                            curr_text + " " + next_tok.string
+                        ):
+                            split_here = True
 
         # Finalize the line if split detected or end of stream
         if split_here or i == len(meaningful_tokens) - 1:
@@ -330,6 +416,7 @@ def format_python_code(code_str):
     return "\n".join(formatted_lines)
 
 
+@lru_cache(maxsize=2**16)
 def is_valid_python_snippet(snippet: str) -> bool:
     """
     Check if a Python snippet is syntactically valid in a common Python context.
@@ -370,3 +457,118 @@ def get_valid_python(snippet: str) -> str:
         return format_python_code(snippet)
     except SyntaxError:
         return snippet
+
+
+def is_parsable_patch(snippet: str) -> bool:
+    """Whether a patch is valid Python once reformatted like in validation"""
+
+    return is_valid_python_snippet(get_valid_python(snippet))
+
+
+def is_parsable_file(text: str) -> bool:
+    """Whether a whole source file parses, e.g., a buggy file with a patch applied"""
+
+    try:
+        ast.parse(text)
+    except (SyntaxError, ValueError):
+        return False
+    return True
+
+
+class ValidityCache:
+    """On-disk cache of validity results, keyed by the hash of the checked text and
+    the Python version, as the grammar changes between versions, and the check"""
+
+    def __init__(self, db_path: Path, check: Callable[[str], bool]):
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS validity "
+            "(key TEXT PRIMARY KEY, parsable INTEGER NOT NULL)"
+        )
+        self.version = f"{sys.version_info.major}.{sys.version_info.minor}"
+        self.check_name = check.__name__
+
+    def get_key(self, snippet: str) -> str:
+        return hashlib.sha256(
+            f"{self.version}\0{self.check_name}\0{snippet}".encode()
+        ).hexdigest()
+
+    def get_many(self, snippets: list[str]) -> dict[str, bool]:
+        keys = {self.get_key(snippet): snippet for snippet in snippets}
+        results = {}
+        key_list = list(keys)
+        # Stay below SQLite's limit on the number of query parameters
+        for start in range(0, len(key_list), 500):
+            chunk = key_list[start : start + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            for key, parsable in self.connection.execute(
+                f"SELECT key, parsable FROM validity WHERE key IN ({placeholders})",
+                chunk,
+            ):
+                results[keys[key]] = bool(parsable)
+        return results
+
+    def set_many(self, results: dict[str, bool]) -> None:
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO validity (key, parsable) VALUES (?, ?)",
+                [
+                    (self.get_key(snippet), parsable)
+                    for snippet, parsable in results.items()
+                ],
+            )
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def check_parsable_patches(
+    snippets: Iterable[str], cache_path: Optional[Path] = None, n_jobs: int = 1
+) -> list[bool]:
+    """Checks `is_parsable_patch` for a batch of snippets, e.g., a whole candidates
+    column. Each distinct snippet is checked once, skipping the ones in the
+    in-memory or on-disk cache, and large batches are spread over `n_jobs`
+    processes."""
+
+    return check_batch(snippets, is_parsable_patch, cache_path, n_jobs)
+
+
+def check_parsable_files(
+    texts: Iterable[str], cache_path: Optional[Path] = None, n_jobs: int = 1
+) -> list[bool]:
+    """Checks `is_parsable_file` for a batch of source files, e.g., a buggy file with
+    each candidate of a hunk applied, like `check_parsable_patches`"""
+
+    return check_batch(texts, is_parsable_file, cache_path, n_jobs)
+
+
+def check_batch(
+    snippets: Iterable[str],
+    check: Callable[[str], bool],
+    cache_path: Optional[Path],
+    n_jobs: int,
+) -> list[bool]:
+    snippets = list(snippets)
+    unique_snippets = list(dict.fromkeys(snippets))
+
+    cache = ValidityCache(cache_path, check) if cache_path is not None else None
+    try:
+        results = cache.get_many(unique_snippets) if cache is not None else {}
+        unchecked = [snippet for snippet in unique_snippets if snippet not in results]
+
+        if n_jobs != 1 and len(unchecked) > parallel_threshold:
+            checked = Parallel(n_jobs=n_jobs, batch_size=256)(
+                delayed(check)(snippet) for snippet in unchecked
+            )
+        else:
+            checked = [check(snippet) for snippet in unchecked]
+        new_results = dict(zip(unchecked, checked))
+
+        if cache is not None:
+            cache.set_many(new_results)
+    finally:
+        if cache is not None:
+            cache.close()
+
+    results.update(new_results)
+    return [results[snippet] for snippet in snippets]
@@ -0,0 +1,240 @@
+"""Fork server for running a compiled program against many test inputs.
+
+The program is started once with a small shared library preloaded, whose constructor
+runs before `main` and waits for requests on a pipe. Each request names an input and
+an output file, and the server forks a child that redirects its stdin and stdout to
+them and returns to `main`. The dynamic linking and libc startup of the program are
+done once, so each test costs a fork.
+
+Statically linked programs don't load the library, so the server doesn't start and
+`ForkServer.ready` is `False`, and callers should run the program directly.
+"""
+
+import hashlib
+import os
+import select
+import signal
+import struct
+import subprocess
+import threading
+from pathlib import Path
+from typing import Callable, Optional
+
+fds_env_var = "MULTIMEND_FORK_SERVER_FDS"
+
+# Seconds to wait for the server to start or fork a child
+startup_timeout = 10
+
+fork_server_source = r"""
+#include <fcntl.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <sys/types.h>
+#include <sys/wait.h>
+#include <unistd.h>
+
+static int read_all(int fd, void *buf, size_t size) {
+    char *p = buf;
+    while (size > 0) {
+        ssize_t n = read(fd, p, size);
+        if (n <= 0)
+            return -1;
+        p += n;
+        size -= n;
+    }
+    return 0;
+}
+
+static int read_path(int fd, char *path, size_t size) {
+    uint32_t length;
+    if (read_all(fd, &length, sizeof(length)) || length >= size)
+        return -1;
+    if (read_all(fd, path, length))
+        return -1;
+    path[length] = '\0';
+    return 0;
+}
+
+static void write_word(int fd, uint32_t word) {
+    if (write(fd, &word, sizeof(word)) != sizeof(word))
+        _exit(1);
+}
+
+__attribute__((constructor)) static void multimend_fork_server(void) {
+    const char *fds = getenv("MULTIMEND_FORK_SERVER_FDS");
+    int ctl, st;
+    if (!fds || sscanf(fds, "%d,%d", &ctl, &st) != 2)
+        return;
+    /* Processes started by the program don't serve */
+    unsetenv("MULTIMEND_FORK_SERVER_FDS");
+    unsetenv("LD_PRELOAD");
+
+    static char input[4096], output[4096];
+    write_word(st, 0);
+    for (;;) {
+        if (read_path(ctl, input, sizeof(input)) ||
+            read_path(ctl, output, sizeof(output)))
+            _exit(0);
+
+        pid_t pid = fork();
+        if (pid < 0)
+            _exit(1);
+        if (pid == 0) {
+            close(ctl);
+            close(st);
+            int in = open(input, O_RDONLY);
+            int out = open(output, O_WRONLY | O_CREAT | O_TRUNC, 0644);
+            int err = open("/dev/null", O_WRONLY);
+            if (in < 0 || out < 0 || err < 0)
+                _exit(127);
+            dup2(in, 0);
+            dup2(out, 1);
+            dup2(err, 2);
+            close(in);
+            close(out);
+            close(err);
+            return;
+        }
+
+        int status;
+        write_word(st, (uint32_t)pid);
+        if (waitpid(pid, &status, 0) < 0)
+            _exit(1);
+        write_word(st, (uint32_t)status);
+    }
+}
+"""
+
+_build_lock = threading.Lock()
+
+
+class ForkServerError(Exception):
+    pass
+
+
+def build_fork_server(build_dir: Path) -> Path:
+    """Compiles the preloaded library once per version of its source"""
+
+    digest = hashlib.sha256(fork_server_source.encode()).hexdigest()[:16]
+    library_path = build_dir / f"fork-server-{digest}.so"
+
+    with _build_lock:
+        if library_path.exists():
+            return library_path
+
+        # Built under temporary names, so other processes never load a partial file
+        build_dir.mkdir(parents=True, exist_ok=True)
+        source_path = build_dir / f"fork-server-{digest}.{os.getpid()}.c"
+        source_path.write_text(fork_server_source)
+        temp_path = library_path.with_suffix(f".{os.getpid()}.tmp")
+        subprocess.run(
+            ["gcc", "-shared", "-fPIC", "-O2", "-o", str(temp_path), str(source_path)],
+            capture_output=True,
+            check=True,
+        )
+        os.replace(temp_path, library_path)
+        source_path.unlink()
+
+    return library_path
+
+
+class ForkServer:
+    """Serves the program at `binary_path` from `cwd`. Relative paths of requests are
+    relative to `cwd`. `preexec_fn` runs in the server process before the program,
+    e.g., to set rlimits that its children inherit."""
+
+    def __init__(
+        self,
+        binary_path: Path,
+        cwd: Path,
+        library_path: Path,
+        env: Optional[dict[str, str]] = None,
+        preexec_fn: Optional[Callable[[], None]] = None,
+    ):
+        ctl_read, self.ctl_write = os.pipe()
+        self.st_read, st_write = os.pipe()
+
+        env = dict(os.environ if env is None else env)
+        env[fds_env_var] = f"{ctl_read},{st_write}"
+        env["LD_PRELOAD"] = " ".join(
+            filter(None, [str(library_path), env.get("LD_PRELOAD")])
+        )
+
+        try:
+            self.process = subprocess.Popen(
+                [str(cwd / binary_path)],
+                cwd=cwd,
+                env=env,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                pass_fds=(ctl_read, st_write),
+                preexec_fn=preexec_fn,
+            )
+        finally:
+            os.close(ctl_read)
+            os.close(st_write)
+
+        # Without the library, the program runs `main` with no input and exits
+        self.ready = self.read_word(startup_timeout) is not None
+
+    def read_word(self, timeout: Optional[float]) -> Optional[int]:
+        """Reads a word from the server, `None` on timeout or if it exited"""
+
+        data = b""
+        while len(data) < 4:
+            readable, _, _ = select.select([self.st_read], [], [], timeout)
+            if not readable:
+                return None
+            chunk = os.read(self.st_read, 4 - len(data))
+            if not chunk:
+                return None
+            data += chunk
+
+        return struct.unpack("=I", data)[0]
+
+    def run(self, input_path: Path, output_path: Path, timeout: float) -> Optional[int]:
+        """Runs the program with stdin from `input_path` and stdout to `output_path`.
+        Returns its wait status, or `None` if it was killed at `timeout` seconds."""
+
+        request = b"".join(
+            struct.pack("=I", len(path)) + path
+            for path in (os.fsencode(input_path), os.fsencode(output_path))
+        )
+        try:
+            os.write(self.ctl_write, request)
+        except BrokenPipeError as e:
+            raise ForkServerError("Fork server exited") from e
+
+        pid = self.read_word(startup_timeout)
+        if pid is None:
+            raise ForkServerError("Fork server didn't start a child")
+
+        status = self.read_word(timeout)
+        if status is not None:
+            return status
+
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        if self.read_word(startup_timeout) is None:
+            raise ForkServerError("Fork server didn't reap a killed child")
+        return None
+
+    def close(self) -> None:
+        # The server exits when the control pipe is closed
+        os.close(self.ctl_write)
+        try:
+            self.process.wait(timeout=startup_timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        os.close(self.st_read)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,212 @@
+"""Search over combinations of hunk candidates for bugs with multiple hunks.
+
+Validators provide the candidates of each hunk and a function that applies a
+list of patches (one per hunk, starting from the first hunk; later hunks keep
+their buggy code) and runs the tests. Strategies:
+
+- "greedy": goes through the hunks in order and keeps the first candidate of each
+  hunk that reduces the number of failing tests, or the buggy source otherwise.
+- "beam": tests full combinations of the top `beam_width` candidates of each hunk
+  in best-first order of summed `rank` (ties broken by summed `sequences_scores`).
+- "delta": goes through the hunks in order like "greedy", but tests the top
+  `beam_width` candidates of each hunk and keeps the one that reduces the number
+  of failing tests the most.
+"""
+
+import heapq
+import sys
+from typing import Callable, NamedTuple, Optional
+
+import pandas as pd
+
+strategies = ["greedy", "beam", "delta"]
+
+
+class Candidate(NamedTuple):
+    """Fields of a candidate patch of a single hunk"""
+
+    checkpoint: str
+    decoded_sequences: str
+    normalized_patch: str
+    sequences_scores: Optional[float]
+    rank: Optional[int]
+    exact_match: bool
+
+
+class TestResult(NamedTuple):
+    plausible: bool
+    # `None` when the failing tests are unknown, e.g., uncompilable or timed out
+    failed_count: Optional[int]
+    # Status columns recorded for the tested combination
+    fields: dict
+
+
+class Trial(NamedTuple):
+    # One candidate per hunk, starting from the first hunk
+    candidates: tuple[Candidate, ...]
+    result: TestResult
+
+
+class SearchResult(NamedTuple):
+    strategy: str
+    trials: list[Trial]
+    test_runs: int
+    # Number of test runs up to and including the first plausible combination
+    runs_to_plausible: Optional[int]
+
+
+class BudgetExhausted(Exception):
+    pass
+
+
+def get_candidates(df: pd.DataFrame) -> list[Candidate]:
+    return [
+        Candidate(*row) for row in df[list(Candidate._fields)].itertuples(index=False)
+    ]
+
+
+def get_source_candidate(source: str, normalized_source: str) -> Candidate:
+    """The buggy source of a hunk, used when no candidate of the hunk is kept"""
+
+    return Candidate("manual", source, normalized_source, None, None, False)
+
+
+def get_trial_record(template: dict, trial: Trial) -> dict:
+    """Fills the per-bug `template` record with the candidates and status of a trial"""
+
+    record = dict(template)
+    for field in Candidate._fields:
+        record[field] = [getattr(candidate, field) for candidate in trial.candidates]
+    record.update(trial.result.fields)
+    return record
+
+
+class MultiHunkSearch:
+    def __init__(
+        self,
+        hunk_candidates: list[list[Candidate]],
+        source_candidates: list[Candidate],
+        run_tests: Callable[[list[str]], TestResult],
+        test_budget: int,
+        beam_width: int,
+        on_trial: Optional[Callable[[Trial], None]] = None,
+    ):
+        self.hunk_candidates = hunk_candidates
+        self.source_candidates = source_candidates
+        self.run_tests = run_tests
+        self.test_budget = test_budget
+        self.beam_width = beam_width
+        self.on_trial = on_trial
+
+        self.trials: list[Trial] = []
+        self.test_runs = 0
+        self.runs_to_plausible: Optional[int] = None
+
+    def run(self, strategy: str) -> SearchResult:
+        if strategy not in strategies:
+            raise ValueError(f"Unknown multi-hunk search strategy: {strategy}")
+
+        try:
+            getattr(self, strategy)()
+        except BudgetExhausted:
+            pass
+
+        return SearchResult(
+            strategy, self.trials, self.test_runs, self.runs_to_plausible
+        )
+
+    def test(self, candidates: tuple[Candidate, ...]) -> TestResult:
+        """Tests a combination; the empty combination runs the buggy program"""
+
+        if self.test_runs >= self.test_budget:
+            raise BudgetExhausted
+
+        self.test_runs += 1
+        result = self.run_tests(
+            [candidate.decoded_sequences for candidate in candidates]
+        )
+
+        if candidates and result.plausible and self.runs_to_plausible is None:
+            self.runs_to_plausible = self.test_runs
+
+        if candidates:
+            trial = Trial(candidates, result)
+            self.trials.append(trial)
+            if self.on_trial is not None:
+                self.on_trial(trial)
+
+        return result
+
+    def get_baseline_failed_count(self) -> int:
+        return self.test(()).failed_count or sys.maxsize
+
+    def greedy(self) -> None:
+        running_failed_count = self.get_baseline_failed_count()
+        accepted: tuple[Candidate, ...] = ()
+
+        for i, candidates in enumerate(self.hunk_candidates):
+            for candidate in candidates:
+                result = self.test(accepted + (candidate,))
+                if result.plausible:
+                    return
+                if result.failed_count and result.failed_count < running_failed_count:
+                    running_failed_count = result.failed_count
+                    accepted += (candidate,)
+                    break
+            else:
+                accepted += (self.source_candidates[i],)
+
+    def delta(self) -> None:
+        running_failed_count = self.get_baseline_failed_count()
+        accepted: tuple[Candidate, ...] = ()
+
+        for i, candidates in enumerate(self.hunk_candidates):
+            best_candidate = self.source_candidates[i]
+            for candidate in candidates[: self.beam_width]:
+                result = self.test(accepted + (candidate,))
+                if result.plausible:
+                    return
+                if result.failed_count and result.failed_count < running_failed_count:
+                    running_failed_count = result.failed_count
+                    best_candidate = candidate
+            accepted += (best_candidate,)
+
+    def beam(self) -> None:
+        pools = [candidates[: self.beam_width] for candidates in self.hunk_candidates]
+        if not all(pools):
+            return
+
+        def get_priority(indices: tuple[int, ...]) -> tuple[float, float]:
+            chosen = [pool[j] for pool, j in zip(pools, indices)]
+            return (
+                sum(candidate.rank or 0 for candidate in chosen),
+                -sum(candidate.sequences_scores or 0 for candidate in chosen),
+            )
+
+        start = (0,) * len(pools)
+        heap = [(get_priority(start), start)]
+        seen = {start}
+        while heap:
+            _, indices = heapq.heappop(heap)
+            result = self.test(tuple(pool[j] for pool, j in zip(pools, indices)))
+            if result.plausible:
+                return
+
+            for h, pool in enumerate(pools):
+                if indices[h] + 1 < len(pool):
+                    neighbor = indices[:h] + (indices[h] + 1,) + indices[h + 1 :]
+                    if neighbor not in seen:
+                        seen.add(neighbor)
+                        heapq.heappush(heap, (get_priority(neighbor), neighbor))
+
+
+def summarize_search_stats(search_stats: pd.DataFrame) -> pd.DataFrame:
+    """Test runs of each strategy, from `StateStore.get_search_stats`"""
+
+    return search_stats.groupby("strategy").agg(
+        bugs=("bugid", "size"),
+        plausible=("runs_to_plausible", "count"),
+        mean_test_runs=("test_runs", "mean"),
+        mean_runs_to_plausible=("runs_to_plausible", "mean"),
+        median_runs_to_plausible=("runs_to_plausible", "median"),
+    )
@@ -0,0 +1,110 @@
+"""Applies candidate patches to buggy source files that are read only once per bug.
+
+Each source file is decoded once and kept with the offset of each of its lines, so
+a candidate is rendered by joining slices of the source text and its replacement
+texts, and each target file is written with a single write.
+"""
+
+import re
+from collections import defaultdict
+from pathlib import Path
+from typing import Iterable, NamedTuple, Sequence
+
+
+class Replacement(NamedTuple):
+    # Zero-based, end-exclusive range of the replaced lines
+    start: int
+    end: int
+    text: str
+
+
+def get_replacement(bug_line: int, bug_len: int, text: str) -> Replacement:
+    """Replaces `bug_len` lines from line `bug_line` (one-based) with `text`, or
+    inserts `text` after line `bug_line` when `bug_len` is 0"""
+
+    if bug_len == 0:
+        return Replacement(bug_line, bug_line, text)
+    return Replacement(bug_line - 1, bug_line - 1 + bug_len, text)
+
+
+class SourceFile:
+    def __init__(self, text: str):
+        self.text = text
+        self.line_offsets = [0] + [m.end() for m in re.finditer("\n", text)]
+
+    def get_offset(self, line: int) -> int:
+        if line < len(self.line_offsets):
+            return self.line_offsets[line]
+        return len(self.text)
+
+    def render(self, replacements: Iterable[Replacement]) -> str:
+        """Applies replacements of non-overlapping line ranges of the source text.
+        Insertions at the same line keep their given order."""
+
+        parts = []
+        position = 0
+        for start, end, text in sorted(replacements, key=lambda r: (r.start, r.end)):
+            parts.append(self.text[position : self.get_offset(start)])
+            parts.append(text)
+            position = max(position, self.get_offset(end))
+        parts.append(self.text[position:])
+
+        return "".join(parts)
+
+
+class PatchApplier:
+    """Source files are decoded with the first of `encodings`, and targets are
+    written with the first of them that can encode the patched text"""
+
+    def __init__(self, encodings: Sequence[str] = ("utf-8",)):
+        self.encodings = encodings
+        self.sources: dict[Path, SourceFile] = {}
+
+    def load(self, source_file_path: Path) -> SourceFile:
+        if source_file_path not in self.sources:
+            with open(source_file_path, encoding=self.encodings[0]) as file:
+                self.sources[source_file_path] = SourceFile(file.read())
+        return self.sources[source_file_path]
+
+    def render(
+        self, source_file_path: Path, replacements: Iterable[Replacement]
+    ) -> str:
+        return self.load(source_file_path).render(replacements)
+
+    def write(self, text: str, target_file_path: Path) -> None:
+        for encoding in self.encodings[:-1]:
+            try:
+                data = text.encode(encoding)
+                break
+            except UnicodeEncodeError:
+                continue
+        else:
+            data = text.encode(self.encodings[-1])
+
+        with open(target_file_path, "wb") as file:
+            file.write(data)
+
+    def apply(
+        self,
+        source_file_path: Path,
+        target_file_path: Path,
+        replacements: Iterable[Replacement],
+    ) -> None:
+        self.write(self.render(source_file_path, replacements), target_file_path)
+
+    def apply_hunks(
+        self, hunk_replacements: Iterable[tuple[Path, Path, Replacement]]
+    ) -> None:
+        """Applies the replacements of all hunks of a candidate, given as
+        `(source_file_path, target_file_path, replacement)`, writing each target
+        file once"""
+
+        file_replacements = defaultdict(list)
+        for source_file_path, target_file_path, replacement in hunk_replacements:
+            file_replacements[(source_file_path, target_file_path)].append(replacement)
+
+        for (
+            source_file_path,
+            target_file_path,
+        ), replacements in file_replacements.items():
+            self.apply(source_file_path, target_file_path, replacements)
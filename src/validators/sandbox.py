@@ -0,0 +1,338 @@
+"""Resource limits for running the tests of candidates.
+
+Test processes run with rlimits on their CPU time, memory and the size of the files
+they write, so a runaway candidate fails on its own instead of swapping the host and
+slowing down the other workers. The limits are per process and are inherited by the
+processes they start.
+
+When `cgroup_root` is set, each run also gets its own child cgroup there, which caps
+the memory and the number of tasks of the whole process tree and is killed with it.
+It should be an empty cgroup v2 directory writable by the user, with the `memory` and
+`pids` controllers in its `cgroup.subtree_control` (e.g., a subdirectory of a
+`systemd-run --user -p Delegate=yes` scope). The number of processes isn't limited
+without a cgroup, as `RLIMIT_NPROC` counts all processes of the user, and exceeding
+the memory rlimit makes allocations fail, which the program reports as an ordinary
+error.
+
+Runs that exceed a limit raise `LimitExceeded`, and runs killed by setting their `stop`
+event raise `Stopped`.
+"""
+
+import contextlib
+import itertools
+import locale
+import os
+import platform
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterator, NamedTuple, Optional
+
+if platform.system() != "Windows":
+    import resource
+else:
+    resource = None
+
+cgroup_root = (
+    Path(os.environ["MULTIMEND_CGROUP"]) if "MULTIMEND_CGROUP" in os.environ else None
+)
+
+# Seconds to wait for the processes of a killed cgroup to exit
+cgroup_cleanup_timeout = 5
+# Seconds between checks of the `stop` event of a run
+stop_poll_interval = 0.1
+
+_run_ids = itertools.count()
+
+
+class Limits(NamedTuple):
+    memory_bytes: Optional[int] = None
+    cpu_seconds: Optional[int] = None
+    max_processes: Optional[int] = None
+    output_bytes: Optional[int] = None
+
+
+class LimitExceeded(Exception):
+    def __init__(self, limit: str):
+        super().__init__(f"Exceeded the {limit} limit")
+        self.limit = limit
+
+
+class Stopped(Exception):
+    """The run was killed as its result isn't needed anymore"""
+
+
+def get_signal_limit(returncode: int) -> Optional[str]:
+    """The limit that killed a process from its `subprocess` return code"""
+
+    if resource is None or returncode >= 0:
+        return None
+    elif -returncode == signal.SIGXCPU:
+        return "cpu"
+    elif -returncode == signal.SIGXFSZ:
+        return "output"
+    return None
+
+
+def read_event_count(events_file_path: Path, event: str) -> int:
+    for line in events_file_path.read_text().splitlines():
+        name, count = line.split()
+        if name == event:
+            return int(count)
+    return 0
+
+
+class Sandbox:
+    def __init__(self, limits: Limits, cgroup_dir: Optional[Path] = cgroup_root):
+        self.limits = limits
+        self.cgroup_dir = cgroup_dir if resource is not None else None
+
+    def get_rlimits(self) -> list[tuple[int, int, int]]:
+        limits = self.limits
+        rlimits = []
+        if limits.memory_bytes is not None:
+            # Unlike the address space, the data segment doesn't count the memory
+            # that runtimes such as the JVM and V8 reserve but don't use
+            memory_rlimit = (
+                resource.RLIMIT_DATA
+                if platform.system() == "Linux"
+                else resource.RLIMIT_AS
+            )
+            rlimits.append((memory_rlimit, limits.memory_bytes, limits.memory_bytes))
+        if limits.cpu_seconds is not None:
+            # SIGXCPU at the soft limit tells it apart from other kills
+            rlimits.append(
+                (resource.RLIMIT_CPU, limits.cpu_seconds, limits.cpu_seconds + 1)
+            )
+        if limits.output_bytes is not None:
+            rlimits.append(
+                (resource.RLIMIT_FSIZE, limits.output_bytes, limits.output_bytes)
+            )
+
+        # Limits can't be raised above the current hard limits
+        capped_rlimits = []
+        for rlimit, soft, hard in rlimits:
+            _, current_hard = resource.getrlimit(rlimit)
+            if current_hard != resource.RLIM_INFINITY:
+                soft, hard = min(soft, current_hard), min(hard, current_hard)
+            capped_rlimits.append((rlimit, soft, hard))
+        return capped_rlimits
+
+    def get_preexec_fn(
+        self, cgroup_procs_fd: Optional[int] = None
+    ) -> Optional[Callable]:
+        """Function that applies the limits in the child process before it starts
+        the program. It only makes system calls, as the parent may have threads."""
+
+        if resource is None:
+            return None
+
+        rlimits = self.get_rlimits()
+
+        def preexec_fn() -> None:
+            if cgroup_procs_fd is not None:
+                os.write(cgroup_procs_fd, b"0")
+            for rlimit, soft, hard in rlimits:
+                resource.setrlimit(rlimit, (soft, hard))
+
+        return preexec_fn
+
+    @contextlib.contextmanager
+    def cgroup(self) -> Iterator[Optional[Path]]:
+        """A child cgroup with the limits for one run, killed and removed after it"""
+
+        if self.cgroup_dir is None:
+            yield None
+            return
+
+        cgroup_path = (
+            self.cgroup_dir
+            / f"multimend-{os.getpid()}-{threading.get_ident()}-{next(_run_ids)}"
+        )
+        cgroup_path.mkdir()
+        try:
+            if self.limits.memory_bytes is not None:
+                (cgroup_path / "memory.max").write_text(str(self.limits.memory_bytes))
+                with contextlib.suppress(FileNotFoundError):
+                    (cgroup_path / "memory.swap.max").write_text("0")
+            if self.limits.max_processes is not None:
+                (cgroup_path / "pids.max").write_text(str(self.limits.max_processes))
+            yield cgroup_path
+        finally:
+            kill_file_path = cgroup_path / "cgroup.kill"
+            if kill_file_path.exists():
+                kill_file_path.write_text("1")
+            else:
+                for pid in (cgroup_path / "cgroup.procs").read_text().split():
+                    with contextlib.suppress(ProcessLookupError):
+                        os.kill(int(pid), signal.SIGKILL)
+
+            # The directory can be removed once the killed processes have exited
+            deadline = time.monotonic() + cgroup_cleanup_timeout
+            while True:
+                try:
+                    cgroup_path.rmdir()
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        raise
+                    time.sleep(0.01)
+
+    def get_exceeded_limit(
+        self, returncode: int, cgroup_path: Optional[Path]
+    ) -> Optional[str]:
+        if cgroup_path is not None:
+            if read_event_count(cgroup_path / "memory.events", "oom_kill"):
+                return "memory"
+            if read_event_count(cgroup_path / "pids.events", "max"):
+                return "processes"
+        return get_signal_limit(returncode)
+
+    def check(self, returncode: int) -> None:
+        """Raises `LimitExceeded` if a process started with `get_preexec_fn` was
+        killed by a limit"""
+
+        limit = get_signal_limit(returncode)
+        if limit is not None:
+            raise LimitExceeded(limit)
+
+    def run(
+        self,
+        args: list,
+        timeout: Optional[float] = None,
+        stop: Optional[threading.Event] = None,
+        **kwargs,
+    ) -> subprocess.CompletedProcess:
+        """`subprocess.run` with the limits, in a new session. The whole process tree
+        is killed at `timeout`, which raises `subprocess.TimeoutExpired` unless a
+        limit was exceeded first, or once `stop` is set, which raises `Stopped`.
+        Captured output, with `capture_output` or `subprocess.PIPE`, goes through
+        temporary files rather than pipes, so the output limit applies to it."""
+
+        input = kwargs.pop("input", None)
+        if input is not None:
+            kwargs["stdin"] = subprocess.PIPE
+        if kwargs.pop("capture_output", False):
+            kwargs["stdout"] = kwargs["stderr"] = subprocess.PIPE
+
+        with contextlib.ExitStack() as stack:
+            output_files = {}
+            for stream in ["stdout", "stderr"]:
+                if kwargs.get(stream) == subprocess.PIPE:
+                    output_files[stream] = kwargs[stream] = stack.enter_context(
+                        tempfile.TemporaryFile()
+                    )
+            process = self.communicate(args, input, timeout, stop, kwargs)
+            if not output_files:
+                return process
+
+            return subprocess.CompletedProcess(
+                args,
+                process.returncode,
+                *(
+                    read_output(output_files[stream], kwargs)
+                    if stream in output_files
+                    else None
+                    for stream in ["stdout", "stderr"]
+                ),
+            )
+
+    def communicate(
+        self,
+        args: list,
+        input,
+        timeout: Optional[float],
+        stop: Optional[threading.Event],
+        kwargs: dict,
+    ) -> subprocess.CompletedProcess:
+        with self.cgroup() as cgroup_path:
+            procs_fd = None
+            if cgroup_path is not None:
+                procs_fd = os.open(cgroup_path / "cgroup.procs", os.O_WRONLY)
+            try:
+                process = subprocess.Popen(
+                    args,
+                    preexec_fn=self.get_preexec_fn(procs_fd),
+                    start_new_session=True,
+                    **kwargs,
+                )
+            finally:
+                if procs_fd is not None:
+                    os.close(procs_fd)
+
+            with process:
+                try:
+                    stdout, stderr = communicate_until(process, input, timeout, stop)
+                except subprocess.TimeoutExpired:
+                    kill_session(process)
+                    process.communicate()
+                    limit = self.get_exceeded_limit(process.returncode, cgroup_path)
+                    if limit is not None:
+                        raise LimitExceeded(limit)
+                    raise
+                except BaseException:
+                    kill_session(process)
+                    raise
+
+            limit = self.get_exceeded_limit(process.returncode, cgroup_path)
+            if limit is not None:
+                raise LimitExceeded(limit)
+
+        return subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+
+
+def communicate_until(
+    process: subprocess.Popen,
+    input,
+    timeout: Optional[float],
+    stop: Optional[threading.Event],
+) -> tuple:
+    """`process.communicate`, raising `Stopped` once `stop` is set. The caller kills
+    the process, as on `subprocess.TimeoutExpired`."""
+
+    if stop is None:
+        return process.communicate(input, timeout=timeout)
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while not stop.is_set():
+        wait = stop_poll_interval
+        if deadline is not None:
+            wait = max(0.0, min(wait, deadline - time.monotonic()))
+        try:
+            return process.communicate(input, timeout=wait)
+        except subprocess.TimeoutExpired:
+            # Retrying `communicate` doesn't lose any input or output
+            if deadline is not None and time.monotonic() >= deadline:
+                raise subprocess.TimeoutExpired(process.args, timeout)
+    raise Stopped
+
+
+def kill_session(process: subprocess.Popen) -> None:
+    """Kills a process started in a new session and the processes it started"""
+
+    if resource is None:
+        process.kill()
+        return
+
+    with contextlib.suppress(ProcessLookupError):
+        os.killpg(process.pid, signal.SIGKILL)
+
+
+def read_output(file, kwargs: dict):
+    """Reads captured output back, decoded as `subprocess.run` would with `kwargs`"""
+
+    file.seek(0)
+    data = file.read()
+    if not any(
+        kwargs.get(k) for k in ("text", "universal_newlines", "encoding", "errors")
+    ):
+        return data
+
+    text = data.decode(
+        kwargs.get("encoding") or locale.getpreferredencoding(False),
+        kwargs.get("errors") or "strict",
+    )
+    return text.replace("\r\n", "\n").replace("\r", "\n")
@@ -0,0 +1,322 @@
+"""Mutant schemata, so all candidates of a hunk are compiled together.
+
+The buggy lines of the hunk are replaced with an `if`/`else if` chain of branches, one
+per candidate, selected at runtime by the `MULTIMEND_CANDIDATE` environment variable,
+and the buggy lines stay in the final `else` branch. A chain rather than a `switch`,
+so `break` statements of candidates keep their target. Compilation errors are
+attributed to branches by their line numbers, and the failing branches are dropped
+before compiling the rest again. Each remaining candidate is then tested by setting
+the variable, without compiling again. A branch can compile where the candidate
+applied on its own doesn't, e.g., Java statements after a `return` are only
+unreachable outside the `if` (JLS 14.22), so plausible candidates should be compiled
+again on their own with `compiles_alone`.
+
+Only complete statements can be branches: the buggy lines and the candidate must have
+balanced brackets, end with `;` or `}`, and not declare variables (which would be
+scoped to the branch) or hold `case` labels and the like. Other candidates are applied
+and compiled separately, as are the candidates of a group whose errors can't be
+attributed to branches, e.g., a missing `return` or a method that is too large.
+"""
+
+import os
+import re
+from enum import Enum, auto
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+
+from .patch_applier import PatchApplier, Replacement, get_replacement
+
+env_var = "MULTIMEND_CANDIDATE"
+
+brackets = {"(": ")", "[": "]", "{": "}"}
+
+
+class SchemataStatus(Enum):
+    # The candidate's branch compiled, test it with `get_candidate_env`
+    COMPILED = auto()
+    # The candidate can't compile, no need to test it
+    UNCOMPILABLE = auto()
+    # The candidate should be applied, compiled and tested on its own
+    SEPARATE = auto()
+
+
+def get_top_level_code(text: str) -> Optional[str]:
+    """The code of `text` outside of brackets, literals and comments, with the
+    brackets kept, or `None` if the brackets are unbalanced"""
+
+    code = []
+    stack = []
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if text.startswith("//", i):
+            i = text.find("\n", i)
+            if i == -1:
+                break
+            continue
+        if text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            if end == -1:
+                return None
+            i = end + 2
+            continue
+        if char in "\"'":
+            i += 1
+            while i < len(text) and text[i] != char:
+                i += 2 if text[i] == "\\" else 1
+            if i >= len(text):
+                return None
+            if not stack:
+                code.append(char * 2)
+            i += 1
+            continue
+
+        if char in brackets:
+            if not stack:
+                code.append(char)
+            stack.append(brackets[char])
+        elif char in brackets.values():
+            if not stack or stack.pop() != char:
+                return None
+            if not stack:
+                code.append(char)
+        elif not stack:
+            code.append(char)
+        i += 1
+
+    return None if stack else "".join(code)
+
+
+def is_balanced(text: str) -> bool:
+    return get_top_level_code(text) is not None
+
+
+def get_candidate_env(index: int) -> dict[str, str]:
+    return {**os.environ, env_var: str(index)}
+
+
+class Schemata:
+    """Schemata of a hunk replacing `bug_len` lines from `bug_line`, whose
+    candidates are indented with `indent`. Subclassed for each language."""
+
+    # Code added to the start of the file, followed by a directive that restores the
+    # line numbers of the file if it's not empty
+    prelude = ""
+    # Statements that can't be moved into a branch
+    unsplittable_pattern: re.Pattern
+    # Compilation errors, with the file path and line number as the first two groups
+    error_pattern: re.Pattern
+
+    def __init__(
+        self,
+        patch_applier: PatchApplier,
+        source_file_path: Path,
+        target_file_path: Path,
+        bug_line: int,
+        bug_len: int,
+        indent: str,
+    ):
+        self.patch_applier = patch_applier
+        self.source_file_path = source_file_path
+        self.target_file_path = target_file_path
+        self.indent = indent
+
+        self.source = patch_applier.load(source_file_path)
+        self.start, self.end, _ = get_replacement(bug_line, bug_len, "")
+        self.buggy_lines = self.source.text[
+            self.source.get_offset(self.start) : self.source.get_offset(self.end)
+        ]
+        if self.buggy_lines and not self.buggy_lines.endswith("\n"):
+            self.buggy_lines += "\n"
+        self.compatible = self.is_branch_compatible(self.buggy_lines)
+        # Whether the target file was overwritten since the schemata was compiled
+        self.stale = False
+
+    def get_condition(self, index: int) -> str:
+        raise NotImplementedError
+
+    def is_branch_compatible(self, text: str) -> bool:
+        code = get_top_level_code(text)
+        if code is None:
+            return False
+
+        code = code.strip()
+        if code and not code.endswith((";", "}")):
+            return False
+
+        statements = (s.strip() for s in re.split(r"[;{}]", code))
+        return not any(self.unsplittable_pattern.match(s) for s in statements)
+
+    def get_error_lines(self, output: str) -> list[int]:
+        """Lines of the compilation errors in the target file"""
+
+        target_file_path = self.target_file_path.as_posix()
+        return [
+            int(line)
+            for file_path, line, *_ in self.error_pattern.findall(output)
+            if target_file_path.endswith(Path(file_path).as_posix())
+        ]
+
+    def write(self, patches: dict[int, str]) -> dict[int, range]:
+        """Writes the schemata of `patches` to the target file and returns the lines
+        of each branch"""
+
+        lines = []
+        branch_lines = {}
+        for index, patch in patches.items():
+            condition = self.get_condition(index)
+            keyword = "if" if not lines else "} else if"
+            first_line = self.start + 1 + len(lines)
+            lines.append(f"{self.indent}{keyword} ({condition}) {{\n")
+            lines.extend(f"{self.indent}{line}\n" for line in patch.splitlines())
+            branch_lines[index] = range(first_line, self.start + 1 + len(lines))
+        if lines:
+            lines.append(
+                f"{self.indent}}} else {{\n{self.buggy_lines}{self.indent}}}\n"
+            )
+
+        text = self.source.render(
+            [Replacement(self.start, self.end, "".join(lines) or self.buggy_lines)]
+        )
+        self.patch_applier.write(self.prelude + text, self.target_file_path)
+        return branch_lines
+
+    def compile_branches(
+        self,
+        patches: dict[int, str],
+        compile_project: Callable[[], tuple[bool, str]],
+        max_compiles: int,
+    ) -> Optional[dict[int, str]]:
+        """Compiles the schemata of `patches`, dropping the branches with errors.
+        Returns the compiled patches, which are left in the target file, or `None` if
+        an error is outside the branches or `max_compiles` is reached."""
+
+        patches = dict(patches)
+        self.stale = False
+        for _ in range(max_compiles):
+            branch_lines = self.write(patches)
+            compiled, output = compile_project()
+            if compiled:
+                return patches
+
+            error_lines = self.get_error_lines(output)
+            failed = {
+                index
+                for index, lines in branch_lines.items()
+                if any(line in lines for line in error_lines)
+            }
+            if not failed or any(
+                not any(line in lines for lines in branch_lines.values())
+                for line in error_lines
+            ):
+                return None
+            for index in failed:
+                del patches[index]
+
+        return None
+
+    def compiles_alone(
+        self, patch: str, compile_project: Callable[[], tuple[bool, str]]
+    ) -> bool:
+        """Whether a candidate compiles when applied on its own, like a candidate
+        tested separately. The schemata is compiled again before the next candidate
+        is tested with it."""
+
+        self.stale = True
+        self.patch_applier.apply(
+            self.source_file_path,
+            self.target_file_path,
+            [Replacement(self.start, self.end, self.indent + patch + "\n")],
+        )
+        return compile_project()[0]
+
+    def iter_candidates(
+        self,
+        patches: dict[int, str],
+        compile_project: Callable[[], tuple[bool, str]],
+        group_size: int,
+        max_compiles: int,
+    ) -> Iterator[tuple[int, SchemataStatus]]:
+        """Yields the candidates in the order of `patches` with how to test them.
+        Candidates are compiled in groups of `group_size` when the loop reaches the
+        group, and the schemata is written and compiled again if a candidate was
+        tested separately or compiled alone in between."""
+
+        if not self.compatible:
+            for index in patches:
+                yield index, SchemataStatus.SEPARATE
+            return
+
+        items = list(patches.items())
+        for g in range(0, len(items), group_size):
+            group = items[g : g + group_size]
+            branches = {
+                index: patch
+                for index, patch in group
+                if self.is_branch_compatible(patch)
+            }
+            compiled = (
+                self.compile_branches(branches, compile_project, max_compiles)
+                if branches
+                else {}
+            )
+            if compiled is None:
+                for index, _ in group:
+                    yield index, SchemataStatus.SEPARATE
+                continue
+
+            # Separately tested candidates overwrite the schemata in the target file
+            rebuilt = True
+            for index, patch in group:
+                if index in compiled:
+                    if self.stale and rebuilt:
+                        self.write(compiled)
+                        rebuilt = compile_project()[0]
+                        self.stale = False
+                    if rebuilt:
+                        yield index, SchemataStatus.COMPILED
+                    else:
+                        yield index, SchemataStatus.SEPARATE
+                elif index in branches or not is_balanced(patch):
+                    # Branches with errors, and unbalanced candidates that unbalance
+                    # the whole file
+                    yield index, SchemataStatus.UNCOMPILABLE
+                else:
+                    self.stale = True
+                    yield index, SchemataStatus.SEPARATE
+
+
+class JavaSchemata(Schemata):
+    unsplittable_pattern = re.compile(
+        # Local variable declarations
+        r"(?:final\s+)?(?!(?:return|throw|new|else|assert|yield)\b)"
+        r"[A-Za-z_][\w.]*\s*(?:<[^;=]*>)?(?:\s*\[\s*\])*\s+[A-Za-z_]\w*\s*(?:[=,:\[]|$)"
+        # Labels and constructor calls
+        r"|case\b|default\s*:|(?:this|super)\s*\("
+    )
+    error_pattern = re.compile(r"(\S+\.java):(\d+): error")
+
+    def get_condition(self, index: int) -> str:
+        return f'"{index}".equals(System.getenv("{env_var}"))'
+
+
+class CSchemata(Schemata):
+    prelude = (
+        "#include <stdlib.h>\n"
+        "static int multimend_candidate(void) {"
+        f' static const char *c; static int read; if (!read) {{ c = getenv("{env_var}");'
+        " read = 1; } return c ? atoi(c) : -1; }\n"
+        "#line 1\n"
+    )
+    unsplittable_pattern = re.compile(
+        # Variable declarations
+        r"(?!(?:return|goto|else|case|sizeof)\b)"
+        r"(?:(?:const|static|volatile|register|unsigned|signed|long|short|struct|union"
+        r"|enum)\s+)*[A-Za-z_]\w*(?:\s*\*)*\s+\**\s*[A-Za-z_]\w*\s*(?:[=,\[]|$)"
+        # Labels and preprocessor directives
+        r"|case\b|default\s*:|#"
+    )
+    error_pattern = re.compile(r"(\S+\.c):(\d+):(\d+): error")
+
+    def get_condition(self, index: int) -> str:
+        return f"multimend_candidate() == {index}"
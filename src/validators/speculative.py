@@ -0,0 +1,77 @@
+"""Speculative validation of the candidates of a bug, in rank order.
+
+Up to `window` candidates from the next one to be committed are tested at once, each
+in its own workspace. Results are committed in rank order, and testing stops at the
+first committed result that ends the search (e.g., a plausible candidate): candidates
+that haven't started are cancelled, and the running ones are stopped through the event
+passed to their test, e.g., by giving it to `Sandbox.run` as `stop`, and their results
+are discarded. So the same candidates are committed as when testing them one after
+another, and at most `window - 1` extra test runs are started, each cut short. The
+results themselves may still differ where a test is close to its timeout, as the
+concurrent runs compete for the CPUs: callers should size `window` together with
+their other parallelism.
+"""
+
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Hashable, Iterable, TypeVar
+
+T = TypeVar("T")
+
+
+def run_in_rank_order(
+    indices: Iterable[Hashable],
+    test: Callable[[Hashable, int, threading.Event], T],
+    commit: Callable[[Hashable, T], bool],
+    window: int,
+) -> None:
+    """Calls `test(index, workspace, stopped)` for the candidates, where `workspace`
+    is in `range(window)` and isn't shared by concurrent calls, and
+    `commit(index, result)` in the calling thread in the order of `indices` until it
+    returns `True`. `test` should give up as soon as `stopped` is set, as its result
+    is discarded then, and may raise."""
+
+    stopped = threading.Event()
+    if window <= 1:
+        for index in indices:
+            if commit(index, test(index, 0, stopped)):
+                return
+        return
+
+    workspaces = queue.SimpleQueue()
+    for workspace in range(window):
+        workspaces.put(workspace)
+
+    def run(index: Hashable) -> T:
+        if stopped.is_set():
+            return None
+        workspace = workspaces.get()
+        try:
+            return test(index, workspace, stopped)
+        finally:
+            workspaces.put(workspace)
+
+    indices = iter(indices)
+    pending = deque()
+    with ThreadPoolExecutor(window) as executor:
+        try:
+            for index in indices:
+                pending.append((index, executor.submit(run, index)))
+                if len(pending) == window:
+                    break
+
+            while pending:
+                index, future = pending.popleft()
+                if commit(index, future.result()):
+                    return
+
+                for next_index in indices:
+                    pending.append((next_index, executor.submit(run, next_index)))
+                    break
+        finally:
+            # Running tests are stopped, and the executor waits for them to exit
+            stopped.set()
+            for _, future in pending:
+                future.cancel()
@@ -0,0 +1,182 @@
+"""SQLite-backed validation state shared by the validator processes"""
+
+import json
+import os
+import sqlite3
+from pathlib import Path
+from typing import Hashable, Iterator, Optional
+
+import pandas as pd
+
+from ..columnar import get_temp_path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS candidates (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    bugid TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    idx TEXT NOT NULL,
+    tested INTEGER NOT NULL DEFAULT 0,
+    plausible INTEGER NOT NULL DEFAULT 0,
+    record TEXT NOT NULL,
+    UNIQUE (bugid, phase, idx)
+);
+CREATE INDEX IF NOT EXISTS candidates_bugid_seq ON candidates (bugid, seq);
+CREATE TABLE IF NOT EXISTS bugs (
+    bugid TEXT PRIMARY KEY,
+    done INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS searches (
+    bugid TEXT NOT NULL,
+    strategy TEXT NOT NULL,
+    test_runs INTEGER NOT NULL,
+    runs_to_plausible INTEGER,
+    PRIMARY KEY (bugid, strategy)
+);
+"""
+
+
+class StateStore:
+    """Records the validation result of each candidate as soon as it is known.
+
+    Candidates are keyed by `(bugid, phase, idx)`, where `phase` names the
+    validation loop and `idx` is the candidate's index in that loop's DataFrame.
+    Each record is the candidate's row serialized to JSON, and records keep
+    their insertion order for the export.
+    """
+
+    def __init__(self, db_path: Path, timeout: float = 60, shared: bool = False):
+        self.connection = sqlite3.connect(db_path, timeout=timeout)
+        # WAL needs memory shared by all the connections, so processes on other
+        # hosts need the rollback journal
+        self.connection.execute(f"PRAGMA journal_mode={'DELETE' if shared else 'WAL'}")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self) -> "StateStore":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def is_done(self, bugid: str) -> bool:
+        row = self.connection.execute(
+            "SELECT done FROM bugs WHERE bugid = ?", (bugid,)
+        ).fetchone()
+        return bool(row and row[0])
+
+    def mark_done(self, bugid: str) -> None:
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO bugs (bugid, done) VALUES (?, 1) "
+                "ON CONFLICT (bugid) DO UPDATE SET done = 1",
+                (bugid,),
+            )
+
+    def add_candidates(self, bugid: str, phase: str, df: pd.DataFrame) -> None:
+        """Adds the untested candidates of a phase, keeping already stored ones"""
+
+        if df.empty:
+            return
+
+        records = df.to_json(orient="records", lines=True).rstrip("\n").split("\n")
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO candidates (bugid, phase, idx, record) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (bugid, phase, str(idx), record)
+                    for idx, record in zip(df.index, records)
+                ],
+            )
+
+    def save_candidate(
+        self, bugid: str, phase: str, idx: Hashable, row: pd.Series
+    ) -> None:
+        """Stores a tested candidate and commits it immediately"""
+
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO candidates (bugid, phase, idx, tested, plausible, record) "
+                "VALUES (?, ?, ?, 1, ?, ?) "
+                "ON CONFLICT (bugid, phase, idx) DO UPDATE SET "
+                "tested = 1, plausible = excluded.plausible, record = excluded.record",
+                (bugid, phase, str(idx), bool(row["plausible"]), row.to_json()),
+            )
+
+    def tested_indices(self, bugid: str, phase: str) -> set[str]:
+        """Returns the (stringified) indices of the already tested candidates"""
+
+        return {
+            idx
+            for (idx,) in self.connection.execute(
+                "SELECT idx FROM candidates WHERE bugid = ? AND phase = ? AND tested",
+                (bugid, phase),
+            )
+        }
+
+    def has_plausible(self, bugid: str, phase: str) -> bool:
+        row = self.connection.execute(
+            "SELECT 1 FROM candidates WHERE bugid = ? AND phase = ? AND plausible",
+            (bugid, phase),
+        ).fetchone()
+        return row is not None
+
+    def clear_phase(self, bugid: str, phase: str) -> None:
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM candidates WHERE bugid = ? AND phase = ?", (bugid, phase)
+            )
+
+    def save_search_stats(
+        self,
+        bugid: str,
+        strategy: str,
+        test_runs: int,
+        runs_to_plausible: Optional[int],
+    ) -> None:
+        """Stores the test runs spent by a multi-hunk search"""
+
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO searches "
+                "(bugid, strategy, test_runs, runs_to_plausible) VALUES (?, ?, ?, ?)",
+                (bugid, strategy, test_runs, runs_to_plausible),
+            )
+
+    def get_search_stats(self) -> pd.DataFrame:
+        return pd.read_sql_query(
+            "SELECT * FROM searches ORDER BY bugid, strategy", self.connection
+        )
+
+    def export_jsonl(self, file_path: Path) -> None:
+        """Streams all the stored candidates to a JSON Lines file, grouped by bug"""
+
+        temp_file_path = get_temp_path(file_path)
+        with open(temp_file_path, "w") as file:
+            for (record,) in self.connection.execute(
+                "SELECT record FROM candidates ORDER BY bugid, seq"
+            ):
+                file.write(record + "\n")
+        os.replace(temp_file_path, file_path)
+
+    def iter_records(self) -> Iterator[dict]:
+        """Yields all the stored candidates in the export order"""
+
+        for (record,) in self.connection.execute(
+            "SELECT record FROM candidates ORDER BY bugid, seq"
+        ):
+            yield json.loads(record)
+
+    def get_plausible_bugs(self) -> pd.Series:
+        """Returns whether each bug has a plausible candidate"""
+
+        plausible_bugs = pd.read_sql_query(
+            "SELECT bugid, MAX(plausible) AS plausible FROM candidates GROUP BY bugid",
+            self.connection,
+            index_col="bugid",
+        )["plausible"]
+        return plausible_bugs.astype(bool)
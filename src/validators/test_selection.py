@@ -0,0 +1,99 @@
+"""Selection of the tests that cover the patched code of a bug.
+
+The coverage of each test on the buggy version is measured once per bug and stored
+in `<coverage_dir>/<bugid>.json`, as the line ranges of the methods the test executes
+in each source file. Candidates run the tests that execute a method overlapping
+their hunks before the full suite, which catches most failing candidates sooner.
+The full suite still runs for the candidates that pass them, so selection changes
+how soon a candidate fails, not whether it's plausible.
+"""
+
+import json
+import os
+import threading
+import xml.etree.ElementTree as ET
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+# Source file path -> `[first, last]` line ranges of the executed methods
+MethodCoverage = dict[str, list[list[int]]]
+
+
+def parse_cobertura_methods(report_path: Path) -> MethodCoverage:
+    """Line ranges of the methods with an executed line in a Cobertura report"""
+
+    coverage = defaultdict(list)
+    for class_element in ET.parse(report_path).getroot().iter("class"):
+        for method in class_element.iter("method"):
+            lines = [
+                (int(line.get("number")), int(line.get("hits")))
+                for line in method.iter("line")
+            ]
+            if any(hits > 0 for _, hits in lines):
+                numbers = [number for number, _ in lines]
+                coverage[class_element.get("filename")].append(
+                    [min(numbers), max(numbers)]
+                )
+
+    return dict(coverage)
+
+
+def get_coverage(
+    coverage_dir: Path,
+    bugid: str,
+    tests: list[str],
+    measure: Callable[[str], Optional[MethodCoverage]],
+) -> dict[str, Optional[MethodCoverage]]:
+    """Returns the stored coverage of the tests of a bug, measuring and storing it on
+    first use. A test whose coverage couldn't be measured maps to `None`."""
+
+    coverage_file_path = coverage_dir / f"{bugid}.json"
+    if coverage_file_path.exists():
+        with open(coverage_file_path) as file:
+            return json.load(file)["coverage"]
+
+    coverage = {test: measure(test) for test in tests}
+
+    # Write to a temporary file first, so concurrent readers never see a partial file
+    coverage_dir.mkdir(parents=True, exist_ok=True)
+    temp_file_path = coverage_file_path.with_suffix(
+        f".{os.getpid()}-{threading.get_ident()}.tmp"
+    )
+    with open(temp_file_path, "w") as file:
+        json.dump({"bugid": bugid, "coverage": coverage}, file)
+    os.replace(temp_file_path, coverage_file_path)
+
+    return coverage
+
+
+def is_same_file(source_path: str, report_path: str) -> bool:
+    """Whether a path relative to the project is a path relative to a source root"""
+
+    return source_path == report_path or source_path.endswith(f"/{report_path}")
+
+
+def select_tests(
+    coverage: dict[str, Optional[MethodCoverage]],
+    hunks: Iterable[tuple[str, int, int]],
+) -> list[str]:
+    """Tests that execute a method overlapping any of the `(source_path, bug_line,
+    bug_len)` hunks, or whose coverage is unknown"""
+
+    hunks = [
+        (source_path, bug_line, bug_line + max(bug_len, 1) - 1)
+        for source_path, bug_line, bug_len in hunks
+    ]
+
+    return [
+        test
+        for test, methods in coverage.items()
+        if methods is None
+        or any(
+            first <= hunk_last and hunk_first <= last
+            for report_path, ranges in methods.items()
+            for source_path, hunk_first, hunk_last in hunks
+            if is_same_file(source_path, report_path)
+            for first, last in ranges
+        )
+    ]
@@ -0,0 +1,244 @@
+"""Test classes of a Java project run in parallel JVMs.
+
+The classes are split into shards balanced by their runtimes in earlier runs, with
+the longest classes placed first, each on the shard with the least work so far.
+Each shard is a JVM that runs its classes one after another with JUnit and reports
+each class's runtime and failing test count on a line of its stdout. Output of the
+tests themselves goes to stderr, so it can't be mistaken for a report.
+"""
+
+import hashlib
+import heapq
+import json
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from .sandbox import Sandbox
+
+runner_class = "MultiMendShardRunner"
+report_prefix = "MULTIMEND_CLASS"
+
+runner_source = r"""
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.PrintStream;
+import org.junit.runner.JUnitCore;
+import org.junit.runner.Result;
+
+public class MultiMendShardRunner {
+    public static void main(String[] args) {
+        PrintStream reports = new PrintStream(new FileOutputStream(FileDescriptor.out));
+        System.setOut(new PrintStream(new FileOutputStream(FileDescriptor.err)));
+
+        JUnitCore core = new JUnitCore();
+        for (String name : args) {
+            long start = System.nanoTime();
+            int failures;
+            try {
+                Result result = core.run(Class.forName(
+                    name, false, MultiMendShardRunner.class.getClassLoader()));
+                failures = result.getFailureCount();
+            } catch (Throwable e) {
+                failures = 1;
+            }
+            reports.printf("MULTIMEND_CLASS\t%s\t%.3f\t%d%n",
+                name, (System.nanoTime() - start) / 1e9, failures);
+            reports.flush();
+        }
+        // Non-daemon threads left by the tests don't keep the JVM alive
+        System.exit(0);
+    }
+}
+"""
+
+_build_lock = threading.Lock()
+
+
+def build_shard_runner(build_dir: Path, junit_jar_path: Path) -> Path:
+    """Compiles the runner once per version of its source, returning its class
+    directory"""
+
+    digest = hashlib.sha256(runner_source.encode()).hexdigest()[:16]
+    runner_dir = build_dir / f"shard-runner-{digest}"
+
+    with _build_lock:
+        if runner_dir.exists():
+            return runner_dir
+
+        # Built in a temporary directory, so other processes never load a partial one
+        temp_dir = build_dir / f"shard-runner-{digest}.{os.getpid()}.tmp"
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        temp_dir.mkdir(parents=True)
+        source_path = temp_dir / f"{runner_class}.java"
+        source_path.write_text(runner_source)
+        subprocess.run(
+            [
+                "javac",
+                "-cp",
+                str(junit_jar_path),
+                "-d",
+                str(temp_dir),
+                str(source_path),
+            ],
+            capture_output=True,
+            check=True,
+        )
+        source_path.unlink()
+        try:
+            temp_dir.rename(runner_dir)
+        except OSError:
+            # Built by another process meanwhile
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return runner_dir
+
+
+def get_shards(
+    test_classes: list[str], runtimes: dict[str, float], num_shards: int
+) -> list[list[str]]:
+    """Longest-processing-time-first split of the classes. Classes without a runtime
+    are assumed to take the mean runtime of the others."""
+
+    default_runtime = sum(runtimes.values()) / len(runtimes) if runtimes else 1.0
+    loads = [(0.0, shard) for shard in range(num_shards)]
+    shards = [[] for _ in range(num_shards)]
+    for test_class in sorted(
+        test_classes, key=lambda c: runtimes.get(c, default_runtime), reverse=True
+    ):
+        load, shard = heapq.heappop(loads)
+        shards[shard].append(test_class)
+        heapq.heappush(loads, (load + runtimes.get(test_class, default_runtime), shard))
+
+    return [shard for shard in shards if shard]
+
+
+class ShardsResult(NamedTuple):
+    # Failing tests of the classes that ran, `None` if a shard crashed
+    failed_count: Optional[int]
+    timed_out: bool
+
+
+def read_reports(process: subprocess.Popen, events: queue.SimpleQueue) -> None:
+    """Puts `(class, runtime, failures)` for each report line of a shard, then its
+    exit code"""
+
+    for line in process.stdout:
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) == 4 and fields[0] == report_prefix:
+            events.put((fields[1], float(fields[2]), int(fields[3])))
+    events.put(process.wait())
+
+
+class TestShards:
+    """Runs `test_classes` in `num_shards` JVMs with `classpath`, keeping the class
+    runtimes of the runs in `runtimes_file_path` to balance the next ones. The JVMs
+    get the rlimits of `sandbox`, and a run raises `LimitExceeded` if one of them
+    exceeds a limit."""
+
+    def __init__(
+        self,
+        runner_dir: Path,
+        classpath: list[str],
+        test_classes: list[str],
+        runtimes_file_path: Path,
+        num_shards: int,
+        sandbox: Optional[Sandbox] = None,
+    ):
+        self.runner_dir = runner_dir
+        self.classpath = classpath
+        self.test_classes = test_classes
+        self.runtimes_file_path = runtimes_file_path
+        self.num_shards = num_shards
+        self.sandbox = sandbox
+
+        self.runtimes: dict[str, float] = {}
+        if runtimes_file_path.exists():
+            with open(runtimes_file_path) as file:
+                self.runtimes = json.load(file)["runtimes"]
+
+    def save_runtimes(self) -> None:
+        # Write to a temporary file first, so readers never see a partial file
+        self.runtimes_file_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_file_path = self.runtimes_file_path.with_suffix(
+            f".{os.getpid()}-{threading.get_ident()}.tmp"
+        )
+        with open(temp_file_path, "w") as file:
+            json.dump({"runtimes": self.runtimes}, file)
+        os.replace(temp_file_path, self.runtimes_file_path)
+
+    def run(
+        self,
+        project_dir: Path,
+        timeout: float,
+        env: Optional[dict] = None,
+        stop_on_failure: bool = False,
+    ) -> ShardsResult:
+        """Runs the classes from `project_dir`, killing all shards at `timeout`
+        seconds, or when a class fails if `stop_on_failure`"""
+
+        classpath = os.pathsep.join([str(self.runner_dir), *self.classpath])
+        events = queue.SimpleQueue()
+        processes = []
+        deadline = time.monotonic() + timeout
+        failed_count = 0
+        reported = 0
+        exited = 0
+        crashed = timed_out = False
+        try:
+            for shard in get_shards(self.test_classes, self.runtimes, self.num_shards):
+                process = subprocess.Popen(
+                    ["java", "-cp", classpath, runner_class, *shard],
+                    cwd=project_dir,
+                    env=env,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                    text=True,
+                    preexec_fn=None
+                    if self.sandbox is None
+                    else self.sandbox.get_preexec_fn(),
+                )
+                processes.append(process)
+                threading.Thread(
+                    target=read_reports, args=(process, events), daemon=True
+                ).start()
+
+            while exited < len(processes):
+                try:
+                    event = events.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    timed_out = True
+                    break
+
+                if isinstance(event, int):
+                    if self.sandbox is not None:
+                        self.sandbox.check(event)
+                    exited += 1
+                    crashed |= event != 0
+                    continue
+
+                test_class, runtime, failures = event
+                self.runtimes[test_class] = runtime
+                failed_count += failures
+                reported += 1
+                if failures and stop_on_failure:
+                    break
+        finally:
+            for process in processes:
+                if process.poll() is None:
+                    process.kill()
+            for process in processes:
+                process.wait()
+
+        self.save_runtimes()
+
+        # Classes left unreported by a shard that exited mean a test ended the JVM
+        if exited == len(processes) and reported < len(self.test_classes):
+            crashed = True
+        return ShardsResult(None if crashed else failed_count, timed_out)
@@ -1,16 +1,13 @@
 import configparser
 import contextlib
 import itertools
-import json
 import os
 import re
 import shutil
 import subprocess
-import sys
 import textwrap
 import timeit
-from collections import ChainMap, defaultdict
-from copy import deepcopy
+from collections import defaultdict
 from enum import Enum, auto
 from pathlib import Path
 from typing import Optional
@@ -21,19 +18,83 @@ import pandas as pd
 from joblib import Parallel, delayed
 from tqdm import tqdm
 
+from ..columnar import (
+    CandidateSlice,
+    read_candidates,
+    read_hunks,
+    write_candidate_slices,
+    write_plausible_candidates,
+)
 from ..configs import (
     bugsinpy_bin_dir,
     bugsinpy_gen_dir,
     bugsinpy_tmp_dir,
 )
-from .check_python_syntax import get_valid_python
+from .adaptive_timeout import get_reference_runtime, get_timeout
+from .check_python_syntax import check_parsable_files, get_valid_python
+from .multi_hunk_search import (
+    MultiHunkSearch,
+    TestResult,
+    Trial,
+    get_candidates,
+    get_source_candidate,
+    get_trial_record,
+    summarize_search_stats,
+)
+from .patch_applier import PatchApplier, Replacement, get_replacement
+from .sandbox import LimitExceeded, Limits, Sandbox
+from .state_store import StateStore
+from .work_queue import WorkQueue, run_worker
 
 gen_dir = bugsinpy_gen_dir
-bugs_metadata_file = "BugsInPy.jsonl"
+bugs_metadata_file = "BugsInPy.parquet"
 model = "multimend"
 output_dir = gen_dir / f"outputs-{model}"
-save_state_dir = output_dir / "save-state"
+state_db_path = output_dir / "validation-state.db"
+# With `use_work_queue`, runs of this script on any number of hosts sharing
+# `output_dir` validate the bugs together, each of their `n_jobs` processes leasing
+# bugs from the queue at `work_queue_path` (see `work_queue`)
+use_work_queue = False
+work_queue_path = output_dir / "work-queue.db"
+reference_runtimes_dir = gen_dir / "reference-runtimes"
 output_size = 100
+# Candidates are validated in the order of `combine_checkpoints_results` ("final"), or
+# in the order of `rerank_candidates` ("reranked"), once it has run for this dataset
+candidates_order = "final"
+candidates_file_path = output_dir / f"candidates_{output_size}.arrow"
+# Candidates that make the buggy file unparsable when applied at their hunk are
+# dropped before their bug is tested. Hunks are judged in place, as they are often
+# fragments of larger statements that aren't valid on their own. Their results are
+# cached in `validity_cache_path` across runs.
+drop_unparsable_candidates = True
+validity_cache_path = gen_dir / "file-validity.db"
+# Encodings to read the buggy source files with, and to write patched files
+# with when the previous one fails
+source_encodings = ("cp1256", "utf-8")
+
+# Candidates are killed at `timeout_factor` times the tests runtime of the buggy
+# version, clamped to [`timeout_floor`, `timeout_ceiling`] seconds
+timeout_factor = 5
+timeout_floor = 10
+timeout_ceiling = 120
+
+# `bugsinpy-test` runs with these limits, also applied to the whole process tree
+# when a cgroup is available (see `sandbox`)
+sandbox = Sandbox(
+    Limits(
+        memory_bytes=4 << 30,
+        cpu_seconds=2 * timeout_ceiling,
+        max_processes=256,
+        output_bytes=1 << 30,
+    )
+)
+
+# Search over combinations of hunk candidates for multi-hunk bugs: "greedy",
+# "beam" or "delta" (see `multi_hunk_search`), stopped after `multi_hunk_test_budget`
+# test runs per bug
+multi_hunk_strategy = "greedy"
+multi_hunk_test_budget = 2000
+multi_hunk_beam_width = 10
 
 rem_file_path = gen_dir / "rem.txt"
 add_file_path = gen_dir / "add.txt"
@@ -70,34 +131,12 @@ def get_hunk_candidates(df: pd.DataFrame, hunk: int) -> pd.DataFrame:
     return df.loc[df["hunk"] == hunk]
 
 
-def get_candidates(df: pd.DataFrame, bugid: str) -> pd.DataFrame:
-    """Returns the subset of `df` containing candidate patches for a specific bugid and all its hunks"""
-    return df.loc[df["bugid"] == bugid]
-
-
-def insert_patch(patch, source_file_path, target_file_path, bug_line, bug_len, indent):
-    with open(source_file_path, encoding="cp1256") as file:
-        lines = file.readlines()
-    if bug_len == 0:
-        lines.insert(bug_line, textwrap.indent(patch, indent) + "\n")
-    else:
-        lines[bug_line - 1 : (bug_line - 1) + bug_len] = (
-            textwrap.indent(patch, indent) + "\n"
-        )
-
-    try:
-        with open(target_file_path, "w", encoding="cp1256") as file:
-            file.writelines(lines)
-    except UnicodeEncodeError:
-        with open(target_file_path, "w", encoding="utf-8") as file:
-            file.writelines(lines)
-
-
 class Status(Enum):
     PLAUSIBLE = auto()
     COMPILABLE = auto()
     TIMEOUT = auto()
     UNCOMPILABLE = auto()
+    RESOURCE_LIMIT = auto()
 
 
 def parse_test_output(output: str) -> int | None:
@@ -152,7 +191,7 @@ def run_tests(
 ) -> subprocess.CompletedProcess[str]:
     work_dir /= project_name
     cmd = [bugsinpy_bin_dir / "bugsinpy-test", "-w", work_dir]
-    result = subprocess.run(
+    result = sandbox.run(
         cmd,
         text=True,
         timeout=timeout,
@@ -162,13 +201,15 @@ def run_tests(
     return result
 
 
-def run_tests_for_multi(bugid: str, project_dir: Path) -> tuple[Status, int | None]:
-    timeout = 120  # seconds
-
+def run_tests_for_multi(
+    bugid: str, project_dir: Path, timeout: float
+) -> tuple[Status, int | None]:
     try:
         result = run_tests(bugid.split()[0], project_dir, timeout=timeout)
     except subprocess.TimeoutExpired:
         return Status.TIMEOUT, None
+    except LimitExceeded:
+        return Status.RESOURCE_LIMIT, None
 
     failed_tests = parse_test_output(result.stdout)
 
@@ -180,12 +221,122 @@ def run_tests_for_multi(bugid: str, project_dir: Path) -> tuple[Status, int | No
         return Status.COMPILABLE, failed_tests
 
 
-def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.DataFrame]:
-    # Load if already processed
-    save_file_path = save_state_dir / f"{bugid}.jsonl"
-    if save_file_path.exists():
-        return
+def get_test_result(
+    status: Status,
+    failed_count: Optional[int],
+    validation_time: float,
+    timeout: float,
+) -> TestResult:
+    return TestResult(
+        status is Status.PLAUSIBLE,
+        failed_count,
+        {
+            "plausible": status is Status.PLAUSIBLE,
+            "compilable": status is not Status.UNCOMPILABLE,
+            "timeout": status is Status.TIMEOUT,
+            "timeout_limit": timeout if status is Status.TIMEOUT else np.nan,
+            "resource_limit": status is Status.RESOURCE_LIMIT,
+            "validation_time": validation_time,
+        },
+    )
+
+
+def measure_reference_runtime(bugid: str, project_dir: Path) -> Optional[float]:
+    """Times the tests of the unpatched buggy version, `None` if they time out"""
+
+    start_timer = timeit.default_timer()
+    try:
+        run_tests(bugid.split()[0], project_dir, timeout=timeout_ceiling)
+    except (subprocess.TimeoutExpired, LimitExceeded):
+        return None
+    end_timer = timeit.default_timer()
+
+    return end_timer - start_timer
+
+
+def get_bug_timeout(bugid: str, project_dir: Path) -> float:
+    """Returns the timeout of candidate test runs based on the bug's reference runtime"""
+
+    reference_runtime = get_reference_runtime(
+        reference_runtimes_dir,
+        bugid,
+        lambda: measure_reference_runtime(bugid, project_dir),
+    )
+    return get_timeout(
+        reference_runtime, timeout_factor, timeout_floor, timeout_ceiling
+    )
+
+
+def get_hunk_replacement(hunk: dict, patch: str) -> Replacement:
+    """Replaces the buggy lines of a hunk with a reformatted patch, indented like the
+    added lines of the hunk"""
+
+    indent_hunk = "\n".join(
+        [line for line in hunk["added_lines"].splitlines() if line.strip()]
+    )
+    indent_size = len(indent_hunk) - len(indent_hunk.lstrip(" \t"))
+    indent = indent_hunk[:indent_size]
+
+    bug_line, bug_len = hunk["removed_line_numbers_range"]
+    return get_replacement(
+        bug_line, bug_len, textwrap.indent(get_valid_python(patch), indent) + "\n"
+    )
 
+
+def drop_unparsable(
+    cp_df: pd.DataFrame, bugid: str, hunks: list, patch_applier: PatchApplier
+) -> pd.DataFrame:
+    """Drops the candidates that make their buggy file unparsable when applied at
+    their hunk, with the other hunks left buggy. The hunks of files that don't parse
+    before patching (e.g., with syntax this Python version dropped) are kept."""
+
+    is_parsable = pd.Series(True, index=cp_df.index)
+    for i, hunk in enumerate(hunks):
+        source_file_path = bugsinpy_tmp_dir / "sources" / bugid / hunk["source_path"]
+        source_text = patch_applier.load(source_file_path).text
+        if not check_parsable_files([source_text], validity_cache_path)[0]:
+            continue
+
+        patches = cp_df.loc[cp_df["hunk"] == i, "decoded_sequences"]
+        is_parsable[patches.index] = check_parsable_files(
+            [
+                patch_applier.render(
+                    source_file_path, [get_hunk_replacement(hunk, patch)]
+                )
+                for patch in patches
+            ],
+            validity_cache_path,
+        )
+
+    return cp_df[is_parsable]
+
+
+def apply_patch(
+    candidates: CandidateSlice, bugid: str, hunks: list
+) -> Optional[pd.DataFrame]:
+    with StateStore(state_db_path, shared=use_work_queue) as state_store:
+        # Skip if already processed
+        if state_store.is_done(bugid):
+            return
+
+        validate_candidates(candidates.load(), bugid, hunks, state_store)
+        state_store.mark_done(bugid)
+
+
+def validate_queued_bugs(candidate_slices: dict, bugs_metadata: dict) -> None:
+    """Validates the bugs leased from the work queue until all are validated"""
+
+    run_worker(
+        work_queue_path,
+        lambda bugid: apply_patch(candidate_slices[bugid], bugid, bugs_metadata[bugid]),
+    )
+
+
+def validate_candidates(
+    cp_df: pd.DataFrame, bugid: str, hunks: list, state_store: StateStore
+) -> None:
+    # Buggy source files are read once per bug
+    patch_applier = PatchApplier(source_encodings)
     project_name, bug_number = bugid.split()
 
     # Checkout the buggy version
@@ -193,6 +344,20 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
     checkout_source(project_name, bug_number, True, checkout_dir)
     compile_project(project_name, checkout_dir)
     fix_environment(project_name, checkout_dir)
+    timeout = get_bug_timeout(bugid, checkout_dir)
+
+    # Copy initial files to a temp directory
+    for hunk in hunks:
+        target_file_path = checkout_dir / hunk["source_path"]
+        source_file_path = bugsinpy_tmp_dir / "sources" / bugid / hunk["source_path"]
+        source_file_path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(target_file_path, source_file_path)
+
+    # The template of the multi-hunk search needs a candidate of every hunk, even
+    # when all candidates of one are dropped
+    all_cp_df = cp_df
+    if drop_unparsable_candidates:
+        cp_df = drop_unparsable(cp_df, bugid, hunks, patch_applier)
 
     if len(hunks) == 1:
         hunk = hunks[0]
@@ -200,42 +365,42 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
         cp_df = bug_hunk_subset_df.copy()
 
         target_file_path = checkout_dir / hunk["source_path"]
-        bug_line, bug_len = hunk["removed_line_numbers_range"]
-
-        # Copy initial file to a temp directory
         source_file_path = bugsinpy_tmp_dir / "sources" / bugid / hunk["source_path"]
-        source_file_path.parent.mkdir(parents=True, exist_ok=True)
-        shutil.copyfile(target_file_path, source_file_path)
 
-        indent_hunk = "\n".join(
-            [line for line in hunk["added_lines"].splitlines() if line.strip()]
-        )
-        indent_size = len(indent_hunk) - len(indent_hunk.lstrip(" \t"))
-        indent = indent_hunk[:indent_size]
+        state_store.add_candidates(bugid, "single", cp_df)
+        if state_store.has_plausible(bugid, "single"):
+            return
+        tested = state_store.tested_indices(bugid, "single")
 
         for index, patch in bug_hunk_subset_df["decoded_sequences"].items():
-            patch = get_valid_python(patch)
+            if str(index) in tested:
+                continue
 
-            insert_patch(
-                patch, source_file_path, target_file_path, bug_line, bug_len, indent
+            patch_applier.apply(
+                source_file_path, target_file_path, [get_hunk_replacement(hunk, patch)]
             )
 
             start_timer = timeit.default_timer()
-            status, failed_count = run_tests_for_multi(bugid, checkout_dir)
+            status, failed_count = run_tests_for_multi(bugid, checkout_dir, timeout)
             end_timer = timeit.default_timer()
             cp_df.at[index, "validation_time"] = end_timer - start_timer
 
             if status is Status.PLAUSIBLE:
                 cp_df.at[index, "plausible"] = True
                 cp_df.at[index, "compilable"] = True
-                break
             elif status is Status.COMPILABLE:
                 cp_df.at[index, "compilable"] = True
             elif status is Status.TIMEOUT:
                 cp_df.at[index, "timeout"] = True
+                cp_df.at[index, "timeout_limit"] = timeout
+                cp_df.at[index, "compilable"] = True
+            elif status is Status.RESOURCE_LIMIT:
+                cp_df.at[index, "resource_limit"] = True
                 cp_df.at[index, "compilable"] = True
 
-        cp_df.to_json(save_state_dir / f"{bugid}.jsonl", orient="records", lines=True)
+            state_store.save_candidate(bugid, "single", index, cp_df.loc[index])
+            if cp_df.at[index, "plausible"]:
+                break
 
     else:
         agg_mapping = {
@@ -248,6 +413,8 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
                 "plausible",
                 "compilable",
                 "timeout",
+                "timeout_limit",
+                "resource_limit",
                 "validation_time",
             ]
             else list
@@ -262,68 +429,57 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
             by=["rank", "sequences_scores"], ascending=[True, False], inplace=True
         )
 
-        for hunk in hunks:
-            target_file_path = checkout_dir / hunk["source_path"]
-            source_file_path = (
-                bugsinpy_tmp_dir / "sources" / bugid / hunk["source_path"]
-            )
-            source_file_path.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copyfile(target_file_path, source_file_path)
+        state_store.add_candidates(bugid, "combined", new_cp_df)
+        if state_store.has_plausible(bugid, "combined"):
+            return
+        tested = state_store.tested_indices(bugid, "combined")
 
         # Loop to iterate on dataframe rows
         for index, patches in new_cp_df["decoded_sequences"].items():
-            bugs_lens = defaultdict(list)
-            # Loop to apply patches to each hunk
-            for hunk_num, (hunk, patch) in enumerate(
-                reversed(list(zip(hunks, patches)))
-            ):
-                patch = get_valid_python(patch)
+            if str(index) in tested:
+                continue
 
+            hunk_replacements = []
+            # Loop to apply patches to each hunk
+            for hunk, patch in zip(hunks, patches):
                 target_file_path = checkout_dir / hunk["source_path"]
-                bug_line, bug_len = hunk["removed_line_numbers_range"]
                 source_file_path = (
                     bugsinpy_tmp_dir / "sources" / bugid / hunk["source_path"]
                 )
-
-                indent_hunk = "\n".join(
-                    [line for line in hunk["added_lines"].splitlines() if line.strip()]
-                )
-                indent_size = len(indent_hunk) - len(indent_hunk.lstrip(" \t"))
-                indent = indent_hunk[:indent_size]
-
-                insert_patch(
-                    patch,
-                    target_file_path
-                    if target_file_path in bugs_lens
-                    else source_file_path,
-                    target_file_path,
-                    bug_line,
-                    bug_len,
-                    indent,
+                hunk_replacements.append(
+                    (
+                        source_file_path,
+                        target_file_path,
+                        get_hunk_replacement(hunk, patch),
+                    )
                 )
 
-                bugs_lens[target_file_path].append(bug_len)
+            patch_applier.apply_hunks(hunk_replacements)
 
             # call the testing infrastructure
             start_timer = timeit.default_timer()
-            status, failed_count = run_tests_for_multi(bugid, checkout_dir)
+            status, failed_count = run_tests_for_multi(bugid, checkout_dir, timeout)
             end_timer = timeit.default_timer()
             new_cp_df.at[index, "validation_time"] = end_timer - start_timer
 
             if status is Status.PLAUSIBLE:
                 new_cp_df.at[index, "plausible"] = True
                 new_cp_df.at[index, "compilable"] = True
-                break
             elif status is Status.COMPILABLE:
                 new_cp_df.at[index, "compilable"] = True
             elif status is Status.TIMEOUT:
                 new_cp_df.at[index, "timeout"] = True
+                new_cp_df.at[index, "timeout_limit"] = timeout
+                new_cp_df.at[index, "compilable"] = True
+            elif status is Status.RESOURCE_LIMIT:
+                new_cp_df.at[index, "resource_limit"] = True
                 new_cp_df.at[index, "compilable"] = True
 
-        if not new_cp_df.empty and new_cp_df["plausible"].any():
-            new_cp_df.to_json(
-                save_state_dir / f"{bugid}.jsonl", orient="records", lines=True
-            )
+            state_store.save_candidate(bugid, "combined", index, new_cp_df.loc[index])
+            if new_cp_df.at[index, "plausible"]:
+                break
+
+        if state_store.has_plausible(bugid, "combined"):
             return
 
         ###################################################################
@@ -335,6 +491,8 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
                 "plausible",
                 "compilable",
                 "timeout",
+                "timeout_limit",
+                "resource_limit",
                 "validation_time",
             ]:
                 agg_mapping[col] = "first"
@@ -350,7 +508,7 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
             elif col != "bugid":
                 agg_mapping[col] = list  # lambda x: list(x.unique())
 
-        template_df = cp_df.groupby("hunk").agg("first").reset_index()
+        template_df = all_cp_df.groupby("hunk").agg("first").reset_index()
         template_df = template_df.groupby("bugid").agg(agg_mapping).reset_index()
         assert (
             template_df["source"].apply(len).item()
@@ -366,132 +524,70 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
             )
             shutil.copyfile(source_file_path, target_file_path)
 
-        # List to store extracted multi-hunk patches
-        multi_patches_list = []
-
-        # Compute the number of initial failing tests
-        _, running_failed_count = run_tests_for_multi(bugid, checkout_dir)
-        if not running_failed_count:
-            running_failed_count = sys.maxsize
-
-        running_plausible_df = None
-
+        hunk_candidates = []
+        source_candidates = []
         for i in range(len(hunks)):
-            if running_failed_count == 0:
-                break
-            hunk_cp_df = get_hunk_candidates(cp_df, i)
-
-            for row in hunk_cp_df.itertuples():
-                if i == 0:
-                    row_df = pd.DataFrame(
-                        columns=template_df.columns, data=deepcopy(template_df.values)
-                    )
-                else:
-                    row_df = pd.DataFrame(
-                        columns=running_plausible_df.columns,
-                        data=deepcopy(running_plausible_df.values),
-                    )
+            hunk_candidates.append(get_candidates(get_hunk_candidates(cp_df, i)))
+            source_candidates.append(
+                get_source_candidate(
+                    template_df.at[0, "source"][i],
+                    template_df.at[0, "normalized_source"][i],
+                )
+            )
 
-                row_df.at[0, "checkpoint"].append(row.checkpoint)
-                row_df.at[0, "decoded_sequences"].append(row.decoded_sequences)
-                row_df.at[0, "normalized_patch"].append(row.normalized_patch)
-                row_df.at[0, "sequences_scores"].append(row.sequences_scores)
-                row_df.at[0, "rank"].append(row.rank)
-                row_df.at[0, "exact_match"].append(row.exact_match)
+        def test_patches(patches: list[str]) -> TestResult:
+            hunk_replacements = []
 
-                assert (v := len(row_df.at[0, "decoded_sequences"])) == i + 1, (
-                    f"Hunk and patch count mismatch: {i + 1}, {v}"
+            # Patches start from the first hunk, so later hunks keep their buggy code
+            for hunk, patch in zip(hunks, patches):
+                target_file_path = checkout_dir / hunk["source_path"]
+                source_file_path = (
+                    bugsinpy_tmp_dir / "sources" / bugid / hunk["source_path"]
+                )
+                hunk_replacements.append(
+                    (
+                        source_file_path,
+                        target_file_path,
+                        get_hunk_replacement(hunk, patch),
+                    )
                 )
 
-                bugs_lens = defaultdict(list)
+            patch_applier.apply_hunks(hunk_replacements)
 
-                # When we are iterating over previous hunks, we don't have to change later hunks
-                for hunk, patch in reversed(
-                    list(zip(hunks, row_df["decoded_sequences"].item()))
-                ):
-                    patch = get_valid_python(patch)
+            # Call the testing infrastructure
+            start_timer = timeit.default_timer()
+            status, failed_count = run_tests_for_multi(bugid, checkout_dir, timeout)
+            end_timer = timeit.default_timer()
 
-                    target_file_path = checkout_dir / hunk["source_path"]
-                    bug_line, bug_len = hunk["removed_line_numbers_range"]
+            return get_test_result(
+                status, failed_count, end_timer - start_timer, timeout
+            )
 
-                    source_file_path = (
-                        bugsinpy_tmp_dir / "sources" / bugid / hunk["source_path"]
-                    )
+        template = template_df.iloc[0].to_dict()
 
-                    indent_hunk = "\n".join(
-                        [
-                            line
-                            for line in hunk["added_lines"].splitlines()
-                            if line.strip()
-                        ]
-                    )
-                    indent_size = len(indent_hunk) - len(indent_hunk.lstrip(" \t"))
-                    indent = indent_hunk[:indent_size]
-
-                    insert_patch(
-                        patch,
-                        target_file_path
-                        if target_file_path in bugs_lens
-                        else source_file_path,
-                        target_file_path,
-                        bug_line,
-                        bug_len,
-                        indent,
-                    )
+        def save_trial(trial: Trial) -> None:
+            state_store.save_candidate(
+                bugid,
+                multi_hunk_strategy,
+                len(search.trials),
+                pd.Series(get_trial_record(template, trial)),
+            )
 
-                    bugs_lens[target_file_path].append(bug_len)
-
-                # Call the testing infrastructure
-                start_timer = timeit.default_timer()
-                status, failed_count = run_tests_for_multi(bugid, checkout_dir)
-                end_timer = timeit.default_timer()
-                row_df.at[0, "validation_time"] = end_timer - start_timer
-
-                if status is Status.PLAUSIBLE:
-                    row_df.at[0, "plausible"] = True
-                    row_df.at[0, "compilable"] = True
-                    running_failed_count = 0
-                    multi_patches_list.append(row_df)
-                    break
-                elif status is Status.COMPILABLE:
-                    row_df.at[0, "compilable"] = True
-                    if failed_count and failed_count < running_failed_count:
-                        running_failed_count = failed_count
-                        running_plausible_df = pd.DataFrame(
-                            columns=row_df.columns, data=deepcopy(row_df.values)
-                        )
-                        multi_patches_list.append(row_df)
-
-                        break
-                elif status is Status.TIMEOUT:
-                    row_df.at[0, "timeout"] = True
-                    row_df.at[0, "compilable"] = True
-
-                multi_patches_list.append(row_df)
-
-            else:
-                row_df.at[0, "checkpoint"][-1] = "manual"
-                row_df.at[0, "decoded_sequences"][-1] = row.source
-                row_df.at[0, "normalized_patch"][-1] = row.normalized_source
-                row_df.at[0, "sequences_scores"][-1] = None
-                row_df.at[0, "rank"][-1] = None
-                row_df.at[0, "exact_match"][-1] = False
-                running_plausible_df = pd.DataFrame(
-                    columns=row_df.columns, data=deepcopy(row_df.values)
-                )
+        # The search restarts from scratch when resumed
+        state_store.clear_phase(bugid, multi_hunk_strategy)
 
-        # Merge and save to disk
-        new_cp_df = pd.concat(
-            [
-                new_cp_df if not new_cp_df.empty else None,
-                *multi_patches_list,
-            ]
+        search = MultiHunkSearch(
+            hunk_candidates,
+            source_candidates,
+            test_patches,
+            multi_hunk_test_budget,
+            multi_hunk_beam_width,
+            on_trial=save_trial,
+        )
+        result = search.run(multi_hunk_strategy)
+        state_store.save_search_stats(
+            bugid, result.strategy, result.test_runs, result.runs_to_plausible
         )
-
-        if not new_cp_df.empty:
-            new_cp_df.to_json(
-                save_state_dir / f"{bugid}.jsonl", orient="records", lines=True
-            )
 
 
 def compile_project(project_name: str, work_dir: Path):
@@ -583,47 +679,57 @@ def partition_bugs(bugs_metadata: dict) -> list[dict]:
 def main():
     n_jobs = 4
 
-    with open(gen_dir / bugs_metadata_file) as meta_file:
-        bugs_metadata = ChainMap(*[json.loads(line) for line in meta_file][::-1])
+    bugs_metadata = read_hunks(gen_dir / bugs_metadata_file)
 
-    candidate_patches_df = pd.read_json(
-        output_dir / f"final_candidates_{output_size}.jsonl",
-        orient="records",
-        lines=True,
+    candidate_patches_df = read_candidates(
+        output_dir / f"{candidates_order}_candidates_{output_size}.parquet"
     )
     candidate_patches_df["plausible"] = False
     candidate_patches_df["compilable"] = False
     candidate_patches_df["timeout"] = False
+    candidate_patches_df["timeout_limit"] = np.nan
+    candidate_patches_df["resource_limit"] = False
     candidate_patches_df["validation_time"] = np.nan
 
-    save_state_dir.mkdir(exist_ok=True)
-
-    for partition in partition_bugs(bugs_metadata):
-        with tqdm_joblib(tqdm(total=len(partition), disable=False)):
-            Parallel(n_jobs=n_jobs, backend="multiprocessing")(
-                delayed(apply_patch)(
-                    deepcopy(get_candidates(candidate_patches_df, bugid)), bugid, hunks
-                )
-                for bugid, hunks in partition.items()
-            )
-
-    cp_dfs = [
-        pd.read_json(cp, orient="records", lines=True)
-        for cp in sorted(save_state_dir.iterdir())
-    ]
-    concatenated_cp_df = pd.concat(cp_dfs)
+    # Create the state database before the workers connect to it
+    StateStore(state_db_path, shared=use_work_queue).close()
 
-    concatenated_cp_df.to_json(
-        output_dir / f"plausible_candidates_{output_size}.jsonl",
-        orient="records",
-        lines=True,
+    # Workers memory-map the candidates file and copy out only their bug's rows
+    candidate_slices = write_candidate_slices(
+        candidate_patches_df, bugs_metadata, candidates_file_path
     )
 
-    bugs_with_plausible_patch = (
-        concatenated_cp_df.groupby("bugid")["plausible"].any().groupby("bugid").any()
-    )
+    if use_work_queue:
+        # Bugs of a project are leased one at a time, like in the partitions
+        with WorkQueue(work_queue_path) as work_queue:
+            work_queue.add(bugs_metadata, group=lambda bugid: bugid.split()[0])
+        Parallel(n_jobs=n_jobs, backend="multiprocessing")(
+            delayed(validate_queued_bugs)(candidate_slices, bugs_metadata)
+            for _ in range(n_jobs)
+        )
+        with WorkQueue(work_queue_path) as work_queue:
+            print("Work queue:", work_queue.get_counts())
+    else:
+        for partition in partition_bugs(bugs_metadata):
+            with tqdm_joblib(tqdm(total=len(partition), disable=False)):
+                Parallel(n_jobs=n_jobs, backend="multiprocessing")(
+                    delayed(apply_patch)(candidate_slices[bugid], bugid, hunks)
+                    for bugid, hunks in partition.items()
+                )
+
+    with StateStore(state_db_path, shared=use_work_queue) as state_store:
+        state_store.export_jsonl(
+            output_dir / f"plausible_candidates_{output_size}.jsonl"
+        )
+        write_plausible_candidates(
+            state_store.iter_records(),
+            output_dir / f"plausible_candidates_{output_size}.parquet",
+        )
+        bugs_with_plausible_patch = state_store.get_plausible_bugs()
+        search_stats = state_store.get_search_stats()
     print(bugs_with_plausible_patch)
     print(bugs_with_plausible_patch.value_counts())
+    print(summarize_search_stats(search_stats))
 
 
 if __name__ == "__main__":
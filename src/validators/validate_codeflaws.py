@@ -5,13 +5,10 @@ import platform
 import re
 import shutil
 import subprocess
-import sys
 import timeit
-from collections import ChainMap, defaultdict
-from copy import deepcopy
 from enum import Enum, auto
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Iterator, Optional
 
 import joblib
 import numpy as np
@@ -19,15 +16,83 @@ import pandas as pd
 from joblib import Parallel, delayed
 from tqdm import tqdm
 
+from ..columnar import (
+    CandidateSlice,
+    read_candidates,
+    read_hunks,
+    write_candidate_slices,
+    write_plausible_candidates,
+)
 from ..configs import codeflaws_data_dir, codeflaws_gen_dir
+from .adaptive_timeout import get_timeout
+from .fork_server import ForkServer, build_fork_server
+from .multi_hunk_search import (
+    MultiHunkSearch,
+    TestResult,
+    Trial,
+    get_candidates,
+    get_source_candidate,
+    get_trial_record,
+    summarize_search_stats,
+)
+from .patch_applier import PatchApplier, get_replacement
+from .sandbox import LimitExceeded, Limits, Sandbox
+from .schemata import CSchemata, SchemataStatus, get_candidate_env
+from .state_store import StateStore
+from .workspace_manager import WorkspaceManager
 
 gen_dir = codeflaws_gen_dir
-bugs_metadata_file = "Codeflaws.jsonl"
+bugs_metadata_file = "Codeflaws.parquet"
 model = "multimend"
 output_dir = gen_dir / f"outputs-{model}"
-temp_dir = output_dir / "temp"
-save_state_dir = output_dir / "save-state"
+# Scratch files of each worker process, on a tmpfs when enough memory is free (see
+# `workspace_manager`)
+worker_workspace = WorkspaceManager(
+    "codeflaws", output_dir / "temp", 256 << 20, output_dir / "workspace-usage.jsonl"
+)
+state_db_path = output_dir / "validation-state.db"
+oracle_dir = gen_dir / "oracle"
 output_size = 100
+# Candidates are validated in the order of `combine_checkpoints_results` ("final"), or
+# in the order of `rerank_candidates` ("reranked"), once it has run for this dataset
+candidates_order = "final"
+candidates_file_path = output_dir / f"candidates_{output_size}.arrow"
+
+# Candidates are killed at `timeout_factor` times the slowest reference test runtime,
+# clamped to [`timeout_floor`, `timeout_ceiling`] seconds
+timeout_factor = 5
+timeout_floor = 1
+timeout_ceiling = 60
+
+# Search over combinations of hunk candidates for multi-hunk bugs: "greedy",
+# "beam" or "delta" (see `multi_hunk_search`), stopped after `multi_hunk_test_budget`
+# test runs per bug
+multi_hunk_strategy = "greedy"
+multi_hunk_test_budget = 2000
+multi_hunk_beam_width = 10
+
+# Compile the candidates of single-hunk bugs into one binary as mutant schemata (see
+# `schemata`), in groups of `schemata_group_size`, dropping the branches with errors
+# for up to `schemata_max_compiles` compilations per group
+use_schemata = True
+schemata_group_size = 100
+schemata_max_compiles = 5
+
+# Run the tests of a compiled candidate from a fork server (see `fork_server`), so
+# each test costs a fork instead of starting the program again. Needs `fork`.
+use_fork_server = platform.system() != "Windows"
+fork_server_dir = output_dir / "fork-server"
+
+# Tests of candidates run with these limits, also applied to the whole process tree
+# when a cgroup is available (see `sandbox`)
+sandbox = Sandbox(
+    Limits(
+        memory_bytes=1 << 30,
+        cpu_seconds=2 * timeout_ceiling,
+        max_processes=32,
+        output_bytes=100 << 20,
+    )
+)
 
 rem_file_path = gen_dir / "rem.txt"
 add_file_path = gen_dir / "add.txt"
@@ -63,13 +128,13 @@ def working_environment(bugid: str):
     buggy_file_name = f"{metadata[0]}-{metadata[1]}-{metadata[-2]}.c"
 
     # Copy files to a working directory
-    project_copy_dir = temp_dir / bugid
+    project_copy_dir = worker_workspace.path / bugid
     copy_dataset_files(project_dir, project_copy_dir)
 
     target_file_path = project_copy_dir / buggy_file_name
 
     # Copy initial file to a temp directory
-    source_file_path = temp_dir / "sources" / bugid / buggy_file_name
+    source_file_path = worker_workspace.path / "sources" / bugid / buggy_file_name
     source_file_path.parent.mkdir(parents=True, exist_ok=False)
     shutil.copyfile(target_file_path, source_file_path)
 
@@ -122,28 +187,12 @@ def get_hunk_candidates(df: pd.DataFrame, hunk: int) -> pd.DataFrame:
     return df.loc[df["hunk"] == hunk]
 
 
-def get_candidates(df: pd.DataFrame, bugid: str) -> pd.DataFrame:
-    """Returns the subset of `df` containing candidate patches for a specific bugid and all its hunks"""
-    return df.loc[df["bugid"] == bugid]
-
-
-def insert_patch(patch, source_file_path, target_file_path, bug_line, bug_len, indent):
-    with open(source_file_path, "r", encoding="utf-8") as file:
-        lines = file.readlines()
-    if bug_len == 0:
-        lines.insert(bug_line, indent + patch + "\n")
-    else:
-        lines[bug_line - 1 : (bug_line - 1) + bug_len] = indent + patch + "\n"
-
-    with open(target_file_path, "w", encoding="utf-8") as file:
-        file.writelines(lines)
-
-
-def get_passing_tests(bugid: str, project_dir: Path) -> list[tuple[Path, Path]]:
+def get_passing_tests(bugid: str, project_dir: Path) -> dict[tuple[Path, Path], float]:
+    """Runs the correct program against heldout tests and returns the passing ones with their runtimes"""
     timeout = 60
     meta = bugid.split("-")
     correct_filename = f"{meta[0]}-{meta[1]}-{meta[-1]}"
-    passing_tests = []
+    passing_tests = {}
 
     with change_directory(project_dir):
         subprocess.run(
@@ -160,6 +209,7 @@ def get_passing_tests(bugid: str, project_dir: Path) -> list[tuple[Path, Path]]:
         for testcase_path, testcase_output_path in testcases.items():
             with open(testcase_path) as input_file:
                 try:
+                    start_timer = timeit.default_timer()
                     result = subprocess.run(
                         [f".{os.sep}{correct_filename}"],
                         stdin=input_file,
@@ -168,16 +218,84 @@ def get_passing_tests(bugid: str, project_dir: Path) -> list[tuple[Path, Path]]:
                         timeout=timeout,
                         encoding="cp1256",
                     )
+                    end_timer = timeit.default_timer()
                 except subprocess.TimeoutExpired:
                     continue
 
             with open(testcase_output_path) as output_file:
                 if result.stdout.rstrip() == output_file.read().rstrip():
-                    passing_tests.append((testcase_path, testcase_output_path))
+                    passing_tests[(testcase_path, testcase_output_path)] = (
+                        end_timer - start_timer
+                    )
 
     return passing_tests
 
 
+def build_oracle(bugid: str) -> None:
+    """Precomputes the reproducible passing tests of the correct program for a bug.
+
+    Tests are run three times and only the ones passing in every run are kept. Flaky
+    tests are excluded, and the expected outputs and reference runtimes are stored
+    next to them so validators don't need to rebuild the correct program.
+    """
+
+    project_copy_dir = worker_workspace.path / "oracle" / bugid
+    copy_dataset_files(codeflaws_data_dir / bugid, project_copy_dir)
+
+    try:
+        returned_tests = [get_passing_tests(bugid, project_copy_dir) for _ in range(3)]
+        passing_tests = set.intersection(*[set(tests) for tests in returned_tests])
+
+        tests = []
+        for testcase_path, testcase_output_path in sorted(passing_tests):
+            if (bugid, testcase_path.name) in flaky_tests:
+                continue
+
+            with open(project_copy_dir / testcase_output_path) as output_file:
+                expected_output = output_file.read().rstrip()
+
+            tests.append(
+                {
+                    "input": testcase_path.name,
+                    "expected_output": expected_output,
+                    "runtime": max(
+                        runtimes[(testcase_path, testcase_output_path)]
+                        for runtimes in returned_tests
+                    ),
+                }
+            )
+    finally:
+        shutil.rmtree(project_copy_dir)
+
+    oracle_dir.mkdir(parents=True, exist_ok=True)
+    with open(oracle_dir / f"{bugid}.json", "w") as file:
+        json.dump({"bugid": bugid, "tests": tests}, file)
+
+
+def load_oracle(bugid: str) -> dict:
+    """Loads the precomputed oracle of a bug, building it first if it doesn't exist"""
+
+    oracle_file_path = oracle_dir / f"{bugid}.json"
+    if not oracle_file_path.exists():
+        build_oracle(bugid)
+
+    with open(oracle_file_path) as file:
+        return json.load(file)
+
+
+def get_oracle_tests(bugid: str) -> list[tuple[Path, str]]:
+    """Returns (input file, expected output) pairs of the reproducible passing tests of a bug"""
+    return [
+        (Path(test["input"]), test["expected_output"])
+        for test in load_oracle(bugid)["tests"]
+    ]
+
+
+def get_oracle_runtime(bugid: str) -> Optional[float]:
+    """Returns the runtime of the slowest reproducible passing test of the correct program"""
+    return max((test["runtime"] for test in load_oracle(bugid)["tests"]), default=None)
+
+
 flaky_tests = {
     ("107-B-bug-2042682-2042689", "heldout-input-pos32"),
     ("107-B-bug-2042682-2042689", "heldout-input-pos35"),
@@ -406,55 +524,89 @@ class Status(Enum):
     COMPILABLE = auto()
     TIMEOUT = auto()
     UNCOMPILABLE = auto()
+    RESOURCE_LIMIT = auto()
 
 
-def run_tests_for_multi(
-    bugid: str, project_dir: Path, passing_tests: list[tuple[Path, Path]]
-) -> tuple[Status, int | None]:
-    timeout = 60  # seconds
-
-    meta = bugid.split("-")
-    buggy_filename = f"{meta[0]}-{meta[1]}-{meta[-2]}"
-
-    with change_directory(project_dir):
-        # Compile
-        compile_result = subprocess.run([make_bin], capture_output=True)
-        if compile_result.returncode != 0:
-            return Status.UNCOMPILABLE, None
+@contextlib.contextmanager
+def test_runner(
+    project_dir: Path, executable: str, env: Optional[dict] = None
+) -> Iterator[Callable[[Path, float], bool]]:
+    """Yields a function that runs the program on a test input with its output in
+    the `stdout` file, and returns `False` if it timed out or raises `LimitExceeded`.
+    Must be entered from `project_dir`."""
+
+    with contextlib.ExitStack() as stack:
+        fork_server = None
+        if use_fork_server:
+            fork_server = stack.enter_context(
+                ForkServer(
+                    Path(executable),
+                    project_dir,
+                    build_fork_server(fork_server_dir),
+                    env,
+                    sandbox.get_preexec_fn(),
+                )
+            )
 
-        failed_count = 0
-        # Running tests
-        for testcase_path, testcase_output_path in passing_tests:
-            if (bugid, testcase_path.name) in flaky_tests:
-                continue
+        def run_test(testcase_path: Path, timeout: float) -> bool:
+            if fork_server is not None and fork_server.ready:
+                status = fork_server.run(testcase_path, Path("stdout"), timeout)
+                if status is None:
+                    return False
+                sandbox.check(os.waitstatus_to_exitcode(status))
+                return True
 
             with (
                 open(testcase_path) as input_file,
                 open("stdout", "w", encoding="cp1256") as stdout_file,
             ):
                 try:
-                    result = subprocess.run(
-                        [f".{os.sep}{buggy_filename}"],
+                    sandbox.run(
+                        [f".{os.sep}{executable}"],
                         stdin=input_file,
                         text=True,
-                        capture_output=False,
                         stdout=stdout_file,
                         stderr=subprocess.DEVNULL,
                         timeout=timeout,
                         encoding="cp1256",
+                        env=env,
                     )
                 except subprocess.TimeoutExpired:
+                    return False
+            return True
+
+        yield run_test
+
+
+def run_tests_for_multi(
+    bugid: str, project_dir: Path, passing_tests: list[tuple[Path, str]], timeout: float
+) -> tuple[Status, int | None]:
+    meta = bugid.split("-")
+    buggy_filename = f"{meta[0]}-{meta[1]}-{meta[-2]}"
+
+    compiled, _ = compile_project(project_dir)
+    if not compiled:
+        return Status.UNCOMPILABLE, None
+
+    failed_count = 0
+    with (
+        change_directory(project_dir),
+        test_runner(project_dir, buggy_filename) as run_test,
+    ):
+        # Running tests
+        for testcase_path, expected_output in passing_tests:
+            try:
+                if not run_test(testcase_path, timeout):
                     return Status.TIMEOUT, None
+            except LimitExceeded:
+                return Status.RESOURCE_LIMIT, None
 
             if Path("stdout").stat().st_size / (1024 * 1024) > 100:
                 failed_count += 1
                 continue
 
-            with (
-                open(testcase_output_path) as output_file,
-                open("stdout", encoding="cp1256") as stdout_file,
-            ):
-                if stdout_file.read().rstrip() != output_file.read().rstrip():
+            with open("stdout", encoding="cp1256") as stdout_file:
+                if stdout_file.read().rstrip() != expected_output:
                     failed_count += 1
 
     if failed_count:
@@ -463,61 +615,97 @@ def run_tests_for_multi(
         return Status.PLAUSIBLE, 0
 
 
+def get_test_result(
+    status: Status,
+    failed_count: Optional[int],
+    validation_time: float,
+    timeout: float,
+) -> TestResult:
+    return TestResult(
+        status is Status.PLAUSIBLE,
+        failed_count,
+        {
+            "plausible": status is Status.PLAUSIBLE,
+            "compilable": status is not Status.UNCOMPILABLE,
+            "timeout": status is Status.TIMEOUT,
+            "timeout_limit": timeout if status is Status.TIMEOUT else np.nan,
+            "resource_limit": status is Status.RESOURCE_LIMIT,
+            "validation_time": validation_time,
+        },
+    )
+
+
+def compile_project(project_dir: Path) -> tuple[bool, str]:
+    with change_directory(project_dir):
+        compile_result = subprocess.run([make_bin], capture_output=True, text=True)
+    return compile_result.returncode == 0, compile_result.stdout + compile_result.stderr
+
+
 def run_tests(
-    bugid: str, project_dir: Path, passing_tests: list[tuple[Path, Path]]
+    bugid: str, project_dir: Path, passing_tests: list[tuple[Path, str]], timeout: float
 ) -> Status:
-    timeout = 60  # seconds
+    compiled, _ = compile_project(project_dir)
+    if not compiled:
+        return Status.UNCOMPILABLE
 
+    return run_compiled_tests(bugid, project_dir, passing_tests, timeout)
+
+
+def run_compiled_tests(
+    bugid: str,
+    project_dir: Path,
+    passing_tests: list[tuple[Path, str]],
+    timeout: float,
+    env: Optional[dict] = None,
+) -> Status:
     meta = bugid.split("-")
     buggy_filename = f"{meta[0]}-{meta[1]}-{meta[-2]}"
 
-    with change_directory(project_dir):
-        # Compile
-        compile_result = subprocess.run([make_bin], capture_output=True)
-        if compile_result.returncode != 0:
-            return Status.UNCOMPILABLE
-
+    with (
+        change_directory(project_dir),
+        test_runner(project_dir, buggy_filename, env) as run_test,
+    ):
         # Running tests
-        for testcase_path, testcase_output_path in passing_tests:
-            if (bugid, testcase_path.name) in flaky_tests:
-                continue
-
-            with (
-                open(testcase_path) as input_file,
-                open("stdout", "w", encoding="cp1256") as stdout_file,
-            ):
-                try:
-                    result = subprocess.run(
-                        [f".{os.sep}{buggy_filename}"],
-                        stdin=input_file,
-                        text=True,
-                        capture_output=False,
-                        stdout=stdout_file,
-                        stderr=subprocess.DEVNULL,
-                        timeout=timeout,
-                        encoding="cp1256",
-                    )
-                except subprocess.TimeoutExpired:
+        for testcase_path, expected_output in passing_tests:
+            try:
+                if not run_test(testcase_path, timeout):
                     return Status.TIMEOUT
+            except LimitExceeded:
+                return Status.RESOURCE_LIMIT
 
             if Path("stdout").stat().st_size / (1024 * 1024) > 100:
                 return Status.COMPILABLE
 
-            with (
-                open(testcase_output_path) as output_file,
-                open("stdout", encoding="cp1256") as stdout_file,
-            ):
-                if stdout_file.read().rstrip() != output_file.read().rstrip():
+            with open("stdout", encoding="cp1256") as stdout_file:
+                if stdout_file.read().rstrip() != expected_output:
                     return Status.COMPILABLE
 
     return Status.PLAUSIBLE
 
 
-def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.DataFrame]:
-    # Check if already processed
-    save_file_path = save_state_dir / f"{bugid}.jsonl"
-    if save_file_path.exists():
-        return
+def apply_patch(
+    candidates: CandidateSlice, bugid: str, hunks: list
+) -> Optional[pd.DataFrame]:
+    with StateStore(state_db_path) as state_store:
+        # Skip if already processed
+        if state_store.is_done(bugid):
+            return
+
+        with worker_workspace.track(bugid):
+            validate_candidates(candidates.load(), bugid, hunks, state_store)
+        state_store.mark_done(bugid)
+
+
+def validate_candidates(
+    cp_df: pd.DataFrame, bugid: str, hunks: list, state_store: StateStore
+) -> None:
+    # Buggy source files are read once per bug
+    patch_applier = PatchApplier()
+    # Reproducible passing tests of the correct program
+    passing_tests = get_oracle_tests(bugid)
+    timeout = get_timeout(
+        get_oracle_runtime(bugid), timeout_factor, timeout_floor, timeout_ceiling
+    )
 
     if len(hunks) == 1:
         hunk = hunks[0]
@@ -533,20 +721,65 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
             source_file_path,
             target_file_path,
         ):
-            # Get reproducible tests
-            returned_tests = [
-                set(get_passing_tests(bugid, project_copy_dir)) for _ in range(3)
-            ]
-            passing_tests = set.intersection(*returned_tests)
-
-            for index, patch in bug_hunk_subset_df["decoded_sequences"].items():
-                insert_patch(
-                    patch, source_file_path, target_file_path, bug_line, bug_len, indent
+            state_store.add_candidates(bugid, "single", cp_df)
+            if state_store.has_plausible(bugid, "single"):
+                return
+            tested = state_store.tested_indices(bugid, "single")
+
+            patches = {
+                index: patch
+                for index, patch in bug_hunk_subset_df["decoded_sequences"].items()
+                if str(index) not in tested
+            }
+            if use_schemata:
+                schemata = CSchemata(
+                    patch_applier,
+                    source_file_path,
+                    target_file_path,
+                    bug_line,
+                    bug_len,
+                    indent,
+                )
+                schemata_statuses = schemata.iter_candidates(
+                    patches,
+                    lambda: compile_project(project_copy_dir),
+                    schemata_group_size,
+                    schemata_max_compiles,
+                )
+            else:
+                schemata_statuses = (
+                    (index, SchemataStatus.SEPARATE) for index in patches
                 )
 
+            for index, schemata_status in schemata_statuses:
                 # call the testing infrastructure
                 start_timer = timeit.default_timer()
-                passed = run_tests(bugid, project_copy_dir, passing_tests)
+                if schemata_status is SchemataStatus.COMPILED:
+                    passed = run_compiled_tests(
+                        bugid,
+                        project_copy_dir,
+                        passing_tests,
+                        timeout,
+                        get_candidate_env(index),
+                    )
+                    # Its branch may compile where the candidate alone doesn't
+                    if passed is Status.PLAUSIBLE and not schemata.compiles_alone(
+                        patches[index], lambda: compile_project(project_copy_dir)
+                    ):
+                        passed = Status.UNCOMPILABLE
+                elif schemata_status is SchemataStatus.UNCOMPILABLE:
+                    passed = Status.UNCOMPILABLE
+                else:
+                    patch_applier.apply(
+                        source_file_path,
+                        target_file_path,
+                        [
+                            get_replacement(
+                                bug_line, bug_len, indent + patches[index] + "\n"
+                            )
+                        ],
+                    )
+                    passed = run_tests(bugid, project_copy_dir, passing_tests, timeout)
 
                 end_timer = timeit.default_timer()
                 cp_df.at[index, "validation_time"] = end_timer - start_timer
@@ -554,15 +787,19 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
                 if passed is Status.PLAUSIBLE:
                     cp_df.at[index, "plausible"] = True
                     cp_df.at[index, "compilable"] = True
-                    break
                 elif passed is Status.COMPILABLE:
                     cp_df.at[index, "compilable"] = True
                 elif passed is Status.TIMEOUT:
                     cp_df.at[index, "timeout"] = True
+                    cp_df.at[index, "timeout_limit"] = timeout
+                    cp_df.at[index, "compilable"] = True
+                elif passed is Status.RESOURCE_LIMIT:
+                    cp_df.at[index, "resource_limit"] = True
                     cp_df.at[index, "compilable"] = True
 
-        # Save intermediate state
-        cp_df.to_json(save_state_dir / f"{bugid}.jsonl", orient="records", lines=True)
+                state_store.save_candidate(bugid, "single", index, cp_df.loc[index])
+                if cp_df.at[index, "plausible"]:
+                    break
 
     else:
         agg_mapping = {
@@ -575,6 +812,8 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
                 "plausible",
                 "compilable",
                 "timeout",
+                "timeout_limit",
+                "resource_limit",
                 "validation_time",
             ]
             else list
@@ -597,16 +836,18 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
             source_file_path,
             target_file_path,
         ):
-            # Get reproducible tests
-            returned_tests = [
-                set(get_passing_tests(bugid, project_copy_dir)) for _ in range(3)
-            ]
-            passing_tests = set.intersection(*returned_tests)
+            state_store.add_candidates(bugid, "combined", new_cp_df)
+            if state_store.has_plausible(bugid, "combined"):
+                return
+            tested = state_store.tested_indices(bugid, "combined")
 
             for index, patches in new_cp_df["decoded_sequences"].items():
-                bugs_lens = defaultdict(list)
+                if str(index) in tested:
+                    continue
 
-                for hunk, patch in reversed(list(zip(hunks, patches))):
+                replacements = []
+
+                for hunk, patch in zip(hunks, patches):
                     bug_line, bug_len = hunk["removed_line_numbers_range"]
 
                     indent_size = len(hunk["added_lines"]) - len(
@@ -614,39 +855,38 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
                     )
                     indent = hunk["added_lines"][:indent_size]
 
-                    insert_patch(
-                        patch,
-                        target_file_path
-                        if target_file_path in bugs_lens
-                        else source_file_path,
-                        target_file_path,
-                        bug_line,
-                        bug_len,
-                        indent,
+                    replacements.append(
+                        get_replacement(bug_line, bug_len, indent + patch + "\n")
                     )
 
-                    bugs_lens[target_file_path].append(bug_len)
+                patch_applier.apply(source_file_path, target_file_path, replacements)
 
                 # call the testing infrastructure
                 start_timer = timeit.default_timer()
-                passed = run_tests(bugid, project_copy_dir, passing_tests)
+                passed = run_tests(bugid, project_copy_dir, passing_tests, timeout)
                 end_timer = timeit.default_timer()
                 new_cp_df.at[index, "validation_time"] = end_timer - start_timer
 
                 if passed is Status.PLAUSIBLE:
                     new_cp_df.at[index, "plausible"] = True
                     new_cp_df.at[index, "compilable"] = True
-                    break
                 elif passed is Status.COMPILABLE:
                     new_cp_df.at[index, "compilable"] = True
                 elif passed is Status.TIMEOUT:
                     new_cp_df.at[index, "timeout"] = True
+                    new_cp_df.at[index, "timeout_limit"] = timeout
+                    new_cp_df.at[index, "compilable"] = True
+                elif passed is Status.RESOURCE_LIMIT:
+                    new_cp_df.at[index, "resource_limit"] = True
                     new_cp_df.at[index, "compilable"] = True
 
-        if not new_cp_df.empty and new_cp_df["plausible"].any():
-            new_cp_df.to_json(
-                save_state_dir / f"{bugid}.jsonl", orient="records", lines=True
-            )
+                state_store.save_candidate(
+                    bugid, "combined", index, new_cp_df.loc[index]
+                )
+                if new_cp_df.at[index, "plausible"]:
+                    break
+
+        if state_store.has_plausible(bugid, "combined"):
             return
 
         #######################################################################
@@ -658,6 +898,8 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
                 "plausible",
                 "compilable",
                 "timeout",
+                "timeout_limit",
+                "resource_limit",
                 "validation_time",
             ]:
                 agg_mapping[col] = "first"
@@ -683,127 +925,78 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
 
         #######################################################################
 
-        # List to store extracted multi-hunk patches
-        multi_patches_list = []
+        hunk_candidates = []
+        source_candidates = []
+        for i in range(len(hunks)):
+            hunk_candidates.append(get_candidates(get_hunk_candidates(cp_df, i)))
+            source_candidates.append(
+                get_source_candidate(
+                    template_df.at[0, "source"][i],
+                    template_df.at[0, "normalized_source"][i],
+                )
+            )
 
-        running_plausible_df = None
+        template = template_df.iloc[0].to_dict()
+
+        def save_trial(trial: Trial) -> None:
+            state_store.save_candidate(
+                bugid,
+                multi_hunk_strategy,
+                len(search.trials),
+                pd.Series(get_trial_record(template, trial)),
+            )
+
+        # The search restarts from scratch when resumed
+        state_store.clear_phase(bugid, multi_hunk_strategy)
 
         with working_environment(bugid) as (
             project_copy_dir,
             source_file_path,
             target_file_path,
         ):
-            _, running_failed_count = run_tests_for_multi(
-                bugid, project_copy_dir, passing_tests
-            )
-            if not running_failed_count:
-                running_failed_count = sys.maxsize
 
-            for i in range(len(hunks)):
-                if running_failed_count == 0:
-                    break
-                hunk_cp_df = get_hunk_candidates(cp_df, i)
-
-                for row in hunk_cp_df.itertuples():
-                    if i == 0:
-                        row_df = pd.DataFrame(
-                            columns=template_df.columns,
-                            data=deepcopy(template_df.values),
-                        )
-                    else:
-                        row_df = pd.DataFrame(
-                            columns=running_plausible_df.columns,
-                            data=deepcopy(running_plausible_df.values),
-                        )
-                    row_df.at[0, "checkpoint"].append(row.checkpoint)
-                    row_df.at[0, "decoded_sequences"].append(row.decoded_sequences)
-                    row_df.at[0, "normalized_patch"].append(row.normalized_patch)
-                    row_df.at[0, "sequences_scores"].append(row.sequences_scores)
-                    row_df.at[0, "rank"].append(row.rank)
-                    row_df.at[0, "exact_match"].append(row.exact_match)
-
-                    assert (v := len(row_df.at[0, "decoded_sequences"])) == i + 1, (
-                        f"Hunk and patch count mismatch: {i + 1}, {v}"
-                    )
+            def test_patches(patches: list[str]) -> TestResult:
+                replacements = []
 
-                    bugs_lens = defaultdict(list)
+                # Patches start from the first hunk, so later hunks keep their buggy code
+                for hunk, patch in zip(hunks, patches):
+                    bug_line, bug_len = hunk["removed_line_numbers_range"]
 
-                    # When we are iterating over previous hunks, we don't have to change later hunks
-                    for hunk, patch in reversed(
-                        list(zip(hunks, row_df["decoded_sequences"].item()))
-                    ):
-                        bug_line, bug_len = hunk["removed_line_numbers_range"]
-
-                        indent_size = len(hunk["added_lines"]) - len(
-                            hunk["added_lines"].lstrip(" \t")
-                        )
-                        indent = hunk["added_lines"][:indent_size]
-
-                        insert_patch(
-                            patch,
-                            target_file_path
-                            if target_file_path in bugs_lens
-                            else source_file_path,
-                            target_file_path,
-                            bug_line,
-                            bug_len,
-                            indent,
-                        )
-
-                        bugs_lens[target_file_path].append(bug_len)
-
-                    # Call the testing infrastructure
-                    start_timer = timeit.default_timer()
-                    status, failed_count = run_tests_for_multi(
-                        bugid, project_copy_dir, passing_tests
+                    indent_size = len(hunk["added_lines"]) - len(
+                        hunk["added_lines"].lstrip(" \t")
                     )
-                    end_timer = timeit.default_timer()
-                    row_df.at[0, "validation_time"] = end_timer - start_timer
-
-                    if status is Status.PLAUSIBLE:
-                        row_df.at[0, "plausible"] = True
-                        row_df.at[0, "compilable"] = True
-                        running_failed_count = 0
-                        multi_patches_list.append(row_df)
-                        break
-                    elif status is Status.COMPILABLE:
-                        row_df.at[0, "compilable"] = True
-                        if failed_count and failed_count < running_failed_count:
-                            running_failed_count = failed_count
-                            running_plausible_df = pd.DataFrame(
-                                columns=row_df.columns, data=deepcopy(row_df.values)
-                            )
-                            multi_patches_list.append(row_df)
-                            break
-                    elif status is Status.TIMEOUT:
-                        row_df.at[0, "timeout"] = True
-                        row_df.at[0, "compilable"] = True
-
-                    multi_patches_list.append(row_df)
+                    indent = hunk["added_lines"][:indent_size]
 
-                else:
-                    row_df.at[0, "checkpoint"][-1] = "manual"
-                    row_df.at[0, "decoded_sequences"][-1] = row.source
-                    row_df.at[0, "normalized_patch"][-1] = row.normalized_source
-                    row_df.at[0, "sequences_scores"][-1] = None
-                    row_df.at[0, "rank"][-1] = None
-                    row_df.at[0, "exact_match"][-1] = False
-                    running_plausible_df = pd.DataFrame(
-                        columns=row_df.columns, data=deepcopy(row_df.values)
+                    replacements.append(
+                        get_replacement(bug_line, bug_len, indent + patch + "\n")
                     )
 
-        # Merge and save to disk
-        new_cp_df = pd.concat(
-            [
-                new_cp_df if not new_cp_df.empty else None,
-                *multi_patches_list,
-            ]
-        )
+                patch_applier.apply(source_file_path, target_file_path, replacements)
 
-        if not new_cp_df.empty:
-            new_cp_df.to_json(
-                save_state_dir / f"{bugid}.jsonl", orient="records", lines=True
+                # Call the testing infrastructure
+                start_timer = timeit.default_timer()
+                status, failed_count = run_tests_for_multi(
+                    bugid, project_copy_dir, passing_tests, timeout
+                )
+                end_timer = timeit.default_timer()
+
+                return get_test_result(
+                    status, failed_count, end_timer - start_timer, timeout
+                )
+
+            search = MultiHunkSearch(
+                hunk_candidates,
+                source_candidates,
+                test_patches,
+                multi_hunk_test_budget,
+                multi_hunk_beam_width,
+                on_trial=save_trial,
             )
+            result = search.run(multi_hunk_strategy)
+
+        state_store.save_search_stats(
+            bugid, result.strategy, result.test_runs, result.runs_to_plausible
+        )
 
 
 def copy_dataset_files(dataset_dir, temp_dataset_dir):
@@ -820,47 +1013,56 @@ def main():
 
     n_jobs = 4
 
-    with open(gen_dir / bugs_metadata_file) as meta_file:
-        bugs_metadata = ChainMap(*[json.loads(line) for line in meta_file][::-1])
+    bugs_metadata = read_hunks(gen_dir / bugs_metadata_file)
 
-    candidate_patches_df = pd.read_json(
-        output_dir / f"final_candidates_{output_size}.jsonl",
-        orient="records",
-        lines=True,
+    candidate_patches_df = read_candidates(
+        output_dir / f"{candidates_order}_candidates_{output_size}.parquet"
     )
     candidate_patches_df["plausible"] = False
     candidate_patches_df["compilable"] = False
     candidate_patches_df["timeout"] = False
+    candidate_patches_df["timeout_limit"] = np.nan
+    candidate_patches_df["resource_limit"] = False
     candidate_patches_df["validation_time"] = np.nan
 
-    shutil.rmtree(temp_dir, ignore_errors=True)
-    temp_dir.mkdir(parents=True)
-    save_state_dir.mkdir(parents=True, exist_ok=True)
+    # Remove the workspaces left by crashed runs
+    worker_workspace.clean()
+    # Create the state database before the workers connect to it
+    StateStore(state_db_path).close()
+
+    # Workers memory-map the candidates file and copy out only their bug's rows
+    candidate_slices = write_candidate_slices(
+        candidate_patches_df, bugs_metadata, candidates_file_path
+    )
+
+    # Build missing oracles once, validators only load them afterwards
+    missing_oracles = [
+        bugid for bugid in bugs_metadata if not (oracle_dir / f"{bugid}.json").exists()
+    ]
+    with tqdm_joblib(tqdm(total=len(missing_oracles), disable=False)):
+        Parallel(n_jobs=n_jobs, backend="loky")(
+            delayed(build_oracle)(bugid) for bugid in missing_oracles
+        )
 
     with tqdm_joblib(tqdm(total=len(bugs_metadata), disable=False)):
         Parallel(n_jobs=n_jobs, backend="loky")(
-            delayed(apply_patch)(
-                deepcopy(get_candidates(candidate_patches_df, bugid)), bugid, hunks
-            )
+            delayed(apply_patch)(candidate_slices[bugid], bugid, hunks)
             for bugid, hunks in bugs_metadata.items()
         )
 
-    cp_dfs = [
-        pd.read_json(cp, orient="records", lines=True)
-        for cp in sorted(save_state_dir.iterdir())
-    ]
-    concatenated_cp_df = pd.concat(cp_dfs, ignore_index=True)
-
-    bugs_with_plausible_patch = (
-        concatenated_cp_df.groupby("bugid")["plausible"].any().groupby("bugid").any()
-    )
+    with StateStore(state_db_path) as state_store:
+        state_store.export_jsonl(
+            output_dir / f"plausible_candidates_{output_size}.jsonl"
+        )
+        write_plausible_candidates(
+            state_store.iter_records(),
+            output_dir / f"plausible_candidates_{output_size}.parquet",
+        )
+        bugs_with_plausible_patch = state_store.get_plausible_bugs()
+        search_stats = state_store.get_search_stats()
     print(bugs_with_plausible_patch)
     print(bugs_with_plausible_patch.value_counts())
-    concatenated_cp_df.to_json(
-        output_dir / f"plausible_candidates_{output_size}.jsonl",
-        orient="records",
-        lines=True,
-    )
+    print(summarize_search_stats(search_stats))
 
 
 if __name__ == "__main__":
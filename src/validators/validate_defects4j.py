@@ -1,5 +1,4 @@
 import contextlib
-import json
 import multiprocessing as mp
 import re
 import shlex
@@ -7,11 +6,9 @@ import shutil
 import subprocess
 import threading
 import timeit
-from collections import ChainMap, defaultdict
-from copy import deepcopy
 from enum import Enum, auto
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Sequence
 
 import joblib
 import numpy as np
@@ -20,15 +17,109 @@ import psutil
 from joblib import Parallel, delayed
 from tqdm import tqdm
 
-from ..configs import d4j_bin, d4j_gen_dir
+from ..columnar import (
+    CandidateSlice,
+    read_candidates,
+    read_hunks,
+    write_candidate_slices,
+    write_plausible_candidates,
+)
+from ..configs import d4j_bin, d4j_gen_dir, d4j_root
+from ..defects4j_properties import load_properties
+from .adaptive_timeout import get_reference_runtime, get_timeout
+from .multi_hunk_search import (
+    MultiHunkSearch,
+    TestResult,
+    Trial,
+    get_candidates,
+    get_source_candidate,
+    get_trial_record,
+    summarize_search_stats,
+)
+from .patch_applier import PatchApplier, get_replacement
+from .sandbox import LimitExceeded, Limits, Sandbox
+from .schemata import JavaSchemata, SchemataStatus, get_candidate_env
+from .state_store import StateStore
+from .test_selection import get_coverage, parse_cobertura_methods, select_tests
+from .test_shards import TestShards, build_shard_runner
+from .work_queue import WorkQueue, run_worker
+from .workspace_manager import WorkspaceManager
 
 gen_dir = d4j_gen_dir
-bugs_metadata_file = "Defects4J.jsonl"
+bugs_metadata_file = "Defects4J.parquet"
 model = "multimend"
 output_dir = gen_dir / f"outputs-{model}"
-d4j_tmp_dir = output_dir / "temp"
-save_state_dir = output_dir / "save-state"
+# Scratch files of each worker process, on a tmpfs when enough memory is free (see
+# `workspace_manager`)
+worker_workspace = WorkspaceManager(
+    "defects4j", output_dir / "temp", 2 << 30, output_dir / "workspace-usage.jsonl"
+)
+state_db_path = output_dir / "validation-state.db"
+# With `use_work_queue`, runs of this script on any number of hosts sharing
+# `output_dir` validate the bugs together, each of their `n_jobs` processes leasing
+# bugs from the queue at `work_queue_path` (see `work_queue`)
+use_work_queue = False
+work_queue_path = output_dir / "work-queue.db"
+reference_runtimes_dir = gen_dir / "reference-runtimes"
 output_size = 100
+# Candidates are validated in the order of `combine_checkpoints_results` ("final"), or
+# in the order of `rerank_candidates` ("reranked"), once it has run for this dataset
+candidates_order = "final"
+candidates_file_path = output_dir / f"candidates_{output_size}.arrow"
+# Encodings to read the buggy source files with, and to write patched files
+# with when the previous one fails
+source_encodings = ("cp1256", "utf-8")
+
+# Candidates are killed at `timeout_factor` times the relevant tests runtime of the
+# buggy version, clamped to [`timeout_floor`, `timeout_ceiling`] seconds
+timeout_factor = 5
+timeout_floor = 60
+timeout_ceiling = 300
+
+# Defects4J test runs and test shards run with these limits, also applied to the
+# whole process tree when a cgroup is available (see `sandbox`). CPU time is per
+# process, summed over the threads of a JVM.
+sandbox = Sandbox(
+    Limits(
+        memory_bytes=4 << 30,
+        cpu_seconds=4 * timeout_ceiling,
+        max_processes=1024,
+        output_bytes=1 << 30,
+    )
+)
+
+# Search over combinations of hunk candidates for multi-hunk bugs: "greedy",
+# "beam" or "delta" (see `multi_hunk_search`), stopped after `multi_hunk_test_budget`
+# test runs per bug
+multi_hunk_strategy = "greedy"
+multi_hunk_test_budget = 2000
+multi_hunk_beam_width = 10
+
+# Compile the candidates of single-hunk bugs together as mutant schemata (see
+# `schemata`), in groups of `schemata_group_size`, dropping the branches with
+# errors for up to `schemata_max_compiles` compilations per group
+use_schemata = True
+schemata_group_size = 100
+schemata_max_compiles = 5
+
+# Candidates that pass the trigger tests run the relevant test classes that cover
+# their hunks on the buggy version before all relevant tests, unless more than
+# `max_selected_tests` classes cover them. The coverage of each relevant test class is
+# measured once per bug and stored under `coverage_dir`.
+use_test_selection = True
+max_selected_tests = 10
+coverage_dir = gen_dir / "coverage"
+
+# Relevant test classes run in `test_shards` JVMs, balanced by the class runtimes of
+# earlier runs stored under `class_runtimes_dir`, instead of one `defects4j test -r`.
+# A run that only needs a verdict stops at the first failing class. The shard runner
+# skips the build files, JVM arguments and properties of the Defects4J harness, so
+# its failure counts should be checked against `defects4j test -r` on the buggy and
+# fixed versions before enabling it.
+test_shards = 1
+class_runtimes_dir = gen_dir / "class-runtimes"
+shard_runner_dir = output_dir / "shard-runner"
+junit_jar_path = d4j_root / "framework/projects/lib/junit-4.11.jar"
 
 rem_file_path = gen_dir / "rem.txt"
 add_file_path = gen_dir / "add.txt"
@@ -80,43 +171,29 @@ def get_hunk_candidates(df: pd.DataFrame, hunk: int) -> pd.DataFrame:
     return df.loc[df["hunk"] == hunk]
 
 
-def get_candidates(df: pd.DataFrame, bugid: str) -> pd.DataFrame:
-    """Returns the subset of `df` containing candidate patches for a specific bugid and all its hunks"""
-    return df.loc[df["bugid"] == bugid]
-
-
-def insert_patch(patch, source_file_path, target_file_path, bug_line, bug_len, indent):
-    with open(source_file_path, encoding="cp1256") as file:
-        lines = file.readlines()
-    if bug_len == 0:
-        lines.insert(bug_line, indent + patch + "\n")
-    else:
-        lines[bug_line - 1 : (bug_line - 1) + bug_len] = indent + patch + "\n"
-
-    try:
-        with open(target_file_path, "w", encoding="cp1256") as file:
-            file.writelines(lines)
-    except UnicodeEncodeError:
-        with open(target_file_path, "w", encoding="utf-8") as file:
-            file.writelines(lines)
-
-
 class Status(Enum):
     PLAUSIBLE = auto()
     COMPILABLE = auto()
     TIMEOUT = auto()
     UNCOMPILABLE = auto()
+    RESOURCE_LIMIT = auto()
 
 
-def run_tests_for_multi(bugid: str, project_dir: Path) -> tuple[Status, int | None]:
-    timeout = 300  # seconds
-
+def run_tests_for_multi(
+    bugid: str,
+    project_dir: Path,
+    timeout: float,
+    shards: Optional[TestShards] = None,
+) -> tuple[Status, int | None]:
     compile_result = run_d4j_cmd(f"compile -w {project_dir}")
     if compile_result.returncode != 0:
         return Status.UNCOMPILABLE, None
 
-    # Run relevant tests
-    result = run_d4j_cmd(f"test -r -w {project_dir}", timeout=timeout)
+    # Run relevant tests, all of them as the search compares failing test counts
+    try:
+        result = run_relevant_tests(project_dir, timeout, shards=shards)
+    except LimitExceeded:
+        return Status.RESOURCE_LIMIT, None
     if result.returncode == 124:
         return Status.TIMEOUT, None
     elif result.stdout.strip() != "Failing tests: 0":
@@ -129,18 +206,70 @@ def run_tests_for_multi(bugid: str, project_dir: Path) -> tuple[Status, int | No
     return Status.PLAUSIBLE, 0
 
 
-def run_tests(bugid: str, project_dir: Path, trigger_tests: list[str]) -> Status:
-    timeout = 300  # seconds
+def get_test_result(
+    status: Status,
+    failed_count: Optional[int],
+    validation_time: float,
+    timeout: float,
+) -> TestResult:
+    return TestResult(
+        status is Status.PLAUSIBLE,
+        failed_count,
+        {
+            "plausible": status is Status.PLAUSIBLE,
+            "compilable": status is not Status.UNCOMPILABLE,
+            "timeout": status is Status.TIMEOUT,
+            "timeout_limit": timeout if status is Status.TIMEOUT else np.nan,
+            "resource_limit": status is Status.RESOURCE_LIMIT,
+            "validation_time": validation_time,
+        },
+    )
+
 
+def compile_project(project_dir: Path) -> tuple[bool, str]:
     compile_result = run_d4j_cmd(f"compile -w {project_dir}")
-    if compile_result.returncode != 0:
+    return (
+        compile_result.returncode == 0,
+        compile_result.stdout + compile_result.stderr,
+    )
+
+
+def run_tests(
+    bugid: str,
+    project_dir: Path,
+    trigger_tests: list[str],
+    timeout: float,
+    selected_tests: Sequence[str] = (),
+    shards: Optional[TestShards] = None,
+) -> Status:
+    compiled, _ = compile_project(project_dir)
+    if not compiled:
         return Status.UNCOMPILABLE
 
-    # Run triggering tests
-    for trigger_test in trigger_tests:
-        result = run_d4j_cmd(
-            f"test -t {trigger_test} -w {project_dir}", timeout=timeout
-        )
+    return run_compiled_tests(
+        project_dir, trigger_tests, timeout, None, selected_tests, shards
+    )
+
+
+def run_compiled_tests(
+    project_dir: Path,
+    trigger_tests: list[str],
+    timeout: float,
+    env: Optional[dict] = None,
+    selected_tests: Sequence[str] = (),
+    shards: Optional[TestShards] = None,
+) -> Status:
+    # Run triggering tests, then the test classes covering the patched methods
+    for test in [*trigger_tests, *selected_tests]:
+        try:
+            result = run_d4j_cmd(
+                f"test -t {test} -w {project_dir}",
+                timeout=timeout,
+                env=env,
+                sandboxed=True,
+            )
+        except LimitExceeded:
+            return Status.RESOURCE_LIMIT
 
         if result.returncode == 124:
             return Status.TIMEOUT
@@ -148,7 +277,12 @@ def run_tests(bugid: str, project_dir: Path, trigger_tests: list[str]) -> Status
             return Status.COMPILABLE
 
     # Run relevant tests
-    result = run_d4j_cmd(f"test -r -w {project_dir}", timeout=timeout)
+    try:
+        result = run_relevant_tests(
+            project_dir, timeout, env, shards=shards, stop_on_failure=True
+        )
+    except LimitExceeded:
+        return Status.RESOURCE_LIMIT
     if result.returncode == 124:
         return Status.TIMEOUT
     elif result.stdout.strip() != "Failing tests: 0":
@@ -157,12 +291,141 @@ def run_tests(bugid: str, project_dir: Path, trigger_tests: list[str]) -> Status
     return Status.PLAUSIBLE
 
 
-def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.DataFrame]:
-    # Load if already processed
-    save_file_path = save_state_dir / f"{bugid}.jsonl"
-    if save_file_path.exists():
-        return
+def run_relevant_tests(
+    project_dir: Path,
+    timeout: float,
+    env: Optional[dict] = None,
+    shards: Optional[TestShards] = None,
+    stop_on_failure: bool = False,
+) -> subprocess.CompletedProcess[str]:
+    """Runs the relevant tests with `defects4j test -r`, or in shards if given, whose
+    result is reported as Defects4J does"""
+
+    if shards is None:
+        return run_d4j_cmd(
+            f"test -r -w {project_dir}", timeout=timeout, env=env, sandboxed=True
+        )
+
+    result = shards.run(project_dir, timeout, env, stop_on_failure)
+    if result.timed_out:
+        return subprocess.CompletedProcess([], 124, "", "")
+    elif result.failed_count is None:
+        return subprocess.CompletedProcess([], 1, "", "")
+    return subprocess.CompletedProcess(
+        [], 0, f"Failing tests: {result.failed_count}\n", ""
+    )
+
+
+def get_test_shards(
+    bugid: str, project_dir: Path, properties: dict[str, str]
+) -> Optional[TestShards]:
+    """Shards of the relevant test classes of a bug checked out in `project_dir`, or
+    `None` to run them with Defects4J"""
+
+    if test_shards <= 1:
+        return None
+
+    # The test classpath holds absolute paths into the checkout
+    classpath = run_d4j_cmd(f"export -p cp.test -w {project_dir}", check=True)
+    return TestShards(
+        build_shard_runner(shard_runner_dir, junit_jar_path),
+        [*classpath.stdout.strip().split(":"), str(junit_jar_path)],
+        properties["tests.relevant"].splitlines(),
+        class_runtimes_dir / f"{bugid}.json",
+        test_shards,
+        sandbox,
+    )
+
+
+def measure_reference_runtime(project_dir: Path) -> Optional[float]:
+    """Times the relevant tests of the unpatched buggy version, `None` if they time out"""
+
+    run_d4j_cmd(f"compile -w {project_dir}")
+
+    start_timer = timeit.default_timer()
+    result = run_d4j_cmd(f"test -r -w {project_dir}", timeout=timeout_ceiling)
+    end_timer = timeit.default_timer()
+
+    if result.returncode == 124:
+        return None
+    return end_timer - start_timer
+
 
+def measure_test_coverage(project_dir: Path, test_class: str) -> Optional[dict]:
+    """Methods executed by a test class on the buggy version, `None` if its coverage
+    couldn't be measured"""
+
+    report_path = project_dir / "coverage.xml"
+    report_path.unlink(missing_ok=True)
+    result = run_d4j_cmd(
+        f"coverage -t {test_class} -w {project_dir}", timeout=timeout_ceiling
+    )
+    if result.returncode != 0 or not report_path.exists():
+        return None
+
+    return parse_cobertura_methods(report_path)
+
+
+def get_selected_tests(
+    bugid: str, project_dir: Path, properties: dict[str, str], hunks: list
+) -> list[str]:
+    """Relevant test classes that cover the hunks of a bug, or none if there are more
+    than `max_selected_tests`, as each class is a separate Defects4J run"""
+
+    if not use_test_selection:
+        return []
+
+    coverage = get_coverage(
+        coverage_dir,
+        bugid,
+        properties["tests.relevant"].splitlines(),
+        lambda test_class: measure_test_coverage(project_dir, test_class),
+    )
+    selected_tests = select_tests(
+        coverage,
+        [(hunk["source_path"], *hunk["removed_line_numbers_range"]) for hunk in hunks],
+    )
+    return selected_tests if len(selected_tests) <= max_selected_tests else []
+
+
+def get_bug_timeout(bugid: str, project_dir: Path) -> float:
+    """Returns the timeout of candidate test runs based on the bug's reference runtime"""
+
+    reference_runtime = get_reference_runtime(
+        reference_runtimes_dir, bugid, lambda: measure_reference_runtime(project_dir)
+    )
+    return get_timeout(
+        reference_runtime, timeout_factor, timeout_floor, timeout_ceiling
+    )
+
+
+def apply_patch(
+    candidates: CandidateSlice, bugid: str, hunks: list
+) -> Optional[pd.DataFrame]:
+    with StateStore(state_db_path, shared=use_work_queue) as state_store:
+        # Skip if already processed
+        if state_store.is_done(bugid):
+            return
+
+        with worker_workspace.track(bugid):
+            validate_candidates(candidates.load(), bugid, hunks, state_store)
+        state_store.mark_done(bugid)
+
+
+def validate_queued_bugs(candidate_slices: dict, bugs_metadata: dict) -> None:
+    """Validates the bugs leased from the work queue until all are validated"""
+
+    run_worker(
+        work_queue_path,
+        lambda bugid: apply_patch(candidate_slices[bugid], bugid, bugs_metadata[bugid]),
+    )
+
+
+def validate_candidates(
+    cp_df: pd.DataFrame, bugid: str, hunks: list, state_store: StateStore
+) -> None:
+    # Buggy source files are read once per bug
+    patch_applier = PatchApplier(source_encodings)
     pid = threading.get_ident()
     project_name, bug_number = bugid.split()
 
@@ -212,7 +475,7 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
         or bugid in bugs_list
     ):
         # Checkout the buggy version
-        checkout_dir = d4j_tmp_dir / f"{pid}/checkout"
+        checkout_dir = worker_workspace.path / f"{pid}/checkout"
         checkout_dir.mkdir(parents=True, exist_ok=True)
         checkout_source(project_name, bug_number, True, checkout_dir)
 
@@ -242,50 +505,111 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
 
         # Copy initial file to a temp directory
         source_file_path = (
-            d4j_tmp_dir / str(pid) / "sources" / bugid / hunk["source_path"]
+            worker_workspace.path / str(pid) / "sources" / bugid / hunk["source_path"]
         )
         source_file_path.parent.mkdir(parents=True, exist_ok=False)
         shutil.copyfile(target_file_path, source_file_path)
 
-        trigger_tests = run_d4j_cmd(
-            f"export -p tests.trigger -w {checkout_dir}"
-        ).stdout.splitlines()
+        properties = load_properties(bugid, checkout_dir)
+        trigger_tests = properties["tests.trigger"].splitlines()
 
         indent_size = len(hunk["added_lines"]) - len(hunk["added_lines"].lstrip(" \t"))
         indent = hunk["added_lines"][:indent_size]
 
-        classes_target_dir = run_d4j_cmd(
-            f"export -p dir.bin.classes -w {checkout_dir}"
-        ).stdout
-        tests_target_dir = run_d4j_cmd(
-            f"export -p dir.bin.tests -w {checkout_dir}"
-        ).stdout
+        timeout = get_bug_timeout(bugid, checkout_dir)
+        selected_tests = get_selected_tests(bugid, checkout_dir, properties, [hunk])
+        shards = get_test_shards(bugid, checkout_dir, properties)
+
+        classes_target_dir = properties["dir.bin.classes"]
+        tests_target_dir = properties["dir.bin.tests"]
 
-        for index, patch in bug_hunk_subset_df["decoded_sequences"].items():
-            insert_patch(
-                patch, source_file_path, target_file_path, bug_line, bug_len, indent
+        state_store.add_candidates(bugid, "single", cp_df)
+        if state_store.has_plausible(bugid, "single"):
+            return
+        tested = state_store.tested_indices(bugid, "single")
+
+        def clean_target_dirs() -> None:
+            shutil.rmtree(checkout_dir / classes_target_dir, ignore_errors=True)
+            shutil.rmtree(checkout_dir / tests_target_dir, ignore_errors=True)
+
+        def compile_schemata() -> tuple[bool, str]:
+            clean_target_dirs()
+            return compile_project(checkout_dir)
+
+        patches = {
+            index: patch
+            for index, patch in bug_hunk_subset_df["decoded_sequences"].items()
+            if str(index) not in tested
+        }
+        if use_schemata:
+            schemata = JavaSchemata(
+                patch_applier,
+                source_file_path,
+                target_file_path,
+                bug_line,
+                bug_len,
+                indent,
+            )
+            schemata_statuses = schemata.iter_candidates(
+                patches, compile_schemata, schemata_group_size, schemata_max_compiles
             )
+        else:
+            schemata_statuses = ((index, SchemataStatus.SEPARATE) for index in patches)
 
+        for index, schemata_status in schemata_statuses:
             start_timer = timeit.default_timer()
-            passed = run_tests(bugid, checkout_dir, trigger_tests)
+            if schemata_status is SchemataStatus.COMPILED:
+                passed = run_compiled_tests(
+                    checkout_dir,
+                    trigger_tests,
+                    timeout,
+                    get_candidate_env(index),
+                    selected_tests,
+                    shards,
+                )
+                # Its branch may compile where the candidate alone doesn't
+                if passed is Status.PLAUSIBLE and not schemata.compiles_alone(
+                    patches[index], compile_schemata
+                ):
+                    passed = Status.UNCOMPILABLE
+            elif schemata_status is SchemataStatus.UNCOMPILABLE:
+                passed = Status.UNCOMPILABLE
+            else:
+                patch_applier.apply(
+                    source_file_path,
+                    target_file_path,
+                    [
+                        get_replacement(
+                            bug_line, bug_len, indent + patches[index] + "\n"
+                        )
+                    ],
+                )
+                passed = run_tests(
+                    bugid, checkout_dir, trigger_tests, timeout, selected_tests, shards
+                )
             end_timer = timeit.default_timer()
             cp_df.at[index, "validation_time"] = end_timer - start_timer
 
             if passed is Status.PLAUSIBLE:
                 cp_df.at[index, "plausible"] = True
                 cp_df.at[index, "compilable"] = True
-                break
             elif passed is Status.COMPILABLE:
                 cp_df.at[index, "compilable"] = True
             elif passed is Status.TIMEOUT:
                 cp_df.at[index, "timeout"] = True
+                cp_df.at[index, "timeout_limit"] = timeout
+                cp_df.at[index, "compilable"] = True
+            elif passed is Status.RESOURCE_LIMIT:
+                cp_df.at[index, "resource_limit"] = True
                 cp_df.at[index, "compilable"] = True
 
-            # Clean target directories
-            shutil.rmtree(checkout_dir / classes_target_dir, ignore_errors=True)
-            shutil.rmtree(checkout_dir / tests_target_dir, ignore_errors=True)
+            state_store.save_candidate(bugid, "single", index, cp_df.loc[index])
+            if cp_df.at[index, "plausible"]:
+                break
 
-        cp_df.to_json(save_state_dir / f"{bugid}.jsonl", orient="records", lines=True)
+            # Compiled schemata are reused by the next candidates of their group
+            if schemata_status is SchemataStatus.SEPARATE:
+                clean_target_dirs()
 
     else:
         if bugid in ["Gson 14"]:
@@ -304,6 +628,8 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
                 "plausible",
                 "compilable",
                 "timeout",
+                "timeout_limit",
+                "resource_limit",
                 "validation_time",
             ]
             else list
@@ -319,41 +645,54 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
         )
 
         ###################################################################
-        checkout_dir = d4j_tmp_dir / f"{pid}/checkout"
+        checkout_dir = worker_workspace.path / f"{pid}/checkout"
         checkout_dir.mkdir(parents=True, exist_ok=True)
         checkout_source(project_name, bug_number, True, checkout_dir)
 
-        trigger_tests = run_d4j_cmd(
-            f"export -p tests.trigger -w {checkout_dir}"
-        ).stdout.splitlines()
+        properties = load_properties(bugid, checkout_dir)
+        trigger_tests = properties["tests.trigger"].splitlines()
 
-        classes_target_dir = run_d4j_cmd(
-            f"export -p dir.bin.classes -w {checkout_dir}"
-        ).stdout
-        tests_target_dir = run_d4j_cmd(
-            f"export -p dir.bin.tests -w {checkout_dir}"
-        ).stdout
+        timeout = get_bug_timeout(bugid, checkout_dir)
+        selected_tests = get_selected_tests(bugid, checkout_dir, properties, hunks)
+        shards = get_test_shards(bugid, checkout_dir, properties)
+
+        classes_target_dir = properties["dir.bin.classes"]
+        tests_target_dir = properties["dir.bin.tests"]
 
         for hunk in hunks:
             target_file_path = checkout_dir / hunk["source_path"]
             source_file_path = (
-                d4j_tmp_dir / str(pid) / "sources" / bugid / hunk["source_path"]
+                worker_workspace.path
+                / str(pid)
+                / "sources"
+                / bugid
+                / hunk["source_path"]
             )
             source_file_path.parent.mkdir(parents=True, exist_ok=True)
             shutil.copyfile(target_file_path, source_file_path)
 
+        state_store.add_candidates(bugid, "combined", new_cp_df)
+        if state_store.has_plausible(bugid, "combined"):
+            return
+        tested = state_store.tested_indices(bugid, "combined")
+
         # Loop to iterate on dataframe rows
         for index, patches in new_cp_df["decoded_sequences"].items():
-            bugs_lens = defaultdict(list)
+            if str(index) in tested:
+                continue
+
+            hunk_replacements = []
             # Loop to apply patches to each hunk
-            for hunk_num, (hunk, patch) in enumerate(
-                reversed(list(zip(hunks, patches)))
-            ):
+            for hunk, patch in zip(hunks, patches):
                 target_file_path = checkout_dir / hunk["source_path"]
                 bug_line, bug_len = hunk["removed_line_numbers_range"]
 
                 source_file_path = (
-                    d4j_tmp_dir / str(pid) / "sources" / bugid / hunk["source_path"]
+                    worker_workspace.path
+                    / str(pid)
+                    / "sources"
+                    / bugid
+                    / hunk["source_path"]
                 )
 
                 indent_size = len(hunk["added_lines"]) - len(
@@ -361,43 +700,46 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
                 )
                 indent = hunk["added_lines"][:indent_size]
 
-                insert_patch(
-                    patch,
-                    target_file_path
-                    if target_file_path in bugs_lens
-                    else source_file_path,
-                    target_file_path,
-                    bug_line,
-                    bug_len,
-                    indent,
+                hunk_replacements.append(
+                    (
+                        source_file_path,
+                        target_file_path,
+                        get_replacement(bug_line, bug_len, indent + patch + "\n"),
+                    )
                 )
 
-                bugs_lens[target_file_path].append(bug_len)
+            patch_applier.apply_hunks(hunk_replacements)
 
             # call the testing infrastructure
             start_timer = timeit.default_timer()
-            passed = run_tests(bugid, checkout_dir, trigger_tests)
+            passed = run_tests(
+                bugid, checkout_dir, trigger_tests, timeout, selected_tests, shards
+            )
             end_timer = timeit.default_timer()
             new_cp_df.at[index, "validation_time"] = end_timer - start_timer
 
             if passed is Status.PLAUSIBLE:
                 new_cp_df.at[index, "plausible"] = True
                 new_cp_df.at[index, "compilable"] = True
-                break
             elif passed is Status.COMPILABLE:
                 new_cp_df.at[index, "compilable"] = True
             elif passed is Status.TIMEOUT:
                 new_cp_df.at[index, "timeout"] = True
+                new_cp_df.at[index, "timeout_limit"] = timeout
                 new_cp_df.at[index, "compilable"] = True
+            elif passed is Status.RESOURCE_LIMIT:
+                new_cp_df.at[index, "resource_limit"] = True
+                new_cp_df.at[index, "compilable"] = True
+
+            state_store.save_candidate(bugid, "combined", index, new_cp_df.loc[index])
+            if new_cp_df.at[index, "plausible"]:
+                break
 
             # Clean target directories
             shutil.rmtree(checkout_dir / classes_target_dir, ignore_errors=True)
             shutil.rmtree(checkout_dir / tests_target_dir, ignore_errors=True)
 
-        if not new_cp_df.empty and new_cp_df["plausible"].any():
-            new_cp_df.to_json(
-                save_state_dir / f"{bugid}.jsonl", orient="records", lines=True
-            )
+        if state_store.has_plausible(bugid, "combined"):
             return
 
         ###################################################################
@@ -412,6 +754,8 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
                 "plausible",
                 "compilable",
                 "timeout",
+                "timeout_limit",
+                "resource_limit",
                 "validation_time",
             ]:
                 agg_mapping[col] = "first"
@@ -436,150 +780,116 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
         )
 
         ##########################
-        checkout_dir = d4j_tmp_dir / f"{pid}/checkout"
+        checkout_dir = worker_workspace.path / f"{pid}/checkout"
         checkout_dir.mkdir(parents=True, exist_ok=True)
         checkout_source(project_name, bug_number, True, checkout_dir)
 
-        classes_target_dir = run_d4j_cmd(
-            f"export -p dir.bin.classes -w {checkout_dir}"
-        ).stdout
-        tests_target_dir = run_d4j_cmd(
-            f"export -p dir.bin.tests -w {checkout_dir}"
-        ).stdout
+        properties = load_properties(bugid, checkout_dir)
+        classes_target_dir = properties["dir.bin.classes"]
+        tests_target_dir = properties["dir.bin.tests"]
+
+        timeout = get_bug_timeout(bugid, checkout_dir)
+        shards = get_test_shards(bugid, checkout_dir, properties)
 
         for hunk in hunks:
             target_file_path = checkout_dir / hunk["source_path"]
             source_file_path = (
-                d4j_tmp_dir / str(pid) / "sources" / bugid / hunk["source_path"]
+                worker_workspace.path
+                / str(pid)
+                / "sources"
+                / bugid
+                / hunk["source_path"]
             )
             source_file_path.parent.mkdir(parents=True, exist_ok=True)
             shutil.copyfile(target_file_path, source_file_path)
 
         ##########################
 
-        # List to store extracted multi-hunk patches
-        multi_patches_list = []
-
-        _, running_failed_count = run_tests_for_multi(bugid, checkout_dir)
-
-        running_plausible_df = None
-
+        hunk_candidates = []
+        source_candidates = []
         for i in range(len(hunks)):
-            if running_failed_count == 0:
-                break
-
-            hunk_cp_df = get_hunk_candidates(cp_df, i)
-            if bugid in ["Gson 14"] and i == 1:
-                hunk_cp_df = get_hunk_candidates(cp_df, i + 1)
+            # Gson 14 keeps hunks 0 and 2, while the template only lists the kept
+            # hunks
+            h = i + 1 if bugid in ["Gson 14"] and i == 1 else i
+            hunk_candidates.append(get_candidates(get_hunk_candidates(cp_df, h)))
+            source_candidates.append(
+                get_source_candidate(
+                    template_df.at[0, "source"][i],
+                    template_df.at[0, "normalized_source"][i],
+                )
+            )
 
-            for row in hunk_cp_df.itertuples():
-                # Clean target directories
-                shutil.rmtree(checkout_dir / classes_target_dir, ignore_errors=True)
-                shutil.rmtree(checkout_dir / tests_target_dir, ignore_errors=True)
+        def test_patches(patches: list[str]) -> TestResult:
+            # Clean target directories
+            shutil.rmtree(checkout_dir / classes_target_dir, ignore_errors=True)
+            shutil.rmtree(checkout_dir / tests_target_dir, ignore_errors=True)
 
-                if i == 0:
-                    row_df = pd.DataFrame(
-                        columns=template_df.columns, data=deepcopy(template_df.values)
-                    )
-                else:
-                    row_df = pd.DataFrame(
-                        columns=running_plausible_df.columns,
-                        data=deepcopy(running_plausible_df.values),
-                    )
+            hunk_replacements = []
 
-                row_df.at[0, "checkpoint"].append(row.checkpoint)
-                row_df.at[0, "decoded_sequences"].append(row.decoded_sequences)
-                row_df.at[0, "normalized_patch"].append(row.normalized_patch)
-                row_df.at[0, "sequences_scores"].append(row.sequences_scores)
-                row_df.at[0, "rank"].append(row.rank)
-                row_df.at[0, "exact_match"].append(row.exact_match)
+            # Patches start from the first hunk, so later hunks keep their buggy code
+            for hunk, patch in zip(hunks, patches):
+                target_file_path = checkout_dir / hunk["source_path"]
+                bug_line, bug_len = hunk["removed_line_numbers_range"]
 
-                assert (v := len(row_df.at[0, "decoded_sequences"])) == i + 1, (
-                    f"Hunk and patch count mismatch: {i + 1}, {v}"
+                source_file_path = (
+                    worker_workspace.path
+                    / str(pid)
+                    / "sources"
+                    / bugid
+                    / hunk["source_path"]
                 )
 
-                bugs_lens = defaultdict(list)
-
-                # When we are iterating over previous hunks, we don't have to change later hunks
-                for hunk, patch in reversed(
-                    list(zip(hunks, row_df["decoded_sequences"].item()))
-                ):
-                    target_file_path = checkout_dir / hunk["source_path"]
-                    bug_line, bug_len = hunk["removed_line_numbers_range"]
+                indent_size = len(hunk["added_lines"]) - len(
+                    hunk["added_lines"].lstrip(" \t")
+                )
+                indent = hunk["added_lines"][:indent_size]
 
-                    source_file_path = (
-                        d4j_tmp_dir / str(pid) / "sources" / bugid / hunk["source_path"]
+                hunk_replacements.append(
+                    (
+                        source_file_path,
+                        target_file_path,
+                        get_replacement(bug_line, bug_len, indent + patch + "\n"),
                     )
+                )
 
-                    indent_size = len(hunk["added_lines"]) - len(
-                        hunk["added_lines"].lstrip(" \t")
-                    )
-                    indent = hunk["added_lines"][:indent_size]
+            patch_applier.apply_hunks(hunk_replacements)
 
-                    insert_patch(
-                        patch,
-                        target_file_path
-                        if target_file_path in bugs_lens
-                        else source_file_path,
-                        target_file_path,
-                        bug_line,
-                        bug_len,
-                        indent,
-                    )
+            # Call the testing infrastructure
+            start_timer = timeit.default_timer()
+            status, failed_count = run_tests_for_multi(
+                bugid, checkout_dir, timeout, shards
+            )
+            end_timer = timeit.default_timer()
 
-                    bugs_lens[target_file_path].append(bug_len)
-
-                # Call the testing infrastructure
-                start_timer = timeit.default_timer()
-                status, failed_count = run_tests_for_multi(bugid, checkout_dir)
-                end_timer = timeit.default_timer()
-                row_df.at[0, "validation_time"] = end_timer - start_timer
-
-                if status is Status.PLAUSIBLE:
-                    row_df.at[0, "plausible"] = True
-                    row_df.at[0, "compilable"] = True
-                    running_failed_count = 0
-                    multi_patches_list.append(row_df)
-                    break
-                elif status is Status.COMPILABLE:
-                    row_df.at[0, "compilable"] = True
-                    if failed_count and failed_count < running_failed_count:
-                        running_failed_count = failed_count
-                        running_plausible_df = pd.DataFrame(
-                            columns=row_df.columns, data=deepcopy(row_df.values)
-                        )
-                        multi_patches_list.append(row_df)
+            return get_test_result(
+                status, failed_count, end_timer - start_timer, timeout
+            )
 
-                        break
-                elif status is Status.TIMEOUT:
-                    row_df.at[0, "timeout"] = True
-                    row_df.at[0, "compilable"] = True
+        template = template_df.iloc[0].to_dict()
 
-                multi_patches_list.append(row_df)
+        def save_trial(trial: Trial) -> None:
+            state_store.save_candidate(
+                bugid,
+                multi_hunk_strategy,
+                len(search.trials),
+                pd.Series(get_trial_record(template, trial)),
+            )
 
-            else:
-                row_df.at[0, "checkpoint"][-1] = "manual"
-                row_df.at[0, "decoded_sequences"][-1] = row.source
-                row_df.at[0, "normalized_patch"][-1] = row.normalized_source
-                row_df.at[0, "sequences_scores"][-1] = None
-                row_df.at[0, "rank"][-1] = None
-                row_df.at[0, "exact_match"][-1] = False
-                running_plausible_df = pd.DataFrame(
-                    columns=row_df.columns, data=deepcopy(row_df.values)
-                )
+        # The search restarts from scratch when resumed
+        state_store.clear_phase(bugid, multi_hunk_strategy)
 
-        # Merge and save to disk
-        new_cp_df = pd.concat(
-            [
-                new_cp_df if not new_cp_df.empty else None,
-                *multi_patches_list,
-            ]
+        search = MultiHunkSearch(
+            hunk_candidates,
+            source_candidates,
+            test_patches,
+            multi_hunk_test_budget,
+            multi_hunk_beam_width,
+            on_trial=save_trial,
+        )
+        result = search.run(multi_hunk_strategy)
+        state_store.save_search_stats(
+            bugid, result.strategy, result.test_runs, result.runs_to_plausible
         )
-
-        if not new_cp_df.empty:
-            new_cp_df.to_json(
-                save_state_dir / f"{bugid}.jsonl", orient="records", lines=True
-            )
 
         #######################################################
 
@@ -589,7 +899,11 @@ def get_file_path(dir_path: Path, class_name: str) -> Path:
 
 
 def run_d4j_cmd(
-    cmd: str, check: bool = False, timeout: Optional[int] = None
+    cmd: str,
+    check: bool = False,
+    timeout: Optional[int] = None,
+    env: Optional[dict] = None,
+    sandboxed: bool = False,
 ) -> subprocess.CompletedProcess[str]:
     def kill(proc_pid):
         parent_proc = psutil.Process(proc_pid)
@@ -600,11 +914,24 @@ def run_d4j_cmd(
     d4j_cmd = f"perl {d4j_bin} {cmd}"
     args = shlex.split(d4j_cmd)
 
+    # Tests of candidates run in the sandbox, which raises `LimitExceeded`
+    if sandboxed:
+        try:
+            result = sandbox.run(
+                args, capture_output=True, text=True, timeout=timeout, env=env
+            )
+        except subprocess.TimeoutExpired:
+            result = subprocess.CompletedProcess(args, 124, "", "")
+        if check and result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, args)
+        return result
+
     process = subprocess.Popen(
         args,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         text=True,
+        env=env,
     )
 
     try:
@@ -635,47 +962,57 @@ def main():
     n_jobs = 2
     mp.set_start_method("spawn")
 
-    with open(gen_dir / bugs_metadata_file) as meta_file:
-        bugs_metadata = ChainMap(*[json.loads(line) for line in meta_file][::-1])
+    bugs_metadata = read_hunks(gen_dir / bugs_metadata_file)
 
-    candidate_patches_df = pd.read_json(
-        output_dir / f"final_candidates_{output_size}.jsonl",
-        orient="records",
-        lines=True,
+    candidate_patches_df = read_candidates(
+        output_dir / f"{candidates_order}_candidates_{output_size}.parquet"
     )
     candidate_patches_df["plausible"] = False
     candidate_patches_df["compilable"] = False
     candidate_patches_df["timeout"] = False
+    candidate_patches_df["timeout_limit"] = np.nan
+    candidate_patches_df["resource_limit"] = False
     candidate_patches_df["validation_time"] = np.nan
 
-    shutil.rmtree(d4j_tmp_dir, ignore_errors=True)
-    save_state_dir.mkdir(exist_ok=True)
+    # Remove the workspaces left by crashed runs
+    worker_workspace.clean()
+    # Create the state database before the workers connect to it
+    StateStore(state_db_path, shared=use_work_queue).close()
 
-    with tqdm_joblib(tqdm(total=len(bugs_metadata), disable=False)):
+    # Workers memory-map the candidates file and copy out only their bug's rows
+    candidate_slices = write_candidate_slices(
+        candidate_patches_df, bugs_metadata, candidates_file_path
+    )
+
+    if use_work_queue:
+        with WorkQueue(work_queue_path) as work_queue:
+            work_queue.add(bugs_metadata)
         Parallel(n_jobs=n_jobs, backend="multiprocessing")(
-            delayed(apply_patch)(
-                deepcopy(get_candidates(candidate_patches_df, bugid)), bugid, hunks
-            )
-            for bugid, hunks in bugs_metadata.items()
+            delayed(validate_queued_bugs)(candidate_slices, bugs_metadata)
+            for _ in range(n_jobs)
         )
+        with WorkQueue(work_queue_path) as work_queue:
+            print("Work queue:", work_queue.get_counts())
+    else:
+        with tqdm_joblib(tqdm(total=len(bugs_metadata), disable=False)):
+            Parallel(n_jobs=n_jobs, backend="multiprocessing")(
+                delayed(apply_patch)(candidate_slices[bugid], bugid, hunks)
+                for bugid, hunks in bugs_metadata.items()
+            )
 
-    cp_dfs = [
-        pd.read_json(cp, orient="records", lines=True)
-        for cp in sorted(save_state_dir.iterdir())
-    ]
-    concatenated_cp_df = pd.concat(cp_dfs)
-
-    concatenated_cp_df.to_json(
-        output_dir / f"plausible_candidates_{output_size}.jsonl",
-        orient="records",
-        lines=True,
-    )
-
-    bugs_with_plausible_patch = (
-        concatenated_cp_df.groupby("bugid")["plausible"].any().groupby("bugid").any()
-    )
+    with StateStore(state_db_path, shared=use_work_queue) as state_store:
+        state_store.export_jsonl(
+            output_dir / f"plausible_candidates_{output_size}.jsonl"
+        )
+        write_plausible_candidates(
+            state_store.iter_records(),
+            output_dir / f"plausible_candidates_{output_size}.parquet",
+        )
+        bugs_with_plausible_patch = state_store.get_plausible_bugs()
+        search_stats = state_store.get_search_stats()
     print(bugs_with_plausible_patch)
     print(bugs_with_plausible_patch.value_counts())
+    print(summarize_search_stats(search_stats))
 
 
 if __name__ == "__main__":
@@ -1,12 +1,9 @@
 import contextlib
-import json
 import re
 import shutil
 import subprocess
 import threading
 import timeit
-from collections import ChainMap
-from copy import deepcopy
 from enum import Enum, auto
 from pathlib import Path
 from typing import Optional
@@ -17,16 +14,63 @@ import pandas as pd
 from joblib import Parallel, delayed
 from tqdm import tqdm
 
+from ..columnar import (
+    CandidateSlice,
+    read_candidates,
+    read_hunks,
+    write_candidate_slices,
+    write_plausible_candidates,
+)
 from ..configs import quixbugs_dir, quixbugs_genjava_dir
+from .adaptive_timeout import get_reference_runtime, get_timeout
+from .patch_applier import PatchApplier, get_replacement
+from .sandbox import LimitExceeded, Limits, Sandbox
+from .schemata import JavaSchemata, SchemataStatus, get_candidate_env
+from .state_store import StateStore
+from .workspace_manager import WorkspaceManager
 
 project_dir = quixbugs_dir
 gen_dir = quixbugs_genjava_dir
-bugs_metadata_file = "QuixBugs_Java.jsonl"
+bugs_metadata_file = "QuixBugs_Java.parquet"
 model = "multimend"
 output_dir = gen_dir / f"outputs-{model}"
-temp_dir = output_dir / "temp"
-save_state_dir = output_dir / "save-state"
+# Scratch files of each worker process, on a tmpfs when enough memory is free (see
+# `workspace_manager`)
+worker_workspace = WorkspaceManager(
+    "quixbugs-java", output_dir / "temp", 1 << 30, output_dir / "workspace-usage.jsonl"
+)
+state_db_path = output_dir / "validation-state.db"
+reference_runtimes_dir = gen_dir / "reference-runtimes"
 output_size = 100
+# Candidates are validated in the order of `combine_checkpoints_results` ("final"), or
+# in the order of `rerank_candidates` ("reranked"), once it has run for this dataset
+candidates_order = "final"
+candidates_file_path = output_dir / f"candidates_{output_size}.arrow"
+
+# Candidates are killed at `timeout_factor` times the tests runtime of the buggy
+# program, clamped to [`timeout_floor`, `timeout_ceiling`] seconds
+timeout_factor = 5
+timeout_floor = 10
+timeout_ceiling = 60
+
+# Gradle runs with these limits, also applied to the whole process tree when a
+# cgroup is available (see `sandbox`). Test workers forked by an already running
+# Gradle daemon aren't in that tree.
+sandbox = Sandbox(
+    Limits(
+        memory_bytes=4 << 30,
+        cpu_seconds=4 * timeout_ceiling,
+        max_processes=512,
+        output_bytes=1 << 30,
+    )
+)
+
+# Compile the candidates of a hunk together as mutant schemata (see `schemata`),
+# in groups of `schemata_group_size`, dropping the branches with errors for up to
+# `schemata_max_compiles` compilations per group
+use_schemata = True
+schemata_group_size = 100
+schemata_max_compiles = 5
 
 rem_file_path = gen_dir / "rem.txt"
 add_file_path = gen_dir / "add.txt"
@@ -78,33 +122,15 @@ def get_hunk_candidates(df: pd.DataFrame, hunk: int) -> pd.DataFrame:
     return df.loc[df["hunk"] == hunk]
 
 
-def get_candidates(df: pd.DataFrame, bugid: str) -> pd.DataFrame:
-    """Returns the subset of `df` containing candidate patches for a specific bugid and all its hunks"""
-    return df.loc[df["bugid"] == bugid]
-
-
-def insert_patch(patch, source_file_path, target_file_path, bug_line, bug_len, indent):
-    with open(source_file_path, "r") as file:
-        lines = file.readlines()
-    if bug_len == 0:
-        lines.insert(bug_line, indent + patch + "\n")
-    else:
-        lines[bug_line - 1 : (bug_line - 1) + bug_len] = indent + patch + "\n"
-
-    with open(target_file_path, "w") as file:
-        file.writelines(lines)
-
-
 class Status(Enum):
     PLAUSIBLE = auto()
     COMPILABLE = auto()
     TIMEOUT = auto()
     UNCOMPILABLE = auto()
+    RESOURCE_LIMIT = auto()
 
 
-def run_tests(bugid: str, project_dir: Path) -> Status:
-    timeout = 60  # seconds
-
+def compile_project(project_dir: Path) -> tuple[bool, str]:
     compile_args = [
         "gradle",
         "build",
@@ -115,16 +141,21 @@ def run_tests(bugid: str, project_dir: Path) -> Status:
     ]
     comp_result = subprocess.run(
         compile_args,
-        stdout=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
+        text=True,
     )
+    return comp_result.returncode == 0, comp_result.stdout
 
-    if comp_result.returncode != 0:
-        return Status.UNCOMPILABLE
 
+def run_compiled_tests(
+    bugid: str, project_dir: Path, timeout: float, env: Optional[dict] = None
+) -> Status:
+    # `cleanTest` so the tests rerun when only `env` changed
     test_file_name = f"{bugid.upper()}_TEST"
     test_args = [
         "gradle",
+        "cleanTest",
         "test",
         "--fail-fast",
         "--tests",
@@ -133,14 +164,17 @@ def run_tests(bugid: str, project_dir: Path) -> Status:
         str(project_dir),
     ]
     try:
-        result = subprocess.run(
+        result = sandbox.run(
             test_args,
             stdout=subprocess.DEVNULL,
             stderr=subprocess.STDOUT,
             timeout=timeout,
+            env=env,
         )
     except subprocess.TimeoutExpired:
         return Status.TIMEOUT
+    except LimitExceeded:
+        return Status.RESOURCE_LIMIT
 
     if result.returncode == 0:
         return Status.PLAUSIBLE
@@ -148,19 +182,76 @@ def run_tests(bugid: str, project_dir: Path) -> Status:
         return Status.COMPILABLE
 
 
-def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.DataFrame]:
-    # Load if already processed
-    save_file_path = save_state_dir / f"{bugid}.jsonl"
-    if save_file_path.exists():
-        return
+def run_tests(bugid: str, project_dir: Path, timeout: float) -> Status:
+    compiled, _ = compile_project(project_dir)
+    if not compiled:
+        return Status.UNCOMPILABLE
+
+    return run_compiled_tests(bugid, project_dir, timeout)
+
+
+def measure_reference_runtime(bugid: str, project_dir: Path) -> Optional[float]:
+    """Times the tests of the unpatched buggy program, `None` if they time out"""
 
+    compile_args = [
+        "gradle",
+        "build",
+        "-x",
+        "test",
+        "-p",
+        str(project_dir),
+    ]
+    subprocess.run(compile_args, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+
+    test_args = [
+        "gradle",
+        "test",
+        "--fail-fast",
+        "--tests",
+        f"{bugid.upper()}_TEST",
+        "-p",
+        str(project_dir),
+    ]
+    start_timer = timeit.default_timer()
+    try:
+        subprocess.run(
+            test_args,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.STDOUT,
+            timeout=timeout_ceiling,
+        )
+    except subprocess.TimeoutExpired:
+        return None
+    end_timer = timeit.default_timer()
+
+    return end_timer - start_timer
+
+
+def apply_patch(
+    candidates: CandidateSlice, bugid: str, hunks: list
+) -> Optional[pd.DataFrame]:
+    with StateStore(state_db_path) as state_store:
+        # Skip if already processed
+        if state_store.is_done(bugid):
+            return
+
+        with worker_workspace.track(bugid):
+            validate_candidates(candidates.load(), bugid, hunks, state_store)
+        state_store.mark_done(bugid)
+
+
+def validate_candidates(
+    cp_df: pd.DataFrame, bugid: str, hunks: list, state_store: StateStore
+) -> None:
+    # Buggy source files are read once per bug
+    patch_applier = PatchApplier()
     pid = threading.get_ident()
 
     if len(hunks) == 1:
         hunk = hunks[0]
 
         # Copy QuixBugs files to a working directory
-        project_copy_dir = temp_dir / str(pid) / "QuixBugs"
+        project_copy_dir = worker_workspace.path / str(pid) / "QuixBugs"
         copy_dataset_files(project_dir, project_copy_dir)
 
         target_file_path = project_copy_dir / "java_programs" / f"{bugid.upper()}.java"
@@ -176,7 +267,11 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
 
         # Copy initial file to a temp directory
         source_file_path = (
-            temp_dir / str(pid) / "sources" / bugid / f"{bugid.upper()}.java"
+            worker_workspace.path
+            / str(pid)
+            / "sources"
+            / bugid
+            / f"{bugid.upper()}.java"
         )
         source_file_path.parent.mkdir(parents=True, exist_ok=True)
         shutil.copyfile(target_file_path, source_file_path)
@@ -191,29 +286,87 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
         )
         change_test_timeout(timeout, test_file_path, delete_timeout=True)
 
-        for index, patch in bug_hunk_subset_df["decoded_sequences"].items():
-            insert_patch(
-                patch, source_file_path, target_file_path, bug_line, bug_len, indent
+        reference_runtime = get_reference_runtime(
+            reference_runtimes_dir,
+            bugid,
+            lambda: measure_reference_runtime(bugid, project_copy_dir),
+        )
+        timeout = get_timeout(
+            reference_runtime, timeout_factor, timeout_floor, timeout_ceiling
+        )
+
+        state_store.add_candidates(bugid, "single", cp_df)
+        if state_store.has_plausible(bugid, "single"):
+            return
+        tested = state_store.tested_indices(bugid, "single")
+
+        patches = {
+            index: patch
+            for index, patch in bug_hunk_subset_df["decoded_sequences"].items()
+            if str(index) not in tested
+        }
+        if use_schemata:
+            schemata = JavaSchemata(
+                patch_applier,
+                source_file_path,
+                target_file_path,
+                bug_line,
+                bug_len,
+                indent,
             )
+            schemata_statuses = schemata.iter_candidates(
+                patches,
+                lambda: compile_project(project_copy_dir),
+                schemata_group_size,
+                schemata_max_compiles,
+            )
+        else:
+            schemata_statuses = ((index, SchemataStatus.SEPARATE) for index in patches)
 
+        for index, schemata_status in schemata_statuses:
             # call the testing infrastructure
             start_timer = timeit.default_timer()
-            passed = run_tests(bugid, project_copy_dir)
+            if schemata_status is SchemataStatus.COMPILED:
+                passed = run_compiled_tests(
+                    bugid, project_copy_dir, timeout, get_candidate_env(index)
+                )
+                # Its branch may compile where the candidate alone doesn't
+                if passed is Status.PLAUSIBLE and not schemata.compiles_alone(
+                    patches[index], lambda: compile_project(project_copy_dir)
+                ):
+                    passed = Status.UNCOMPILABLE
+            elif schemata_status is SchemataStatus.UNCOMPILABLE:
+                passed = Status.UNCOMPILABLE
+            else:
+                patch_applier.apply(
+                    source_file_path,
+                    target_file_path,
+                    [
+                        get_replacement(
+                            bug_line, bug_len, indent + patches[index] + "\n"
+                        )
+                    ],
+                )
+                passed = run_tests(bugid, project_copy_dir, timeout)
             end_timer = timeit.default_timer()
             cp_df.at[index, "validation_time"] = end_timer - start_timer
 
             if passed is Status.PLAUSIBLE:
                 cp_df.at[index, "plausible"] = True
                 cp_df.at[index, "compilable"] = True
-                break
             elif passed is Status.COMPILABLE:
                 cp_df.at[index, "compilable"] = True
             elif passed is Status.TIMEOUT:
                 cp_df.at[index, "timeout"] = True
+                cp_df.at[index, "timeout_limit"] = timeout
+                cp_df.at[index, "compilable"] = True
+            elif passed is Status.RESOURCE_LIMIT:
+                cp_df.at[index, "resource_limit"] = True
                 cp_df.at[index, "compilable"] = True
 
-        # Save intermediate state
-        cp_df.to_json(save_state_dir / f"{bugid}.jsonl", orient="records", lines=True)
+            state_store.save_candidate(bugid, "single", index, cp_df.loc[index])
+            if cp_df.at[index, "plausible"]:
+                break
 
 
 def copy_dataset_files(dataset_dir, temp_dataset_dir):
@@ -250,45 +403,44 @@ def main():
 
     n_jobs = 4
 
-    with open(gen_dir / bugs_metadata_file) as meta_file:
-        bugs_metadata = ChainMap(*[json.loads(line) for line in meta_file][::-1])
+    bugs_metadata = read_hunks(gen_dir / bugs_metadata_file)
 
-    candidate_patches_df = pd.read_json(
-        output_dir / f"final_candidates_{output_size}.jsonl",
-        orient="records",
-        lines=True,
+    candidate_patches_df = read_candidates(
+        output_dir / f"{candidates_order}_candidates_{output_size}.parquet"
     )
     candidate_patches_df["plausible"] = False
     candidate_patches_df["compilable"] = False
     candidate_patches_df["timeout"] = False
+    candidate_patches_df["timeout_limit"] = np.nan
+    candidate_patches_df["resource_limit"] = False
     candidate_patches_df["validation_time"] = np.nan
 
-    shutil.rmtree(temp_dir, ignore_errors=True)
+    # Remove the workspaces left by crashed runs
+    worker_workspace.clean()
 
-    save_state_dir.mkdir(parents=True, exist_ok=True)
+    # Create the state database before the workers connect to it
+    StateStore(state_db_path).close()
+
+    # Workers memory-map the candidates file and copy out only their bug's rows
+    candidate_slices = write_candidate_slices(
+        candidate_patches_df, bugs_metadata, candidates_file_path
+    )
 
     with tqdm_joblib(tqdm(total=len(bugs_metadata))):
         Parallel(n_jobs=n_jobs, backend="threading")(
-            delayed(apply_patch)(
-                deepcopy(get_candidates(candidate_patches_df, bugid)), bugid, hunks
-            )
+            delayed(apply_patch)(candidate_slices[bugid], bugid, hunks)
             for bugid, hunks in bugs_metadata.items()
         )
 
-    cp_dfs = [
-        pd.read_json(cp, orient="records", lines=True)
-        for cp in sorted(save_state_dir.iterdir())
-    ]
-    concatenated_cp_df = pd.concat(cp_dfs, ignore_index=True)
-    concatenated_cp_df.to_json(
-        output_dir / f"plausible_candidates_{output_size}.jsonl",
-        orient="records",
-        lines=True,
-    )
-
-    bugs_with_plausible_patch = (
-        concatenated_cp_df.groupby("bugid")["plausible"].any().groupby("bugid").any()
-    )
+    with StateStore(state_db_path) as state_store:
+        state_store.export_jsonl(
+            output_dir / f"plausible_candidates_{output_size}.jsonl"
+        )
+        write_plausible_candidates(
+            state_store.iter_records(),
+            output_dir / f"plausible_candidates_{output_size}.parquet",
+        )
+        bugs_with_plausible_patch = state_store.get_plausible_bugs()
     print(bugs_with_plausible_patch)
     print(bugs_with_plausible_patch.value_counts())
 
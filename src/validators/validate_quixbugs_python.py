@@ -1,12 +1,9 @@
 import contextlib
-import json
 import shutil
 import subprocess
 import threading
 import time
 import timeit
-from collections import ChainMap
-from copy import deepcopy
 from enum import Enum, auto
 from pathlib import Path
 from typing import Optional
@@ -17,17 +14,66 @@ import pandas as pd
 from joblib import Parallel, delayed
 from tqdm import tqdm
 
+from ..columnar import (
+    CandidateSlice,
+    read_candidates,
+    read_hunks,
+    write_candidate_slices,
+    write_plausible_candidates,
+)
 from ..configs import quixbugs_dir, quixbugs_genpy_dir
+from .adaptive_timeout import get_reference_runtime, get_timeout
+from .patch_applier import PatchApplier, get_replacement
+from .sandbox import LimitExceeded, Limits, Sandbox
+from .speculative import run_in_rank_order
+from .state_store import StateStore
+from .workspace_manager import WorkspaceManager
 
 project_dir = quixbugs_dir
 gen_dir = quixbugs_genpy_dir
-bugs_metadata_file = "QuixBugs_Python.jsonl"
+bugs_metadata_file = "QuixBugs_Python.parquet"
 model = "multimend"
 
 output_dir = gen_dir / f"outputs-{model}"
-temp_dir = output_dir / "temp"
-save_state_dir = output_dir / "save-state"
+# Scratch files of each worker process, on a tmpfs when enough memory is free (see
+# `workspace_manager`)
+worker_workspace = WorkspaceManager(
+    "quixbugs-python",
+    output_dir / "temp",
+    512 << 20,
+    output_dir / "workspace-usage.jsonl",
+)
+state_db_path = output_dir / "validation-state.db"
+reference_runtimes_dir = gen_dir / "reference-runtimes"
 output_size = 100
+# Candidates are validated in the order of `combine_checkpoints_results` ("final"), or
+# in the order of `rerank_candidates` ("reranked"), once it has run for this dataset
+candidates_order = "final"
+candidates_file_path = output_dir / f"candidates_{output_size}.arrow"
+
+# Candidates are killed at `timeout_factor` times the tests runtime of the correct
+# program, clamped to [`timeout_floor`, `timeout_ceiling`] seconds
+timeout_factor = 5
+timeout_floor = 5
+timeout_ceiling = 60
+
+# pytest runs with these limits, also applied to the whole process tree when a
+# cgroup is available (see `sandbox`)
+sandbox = Sandbox(
+    Limits(
+        memory_bytes=2 << 30,
+        cpu_seconds=2 * timeout_ceiling,
+        max_processes=64,
+        output_bytes=100 << 20,
+    )
+)
+
+# Candidates of a bug tested at once in separate copies of QuixBugs, committed in
+# rank order until the first plausible one (see `speculative`)
+speculation_window = 3
+# Test runs at once across bugs: the bugs validated in parallel each run up to
+# `speculation_window` of them, so more would slow the runs into spurious timeouts
+max_test_runs = 6
 
 rem_file_path = gen_dir / "rem.txt"
 add_file_path = gen_dir / "add.txt"
@@ -64,32 +110,23 @@ def get_hunk_candidates(df: pd.DataFrame, hunk: int) -> pd.DataFrame:
     return df.loc[df["hunk"] == hunk]
 
 
-def get_candidates(df: pd.DataFrame, bugid: str) -> pd.DataFrame:
-    """Returns the subset of `df` containing candidate patches for a specific bugid and all its hunks"""
-    return df.loc[df["bugid"] == bugid]
-
-
-def insert_patch(patch, source_file_path, target_file_path, bug_line, bug_len, indent):
-    with open(source_file_path, "r") as file:
-        lines = file.readlines()
-    if bug_len == 0:
-        lines.insert(bug_line, indent + patch + "\n")
-    else:
-        lines[bug_line - 1 : (bug_line - 1) + bug_len] = indent + patch + "\n"
-
-    with open(target_file_path, "w") as file:
-        file.writelines(lines)
-
-
 class Status(Enum):
     PLAUSIBLE = auto()
     PARSABLE = auto()
     TIMEOUT = auto()
     UNPARSABLE = auto()
+    RESOURCE_LIMIT = auto()
+
 
+def run_tests(
+    bugid: str,
+    project_copy_dir: Path,
+    timeout: float,
+    stop: Optional[threading.Event] = None,
+) -> Status:
+    """Runs the tests of a bug, raising `Stopped` if they're killed by `stop`, as
+    their result is discarded then"""
 
-def run_tests(bugid: str, project_copy_dir: Path) -> Status:
-    timeout = 60  # seconds
     tests_dir = project_copy_dir / "python_testcases"
     test_file = f"test_{bugid}.py"
 
@@ -99,13 +136,16 @@ def run_tests(bugid: str, project_copy_dir: Path) -> Status:
         str(tests_dir / test_file),
     ]
     try:
-        result = subprocess.run(
+        result = sandbox.run(
             args,
             capture_output=True,
             timeout=timeout,
+            stop=stop,
         )
     except subprocess.TimeoutExpired:
         return Status.TIMEOUT
+    except LimitExceeded:
+        return Status.RESOURCE_LIMIT
 
     if result.returncode == 0:
         return Status.PLAUSIBLE
@@ -115,58 +155,138 @@ def run_tests(bugid: str, project_copy_dir: Path) -> Status:
         return Status.PARSABLE
 
 
-def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.DataFrame]:
-    # Load if already processed
-    save_file_path = save_state_dir / f"{bugid}.jsonl"
-    if save_file_path.exists():
-        return
+def measure_reference_runtime(bugid: str, project_copy_dir: Path) -> Optional[float]:
+    """Times the tests against the correct program, `None` if they time out"""
+
+    tests_dir = project_copy_dir / "python_testcases"
+    test_file = f"test_{bugid}.py"
+
+    args = [
+        "pytest",
+        "-x",
+        "--correct",
+        str(tests_dir / test_file),
+    ]
+    start_timer = timeit.default_timer()
+    try:
+        subprocess.run(args, capture_output=True, timeout=timeout_ceiling)
+    except subprocess.TimeoutExpired:
+        return None
+    end_timer = timeit.default_timer()
+
+    return end_timer - start_timer
+
+
+def apply_patch(
+    candidates: CandidateSlice, bugid: str, hunks: list
+) -> Optional[pd.DataFrame]:
+    with StateStore(state_db_path) as state_store:
+        # Skip if already processed
+        if state_store.is_done(bugid):
+            return
+
+        with worker_workspace.track(bugid):
+            validate_candidates(candidates.load(), bugid, hunks, state_store)
+        state_store.mark_done(bugid)
 
+
+def validate_candidates(
+    cp_df: pd.DataFrame, bugid: str, hunks: list, state_store: StateStore
+) -> None:
+    # Buggy source files are read once per bug
+    patch_applier = PatchApplier()
     pid = threading.get_ident()
 
     if len(hunks) == 1:
         hunk = hunks[0]
 
         # Copy QuixBugs files to a working directory
-        project_copy_dir = temp_dir / str(pid) / "QuixBugs"
+        project_copy_dir = worker_workspace.path / str(pid) / "QuixBugs"
         copy_dataset_files(project_dir, project_copy_dir)
 
         target_file_path = project_copy_dir / "python_programs" / f"{bugid}.py"
         bug_line, bug_len = hunk["removed_line_numbers_range"]
         bug_hunk_subset_df = get_hunk_candidates(cp_df, 0)
 
-        source_file_path = temp_dir / str(pid) / "sources" / bugid / f"{bugid}.py"
+        source_file_path = (
+            worker_workspace.path / str(pid) / "sources" / bugid / f"{bugid}.py"
+        )
         source_file_path.parent.mkdir(parents=True, exist_ok=True)
         shutil.copyfile(target_file_path, source_file_path)
 
         indent_size = len(hunk["added_lines"]) - len(hunk["added_lines"].lstrip(" \t"))
         indent = hunk["added_lines"][:indent_size]
 
-        for index, patch in bug_hunk_subset_df["decoded_sequences"].items():
-            insert_patch(
-                patch, source_file_path, target_file_path, bug_line, bug_len, indent
+        reference_runtime = get_reference_runtime(
+            reference_runtimes_dir,
+            bugid,
+            lambda: measure_reference_runtime(bugid, project_copy_dir),
+        )
+        timeout = get_timeout(
+            reference_runtime, timeout_factor, timeout_floor, timeout_ceiling
+        )
+
+        state_store.add_candidates(bugid, "single", cp_df)
+        if state_store.has_plausible(bugid, "single"):
+            return
+        tested = state_store.tested_indices(bugid, "single")
+
+        # Copies of QuixBugs for the candidates tested at once
+        workspace_dirs = [project_copy_dir]
+        for workspace in range(1, speculation_window):
+            workspace_dir = worker_workspace.path / str(pid) / f"QuixBugs-{workspace}"
+            copy_dataset_files(project_dir, workspace_dir)
+            workspace_dirs.append(workspace_dir)
+        last_write_times = [0.0] * len(workspace_dirs)
+        patch_applier.load(source_file_path)
+
+        def test_candidate(
+            index, workspace: int, stopped: threading.Event
+        ) -> tuple[Status, float]:
+            # pytest shows some inconsistent behavior on some source files if ran fast!
+            time.sleep(max(0.0, last_write_times[workspace] + 1 - time.monotonic()))
+            last_write_times[workspace] = time.monotonic()
+
+            workspace_dir = workspace_dirs[workspace]
+            patch = bug_hunk_subset_df.at[index, "decoded_sequences"]
+            patch_applier.apply(
+                source_file_path,
+                workspace_dir / "python_programs" / f"{bugid}.py",
+                [get_replacement(bug_line, bug_len, indent + patch + "\n")],
             )
 
             # call the testing infrastructure
             start_timer = timeit.default_timer()
-            passed = run_tests(bugid, project_copy_dir)
+            passed = run_tests(bugid, workspace_dir, timeout, stopped)
             end_timer = timeit.default_timer()
-            cp_df.at[index, "validation_time"] = end_timer - start_timer
+            return passed, end_timer - start_timer
+
+        def commit_candidate(index, result: tuple[Status, float]) -> bool:
+            passed, validation_time = result
+            cp_df.at[index, "validation_time"] = validation_time
 
             if passed is Status.PLAUSIBLE:
                 cp_df.at[index, "plausible"] = True
                 cp_df.at[index, "parsable"] = True
-                break
             elif passed is Status.PARSABLE:
                 cp_df.at[index, "parsable"] = True
             elif passed is Status.TIMEOUT:
                 cp_df.at[index, "timeout"] = True
+                cp_df.at[index, "timeout_limit"] = timeout
+                cp_df.at[index, "parsable"] = True
+            elif passed is Status.RESOURCE_LIMIT:
+                cp_df.at[index, "resource_limit"] = True
                 cp_df.at[index, "parsable"] = True
 
-            # pytest shows some inconsistent behavior on some source files if ran fast!
-            time.sleep(1)
+            state_store.save_candidate(bugid, "single", index, cp_df.loc[index])
+            return cp_df.at[index, "plausible"]
 
-        # Save intermediate state
-        cp_df.to_json(save_state_dir / f"{bugid}.jsonl", orient="records", lines=True)
+        run_in_rank_order(
+            [index for index in bug_hunk_subset_df.index if str(index) not in tested],
+            test_candidate,
+            commit_candidate,
+            speculation_window,
+        )
 
 
 def copy_dataset_files(dataset_dir, temp_dataset_dir):
@@ -179,44 +299,49 @@ def copy_dataset_files(dataset_dir, temp_dataset_dir):
 
 
 def main():
-    n_jobs = 6
+    n_jobs = max(1, max_test_runs // speculation_window)
 
-    with open(gen_dir / bugs_metadata_file) as meta_file:
-        bugs_metadata = ChainMap(*[json.loads(line) for line in meta_file][::-1])
+    bugs_metadata = read_hunks(gen_dir / bugs_metadata_file)
 
-    candidate_patches_df = pd.read_json(
-        output_dir / f"final_candidates_{output_size}.jsonl",
-        orient="records",
-        lines=True,
+    candidate_patches_df = read_candidates(
+        output_dir / f"{candidates_order}_candidates_{output_size}.parquet"
     )
     candidate_patches_df["plausible"] = False
     candidate_patches_df["parsable"] = False
     candidate_patches_df["timeout"] = False
+    candidate_patches_df["timeout_limit"] = np.nan
+    candidate_patches_df["resource_limit"] = False
     candidate_patches_df["validation_time"] = np.nan
 
-    shutil.rmtree(temp_dir, ignore_errors=True)
+    # Remove the workspaces left by crashed runs
+    worker_workspace.clean()
 
-    save_state_dir.mkdir(parents=True, exist_ok=True)
+    # Create the state database before the workers connect to it
+    StateStore(state_db_path).close()
+
+    # Workers memory-map the candidates file and copy out only their bug's rows
+    candidate_slices = write_candidate_slices(
+        candidate_patches_df, bugs_metadata, candidates_file_path
+    )
 
     with tqdm_joblib(tqdm(total=len(bugs_metadata))):
         Parallel(n_jobs=n_jobs, backend="threading")(
-            delayed(apply_patch)(
-                deepcopy(get_candidates(candidate_patches_df, bugid)), bugid, hunks
-            )
+            delayed(apply_patch)(candidate_slices[bugid], bugid, hunks)
             for bugid, hunks in bugs_metadata.items()
         )
 
-    cp_dfs = [
-        pd.read_json(cp, orient="records", lines=True)
-        for cp in sorted(save_state_dir.iterdir())
-    ]
-    concatenated_cp_df = pd.concat(cp_dfs, ignore_index=True)
-    assert len(candidate_patches_df) == len(concatenated_cp_df)
-    concatenated_cp_df.to_json(
-        output_dir / f"plausible_candidates_{output_size}.jsonl",
-        orient="records",
-        lines=True,
+    plausible_candidates_path = output_dir / f"plausible_candidates_{output_size}.jsonl"
+    with StateStore(state_db_path) as state_store:
+        state_store.export_jsonl(plausible_candidates_path)
+        write_plausible_candidates(
+            state_store.iter_records(),
+            plausible_candidates_path.with_suffix(".parquet"),
+        )
+
+    concatenated_cp_df = pd.read_json(
+        plausible_candidates_path, orient="records", lines=True
     )
+    assert len(candidate_patches_df) == len(concatenated_cp_df)
 
     bugs_with_plausible_patch = (
         concatenated_cp_df.groupby(["bugid", "hunk"])["plausible"]
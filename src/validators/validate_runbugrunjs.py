@@ -1,12 +1,9 @@
 import contextlib
-import json
 import shutil
 import subprocess
-import sys
 import textwrap
+import threading
 import timeit
-from collections import ChainMap, defaultdict
-from copy import deepcopy
 from enum import Enum, auto
 from pathlib import Path
 from typing import Optional
@@ -17,15 +14,80 @@ import pandas as pd
 from joblib import Parallel, delayed
 from tqdm import tqdm
 
+from ..columnar import (
+    CandidateSlice,
+    read_candidates,
+    read_hunks,
+    write_candidate_slices,
+    write_plausible_candidates,
+)
 from ..configs import runbugrun_data_dir, runbugrunjs_gen_dir
+from .adaptive_timeout import get_reference_runtime, get_timeout
+from .multi_hunk_search import (
+    MultiHunkSearch,
+    TestResult,
+    Trial,
+    get_candidates,
+    get_source_candidate,
+    get_trial_record,
+    summarize_search_stats,
+)
+from .patch_applier import PatchApplier, get_replacement
+from .sandbox import LimitExceeded, Limits, Sandbox
+from .speculative import run_in_rank_order
+from .state_store import StateStore
+from .workspace_manager import WorkspaceManager
 
 gen_dir = runbugrunjs_gen_dir
-bugs_metadata_file = "RunBugRun-JS.jsonl"
+bugs_metadata_file = "RunBugRun-JS.parquet"
 model = "multimend"
 output_dir = gen_dir / f"outputs-{model}"
-temp_dir = output_dir / "temp"
-save_state_dir = output_dir / "save-state"
+# Scratch files of each worker process, on a tmpfs when enough memory is free (see
+# `workspace_manager`)
+worker_workspace = WorkspaceManager(
+    "runbugrunjs", output_dir / "temp", 256 << 20, output_dir / "workspace-usage.jsonl"
+)
+state_db_path = output_dir / "validation-state.db"
+reference_runtimes_dir = gen_dir / "reference-runtimes"
 output_size = 100
+# Candidates are validated in the order of `combine_checkpoints_results` ("final"), or
+# in the order of `rerank_candidates` ("reranked"), once it has run for this dataset
+candidates_order = "final"
+candidates_file_path = output_dir / f"candidates_{output_size}.arrow"
+# Encodings to read the buggy source files with, and to write patched files
+# with when the previous one fails
+source_encodings = ("utf-8", "cp1256")
+
+# Candidates are killed at `timeout_factor` times the slowest test runtime of the
+# fixed program, clamped to [`timeout_floor`, `timeout_ceiling`] seconds
+timeout_factor = 5
+timeout_floor = 2
+timeout_ceiling = 60
+
+# Node runs with these limits, also applied to the whole process tree when a cgroup
+# is available (see `sandbox`)
+sandbox = Sandbox(
+    Limits(
+        memory_bytes=2 << 30,
+        cpu_seconds=2 * timeout_ceiling,
+        max_processes=64,
+        output_bytes=100 << 20,
+    )
+)
+
+# Candidates of a single-hunk bug tested at once in separate copies of the bug,
+# committed in rank order until the first plausible one (see `speculative`)
+speculation_window = 3
+# Test runs at once across bugs: the bugs validated in parallel each run up to
+# `speculation_window` of them, so more would slow the runs into spurious timeouts
+max_test_runs = 6
+
+# Search over combinations of hunk candidates for multi-hunk bugs: "greedy",
+# "beam" or "delta" (see `multi_hunk_search`), stopped after `multi_hunk_test_budget`
+# test runs per bug
+multi_hunk_strategy = "greedy"
+multi_hunk_test_budget = 2000
+multi_hunk_beam_width = 10
 
 rem_file_path = gen_dir / "rem.txt"
 add_file_path = gen_dir / "add.txt"
@@ -44,13 +106,13 @@ def working_environment(bugid: str):
     project_dir = runbugrun_data_dir / "jsbugs" / bugid
 
     # Copy files to a working directory
-    project_copy_dir = temp_dir / bugid
+    project_copy_dir = worker_workspace.path / bugid
     copy_dataset_files(project_dir, project_copy_dir)
 
     target_file_path = project_copy_dir / "buggy.js"
 
     # Copy initial file to a temp directory
-    source_file_path = temp_dir / "sources" / bugid / "buggy.js"
+    source_file_path = worker_workspace.path / "sources" / bugid / "buggy.js"
     source_file_path.parent.mkdir(parents=True, exist_ok=False)
     shutil.copyfile(target_file_path, source_file_path)
 
@@ -102,34 +164,12 @@ def get_hunk_candidates(df: pd.DataFrame, hunk: int) -> pd.DataFrame:
     return df.loc[df["hunk"] == hunk]
 
 
-def get_candidates(df: pd.DataFrame, bugid: str) -> pd.DataFrame:
-    """Returns the subset of `df` containing candidate patches for a specific bugid and all its hunks"""
-    return df.loc[df["bugid"] == bugid]
-
-
-def insert_patch(patch, source_file_path, target_file_path, bug_line, bug_len, indent):
-    with open(source_file_path, "r", encoding="utf-8") as file:
-        lines = file.readlines()
-    if bug_len == 0:
-        lines.insert(bug_line, textwrap.indent(patch, indent) + "\n")
-    else:
-        lines[bug_line - 1 : (bug_line - 1) + bug_len] = (
-            textwrap.indent(patch, indent) + "\n"
-        )
-
-    try:
-        with open(target_file_path, "w", encoding="utf-8") as file:
-            file.writelines(lines)
-    except UnicodeEncodeError:
-        with open(target_file_path, "w", encoding="cp1256") as file:
-            file.writelines(lines)
-
-
 class Status(Enum):
     PLAUSIBLE = auto()
     COMPILABLE = auto()
     TIMEOUT = auto()
     UNCOMPILABLE = auto()
+    RESOURCE_LIMIT = auto()
 
 
 def compare_output_expected(bugid: str, output: str, expected: str) -> bool:
@@ -161,9 +201,14 @@ def compare_output_expected(bugid: str, output: str, expected: str) -> bool:
 
 
 def run_tests_for_multi(
-    bugid: str, project_dir: Path, tests: list[tuple[Path, Path]]
+    bugid: str,
+    project_dir: Path,
+    tests: list[tuple[Path, Path]],
+    timeout: float,
+    stop: Optional[threading.Event] = None,
 ) -> tuple[Status, int | None]:
-    timeout = 60  # seconds
+    """Runs the tests of a bug, raising `Stopped` if they're killed by `stop`, as
+    their result is discarded then"""
 
     cmd = ["node", project_dir / "buggy.js"]
 
@@ -171,16 +216,19 @@ def run_tests_for_multi(
 
     for testcase, testcase_output in tests:
         try:
-            result = subprocess.run(
+            result = sandbox.run(
                 cmd,
                 input=testcase,
                 text=True,
                 capture_output=True,
                 timeout=timeout,
                 encoding="utf-8",
+                stop=stop,
             )
         except subprocess.TimeoutExpired:
             return Status.TIMEOUT, None
+        except LimitExceeded:
+            return Status.RESOURCE_LIMIT, None
 
         if result.returncode != 0:
             return Status.UNCOMPILABLE, None
@@ -194,6 +242,26 @@ def run_tests_for_multi(
         return Status.PLAUSIBLE, 0
 
 
+def get_test_result(
+    status: Status,
+    failed_count: Optional[int],
+    validation_time: float,
+    timeout: float,
+) -> TestResult:
+    return TestResult(
+        status is Status.PLAUSIBLE,
+        failed_count,
+        {
+            "plausible": status is Status.PLAUSIBLE,
+            "compilable": status is not Status.UNCOMPILABLE,
+            "timeout": status is Status.TIMEOUT,
+            "timeout_limit": timeout if status is Status.TIMEOUT else np.nan,
+            "resource_limit": status is Status.RESOURCE_LIMIT,
+            "validation_time": validation_time,
+        },
+    )
+
+
 def get_tests(bugid: str, project_dir: Path) -> list[tuple[str, str]]:
     tests = []
     for i in project_dir.iterdir():
@@ -207,12 +275,66 @@ def get_tests(bugid: str, project_dir: Path) -> list[tuple[str, str]]:
     return tests
 
 
-def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.DataFrame]:
-    # Check if already processed
-    save_file_path = save_state_dir / f"{bugid}.jsonl"
-    if save_file_path.exists():
-        return
+def measure_reference_runtime(
+    project_dir: Path, tests: list[tuple[str, str]]
+) -> Optional[float]:
+    """Returns the slowest test runtime of the fixed program, `None` if a test times out"""
+
+    cmd = ["node", project_dir / "fixed.js"]
+
+    slowest_runtime = 0.0
+    for testcase, _ in tests:
+        start_timer = timeit.default_timer()
+        try:
+            subprocess.run(
+                cmd,
+                input=testcase,
+                text=True,
+                capture_output=True,
+                timeout=timeout_ceiling,
+                encoding="utf-8",
+            )
+        except subprocess.TimeoutExpired:
+            return None
+        end_timer = timeit.default_timer()
+        slowest_runtime = max(slowest_runtime, end_timer - start_timer)
+
+    return slowest_runtime
+
 
+def get_bug_timeout(
+    bugid: str, project_dir: Path, tests: list[tuple[str, str]]
+) -> float:
+    """Returns the per-test timeout of candidates based on the bug's reference runtime"""
+
+    reference_runtime = get_reference_runtime(
+        reference_runtimes_dir,
+        bugid,
+        lambda: measure_reference_runtime(project_dir, tests),
+    )
+    return get_timeout(
+        reference_runtime, timeout_factor, timeout_floor, timeout_ceiling
+    )
+
+
+def apply_patch(
+    candidates: CandidateSlice, bugid: str, hunks: list
+) -> Optional[pd.DataFrame]:
+    with StateStore(state_db_path) as state_store:
+        # Skip if already processed
+        if state_store.is_done(bugid):
+            return
+
+        with worker_workspace.track(bugid):
+            validate_candidates(candidates.load(), bugid, hunks, state_store)
+        state_store.mark_done(bugid)
+
+
+def validate_candidates(
+    cp_df: pd.DataFrame, bugid: str, hunks: list, state_store: StateStore
+) -> None:
+    # Buggy source files are read once per bug
+    patch_applier = PatchApplier(source_encodings)
     if len(hunks) == 1:
         hunk = hunks[0]
 
@@ -232,32 +354,81 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
         ):
             # Get tests
             tests = get_tests(bugid, project_copy_dir)
+            timeout = get_bug_timeout(bugid, project_copy_dir, tests)
 
-            for index, patch in bug_hunk_subset_df["decoded_sequences"].items():
-                insert_patch(
-                    patch, source_file_path, target_file_path, bug_line, bug_len, indent
+            state_store.add_candidates(bugid, "single", cp_df)
+            if state_store.has_plausible(bugid, "single"):
+                return
+            tested = state_store.tested_indices(bugid, "single")
+
+            # Copies of the bug for the candidates tested at once
+            workspace_dirs = [project_copy_dir] + [
+                project_copy_dir.with_name(f"{bugid}-{workspace}")
+                for workspace in range(1, speculation_window)
+            ]
+            for workspace_dir in workspace_dirs[1:]:
+                copy_dataset_files(project_copy_dir, workspace_dir)
+            patch_applier.load(source_file_path)
+
+            def test_candidate(
+                index, workspace: int, stopped: threading.Event
+            ) -> tuple[Status, Optional[int], float]:
+                workspace_dir = workspace_dirs[workspace]
+                patch = bug_hunk_subset_df.at[index, "decoded_sequences"]
+                patch_applier.apply(
+                    source_file_path,
+                    workspace_dir / target_file_path.name,
+                    [
+                        get_replacement(
+                            bug_line, bug_len, textwrap.indent(patch, indent) + "\n"
+                        )
+                    ],
                 )
 
                 # call the testing infrastructure
                 start_timer = timeit.default_timer()
                 status, failed_count = run_tests_for_multi(
-                    bugid, project_copy_dir, tests
+                    bugid, workspace_dir, tests, timeout, stopped
                 )
                 end_timer = timeit.default_timer()
-                cp_df.at[index, "validation_time"] = end_timer - start_timer
+                return status, failed_count, end_timer - start_timer
+
+            def commit_candidate(
+                index, result: tuple[Status, Optional[int], float]
+            ) -> bool:
+                status, _, validation_time = result
+                cp_df.at[index, "validation_time"] = validation_time
 
                 if status is Status.PLAUSIBLE:
                     cp_df.at[index, "plausible"] = True
                     cp_df.at[index, "compilable"] = True
-                    break
                 elif status is Status.COMPILABLE:
                     cp_df.at[index, "compilable"] = True
                 elif status is Status.TIMEOUT:
                     cp_df.at[index, "timeout"] = True
+                    cp_df.at[index, "timeout_limit"] = timeout
+                    cp_df.at[index, "compilable"] = True
+                elif status is Status.RESOURCE_LIMIT:
+                    cp_df.at[index, "resource_limit"] = True
                     cp_df.at[index, "compilable"] = True
 
-        # Save intermediate state
-        cp_df.to_json(save_state_dir / f"{bugid}.jsonl", orient="records", lines=True)
+                state_store.save_candidate(bugid, "single", index, cp_df.loc[index])
+                return cp_df.at[index, "plausible"]
+
+            try:
+                run_in_rank_order(
+                    [
+                        index
+                        for index in bug_hunk_subset_df.index
+                        if str(index) not in tested
+                    ],
+                    test_candidate,
+                    commit_candidate,
+                    speculation_window,
+                )
+            finally:
+                for workspace_dir in workspace_dirs[1:]:
+                    shutil.rmtree(workspace_dir, ignore_errors=True)
 
     else:
         agg_mapping = {
@@ -270,6 +441,8 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
                 "plausible",
                 "compilable",
                 "timeout",
+                "timeout_limit",
+                "resource_limit",
                 "validation_time",
             ]
             else list
@@ -292,11 +465,20 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
         ):
             # Get tests
             tests = get_tests(bugid, project_copy_dir)
+            timeout = get_bug_timeout(bugid, project_copy_dir, tests)
+
+            state_store.add_candidates(bugid, "combined", new_cp_df)
+            if state_store.has_plausible(bugid, "combined"):
+                return
+            tested = state_store.tested_indices(bugid, "combined")
 
             for index, patches in new_cp_df["decoded_sequences"].items():
-                bugs_lens = defaultdict(list)
+                if str(index) in tested:
+                    continue
+
+                replacements = []
 
-                for hunk, patch in reversed(list(zip(hunks, patches))):
+                for hunk, patch in zip(hunks, patches):
                     bug_line, bug_len = hunk["removed_line_numbers_range"]
 
                     indent_hunk = "\n".join(
@@ -309,23 +491,18 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
                     indent_size = len(indent_hunk) - len(indent_hunk.lstrip(" \t"))
                     indent = indent_hunk[:indent_size]
 
-                    insert_patch(
-                        patch,
-                        target_file_path
-                        if target_file_path in bugs_lens
-                        else source_file_path,
-                        target_file_path,
-                        bug_line,
-                        bug_len,
-                        indent,
+                    replacements.append(
+                        get_replacement(
+                            bug_line, bug_len, textwrap.indent(patch, indent) + "\n"
+                        )
                     )
 
-                    bugs_lens[target_file_path].append(bug_len)
+                patch_applier.apply(source_file_path, target_file_path, replacements)
 
                 # Call the testing infrastructure
                 start_timer = timeit.default_timer()
                 status, failed_count = run_tests_for_multi(
-                    bugid, project_copy_dir, tests
+                    bugid, project_copy_dir, tests, timeout
                 )
                 end_timer = timeit.default_timer()
                 new_cp_df.at[index, "validation_time"] = end_timer - start_timer
@@ -333,17 +510,23 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
                 if status is Status.PLAUSIBLE:
                     new_cp_df.at[index, "plausible"] = True
                     new_cp_df.at[index, "compilable"] = True
-                    break
                 elif status is Status.COMPILABLE:
                     new_cp_df.at[index, "compilable"] = True
                 elif status is Status.TIMEOUT:
                     new_cp_df.at[index, "timeout"] = True
+                    new_cp_df.at[index, "timeout_limit"] = timeout
+                    new_cp_df.at[index, "compilable"] = True
+                elif status is Status.RESOURCE_LIMIT:
+                    new_cp_df.at[index, "resource_limit"] = True
                     new_cp_df.at[index, "compilable"] = True
 
-        if not new_cp_df.empty and new_cp_df["plausible"].any():
-            new_cp_df.to_json(
-                save_state_dir / f"{bugid}.jsonl", orient="records", lines=True
-            )
+                state_store.save_candidate(
+                    bugid, "combined", index, new_cp_df.loc[index]
+                )
+                if new_cp_df.at[index, "plausible"]:
+                    break
+
+        if state_store.has_plausible(bugid, "combined"):
             return
 
         #######################################################################
@@ -355,6 +538,8 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
                 "plausible",
                 "compilable",
                 "timeout",
+                "timeout_limit",
+                "resource_limit",
                 "validation_time",
             ]:
                 agg_mapping[col] = "first"
@@ -378,132 +563,85 @@ def apply_patch(cp_df: pd.DataFrame, bugid: str, hunks: list) -> Optional[pd.Dat
             == template_df["hunk"].apply(len).item()
         )
 
-        # List to store extracted multi-hunk patches
-        multi_patches_list = []
+        hunk_candidates = []
+        source_candidates = []
+        for i in range(len(hunks)):
+            hunk_candidates.append(get_candidates(get_hunk_candidates(cp_df, i)))
+            source_candidates.append(
+                get_source_candidate(
+                    template_df.at[0, "source"][i],
+                    template_df.at[0, "normalized_source"][i],
+                )
+            )
+
+        template = template_df.iloc[0].to_dict()
+
+        def save_trial(trial: Trial) -> None:
+            state_store.save_candidate(
+                bugid,
+                multi_hunk_strategy,
+                len(search.trials),
+                pd.Series(get_trial_record(template, trial)),
+            )
 
-        running_plausible_df = None
+        # The search restarts from scratch when resumed
+        state_store.clear_phase(bugid, multi_hunk_strategy)
 
         with working_environment(bugid) as (
             project_copy_dir,
             source_file_path,
             target_file_path,
         ):
-            _, running_failed_count = run_tests_for_multi(
-                bugid, project_copy_dir, tests
-            )
-            if not running_failed_count:
-                running_failed_count = sys.maxsize
 
-            for i in range(len(hunks)):
-                if running_failed_count == 0:
-                    break
-                hunk_cp_df = get_hunk_candidates(cp_df, i)
+            def test_patches(patches: list[str]) -> TestResult:
+                replacements = []
 
-                for row in hunk_cp_df.itertuples():
-                    if i == 0:
-                        row_df = pd.DataFrame(
-                            columns=template_df.columns,
-                            data=deepcopy(template_df.values),
-                        )
-                    else:
-                        row_df = pd.DataFrame(
-                            columns=running_plausible_df.columns,
-                            data=deepcopy(running_plausible_df.values),
-                        )
-                    row_df.at[0, "checkpoint"].append(row.checkpoint)
-                    row_df.at[0, "decoded_sequences"].append(row.decoded_sequences)
-                    row_df.at[0, "normalized_patch"].append(row.normalized_patch)
-                    row_df.at[0, "sequences_scores"].append(row.sequences_scores)
-                    row_df.at[0, "rank"].append(row.rank)
-                    row_df.at[0, "exact_match"].append(row.exact_match)
-
-                    assert (v := len(row_df.at[0, "decoded_sequences"])) == i + 1, (
-                        f"Hunk and patch count mismatch: {i + 1}, {v}"
-                    )
-
-                    bugs_lens = defaultdict(list)
+                # Patches start from the first hunk, so later hunks keep their buggy code
+                for hunk, patch in zip(hunks, patches):
+                    bug_line, bug_len = hunk["removed_line_numbers_range"]
 
-                    # When we are iterating over previous hunks, we don't have to change later hunks
-                    for hunk, patch in reversed(
-                        list(zip(hunks, row_df["decoded_sequences"].item()))
-                    ):
-                        bug_line, bug_len = hunk["removed_line_numbers_range"]
+                    indent_hunk = "\n".join(
+                        [
+                            line
+                            for line in hunk["added_lines"].splitlines()
+                            if line.strip()
+                        ]
+                    )
+                    indent_size = len(indent_hunk) - len(indent_hunk.lstrip(" \t"))
+                    indent = indent_hunk[:indent_size]
 
-                        indent_hunk = "\n".join(
-                            [
-                                line
-                                for line in hunk["added_lines"].splitlines()
-                                if line.strip()
-                            ]
-                        )
-                        indent_size = len(indent_hunk) - len(indent_hunk.lstrip(" \t"))
-                        indent = indent_hunk[:indent_size]
-
-                        insert_patch(
-                            patch,
-                            target_file_path
-                            if target_file_path in bugs_lens
-                            else source_file_path,
-                            target_file_path,
-                            bug_line,
-                            bug_len,
-                            indent,
+                    replacements.append(
+                        get_replacement(
+                            bug_line, bug_len, textwrap.indent(patch, indent) + "\n"
                         )
+                    )
 
-                        bugs_lens[target_file_path].append(bug_len)
+                patch_applier.apply(source_file_path, target_file_path, replacements)
 
-                    # Call the testing infrastructure
-                    start_timer = timeit.default_timer()
-                    status, failed_count = run_tests_for_multi(
-                        bugid, project_copy_dir, tests
-                    )
-                    end_timer = timeit.default_timer()
-                    row_df.at[0, "validation_time"] = end_timer - start_timer
-
-                    if status is Status.PLAUSIBLE:
-                        row_df.at[0, "plausible"] = True
-                        row_df.at[0, "compilable"] = True
-                        running_failed_count = 0
-                        multi_patches_list.append(row_df)
-                        break
-                    elif status is Status.COMPILABLE:
-                        row_df.at[0, "compilable"] = True
-                        if failed_count and failed_count < running_failed_count:
-                            running_failed_count = failed_count
-                            running_plausible_df = pd.DataFrame(
-                                columns=row_df.columns, data=deepcopy(row_df.values)
-                            )
-                            multi_patches_list.append(row_df)
-                            break
-                    elif status is Status.TIMEOUT:
-                        row_df.at[0, "timeout"] = True
-                        row_df.at[0, "compilable"] = True
-
-                    multi_patches_list.append(row_df)
-
-                else:
-                    row_df.at[0, "checkpoint"][-1] = "manual"
-                    row_df.at[0, "decoded_sequences"][-1] = row.source
-                    row_df.at[0, "normalized_patch"][-1] = row.normalized_source
-                    row_df.at[0, "sequences_scores"][-1] = None
-                    row_df.at[0, "rank"][-1] = None
-                    row_df.at[0, "exact_match"][-1] = False
-                    running_plausible_df = pd.DataFrame(
-                        columns=row_df.columns, data=deepcopy(row_df.values)
-                    )
+                # Call the testing infrastructure
+                start_timer = timeit.default_timer()
+                status, failed_count = run_tests_for_multi(
+                    bugid, project_copy_dir, tests, timeout
+                )
+                end_timer = timeit.default_timer()
 
-        # Merge and save to disk
-        new_cp_df = pd.concat(
-            [
-                new_cp_df if not new_cp_df.empty else None,
-                *multi_patches_list,
-            ]
-        )
+                return get_test_result(
+                    status, failed_count, end_timer - start_timer, timeout
+                )
 
-        if not new_cp_df.empty:
-            new_cp_df.to_json(
-                save_state_dir / f"{bugid}.jsonl", orient="records", lines=True
+            search = MultiHunkSearch(
+                hunk_candidates,
+                source_candidates,
+                test_patches,
+                multi_hunk_test_budget,
+                multi_hunk_beam_width,
+                on_trial=save_trial,
             )
+            result = search.run(multi_hunk_strategy)
+
+        state_store.save_search_stats(
+            bugid, result.strategy, result.test_runs, result.runs_to_plausible
+        )
 
 
 def copy_dataset_files(dataset_dir, temp_dataset_dir):
@@ -518,49 +656,49 @@ def copy_dataset_files(dataset_dir, temp_dataset_dir):
 def main():
     check_node_version()
 
-    n_jobs = 6
+    n_jobs = max(1, max_test_runs // speculation_window)
 
-    with open(gen_dir / bugs_metadata_file) as meta_file:
-        bugs_metadata = ChainMap(*[json.loads(line) for line in meta_file][::-1])
+    bugs_metadata = read_hunks(gen_dir / bugs_metadata_file)
 
-    candidate_patches_df = pd.read_json(
-        output_dir / f"final_candidates_{output_size}.jsonl",
-        orient="records",
-        lines=True,
+    candidate_patches_df = read_candidates(
+        output_dir / f"{candidates_order}_candidates_{output_size}.parquet"
     )
     candidate_patches_df["plausible"] = False
     candidate_patches_df["compilable"] = False
     candidate_patches_df["timeout"] = False
+    candidate_patches_df["timeout_limit"] = np.nan
+    candidate_patches_df["resource_limit"] = False
     candidate_patches_df["validation_time"] = np.nan
 
-    shutil.rmtree(temp_dir, ignore_errors=True)
-    temp_dir.mkdir(parents=True)
-    save_state_dir.mkdir(parents=True, exist_ok=True)
+    # Remove the workspaces left by crashed runs
+    worker_workspace.clean()
+    # Create the state database before the workers connect to it
+    StateStore(state_db_path).close()
+
+    # Workers memory-map the candidates file and copy out only their bug's rows
+    candidate_slices = write_candidate_slices(
+        candidate_patches_df, bugs_metadata, candidates_file_path
+    )
 
     with tqdm_joblib(tqdm(total=len(bugs_metadata), disable=False)):
         Parallel(n_jobs=n_jobs, backend="loky")(
-            delayed(apply_patch)(
-                deepcopy(get_candidates(candidate_patches_df, bugid)), bugid, hunks
-            )
+            delayed(apply_patch)(candidate_slices[bugid], bugid, hunks)
             for bugid, hunks in bugs_metadata.items()
         )
 
-    cp_dfs = [
-        pd.read_json(cp, orient="records", lines=True)
-        for cp in sorted(save_state_dir.iterdir())
-    ]
-    concatenated_cp_df = pd.concat(cp_dfs, ignore_index=True)
-
-    bugs_with_plausible_patch = (
-        concatenated_cp_df.groupby("bugid")["plausible"].any().groupby("bugid").any()
-    )
+    with StateStore(state_db_path) as state_store:
+        state_store.export_jsonl(
+            output_dir / f"plausible_candidates_{output_size}.jsonl"
+        )
+        write_plausible_candidates(
+            state_store.iter_records(),
+            output_dir / f"plausible_candidates_{output_size}.parquet",
+        )
+        bugs_with_plausible_patch = state_store.get_plausible_bugs()
+        search_stats = state_store.get_search_stats()
     print(bugs_with_plausible_patch)
     print(bugs_with_plausible_patch.value_counts())
-    concatenated_cp_df.to_json(
-        output_dir / f"plausible_candidates_{output_size}.jsonl",
-        orient="records",
-        lines=True,
-    )
+    print(summarize_search_stats(search_stats))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,200 @@
+"""Queue of the bugs to validate, shared by validator processes on any host.
+
+The queue is a SQLite database on storage that all the hosts can reach (e.g., NFS
+with working file locks), so it needs no server. A worker leases the next pending bug
+for `lease_seconds` and renews the lease from a heartbeat thread while validating
+it. The leases of workers that died expire, and their bugs are leased again, resuming
+from the candidates already in the state store. Adding a host is starting another
+worker there.
+
+The database uses a rollback journal, as WAL needs memory shared by all of its
+connections, which processes on different hosts don't have. Leases expire by the
+clocks of the hosts, so they should be kept in sync.
+"""
+
+import contextlib
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional
+
+# Seconds a lease lasts without a heartbeat
+lease_seconds = 300
+# Leases of a bug after which it's left failed rather than leased again
+max_attempts = 3
+# Seconds between checks for expired leases once no bug is pending
+poll_interval = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    grp TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    lease_id TEXT,
+    worker TEXT,
+    lease_expiry REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS tasks_status_seq ON tasks (status, seq);
+"""
+
+
+class Lease(NamedTuple):
+    key: str
+    lease_id: str
+
+
+class WorkQueue:
+    """Tasks keyed by a string, leased in the order they were added. Tasks with the
+    same group are never leased at the same time."""
+
+    def __init__(self, db_path: Path, timeout: float = 60):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path, timeout=timeout)
+        self.connection.execute("PRAGMA journal_mode=DELETE")
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self) -> "WorkQueue":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def add(
+        self, keys: Iterable[str], group: Optional[Callable[[str], str]] = None
+    ) -> None:
+        """Adds the tasks that aren't in the queue yet"""
+
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO tasks (key, grp) VALUES (?, ?)",
+                [(key, None if group is None else group(key)) for key in keys],
+            )
+
+    def lease(self) -> Optional[Lease]:
+        """Leases the first pending task, or one whose lease expired"""
+
+        now = time.time()
+        lease_id = uuid.uuid4().hex
+        with self.connection:
+            self.connection.execute(
+                "UPDATE tasks SET status = 'failed', lease_id = NULL "
+                "WHERE status = 'leased' AND lease_expiry < ? AND attempts >= ?",
+                (now, max_attempts),
+            )
+            # A single statement, so no other worker can lease the same task
+            self.connection.execute(
+                "UPDATE tasks SET status = 'leased', lease_id = ?, worker = ?, "
+                "lease_expiry = ?, attempts = attempts + 1 "
+                "WHERE seq = ("
+                "  SELECT seq FROM tasks AS t "
+                "  WHERE (status = 'pending' OR (status = 'leased' AND lease_expiry < ?))"
+                "  AND (grp IS NULL OR NOT EXISTS ("
+                "    SELECT 1 FROM tasks WHERE grp = t.grp AND seq != t.seq"
+                "    AND status = 'leased' AND lease_expiry >= ?))"
+                "  ORDER BY seq LIMIT 1)",
+                (lease_id, get_worker_name(), now + lease_seconds, now, now),
+            )
+        row = self.connection.execute(
+            "SELECT key FROM tasks WHERE lease_id = ?", (lease_id,)
+        ).fetchone()
+        return None if row is None else Lease(row[0], lease_id)
+
+    def renew(self, lease: Lease) -> bool:
+        """Extends a lease, returning `False` if it was lost to another worker"""
+
+        with self.connection:
+            cursor = self.connection.execute(
+                "UPDATE tasks SET lease_expiry = ? "
+                "WHERE lease_id = ? AND status = 'leased'",
+                (time.time() + lease_seconds, lease.lease_id),
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, lease: Lease) -> None:
+        with self.connection:
+            self.connection.execute(
+                "UPDATE tasks SET status = 'done', lease_id = NULL WHERE lease_id = ?",
+                (lease.lease_id,),
+            )
+
+    def release(self, lease: Lease) -> None:
+        """Returns a leased task to the queue"""
+
+        with self.connection:
+            self.connection.execute(
+                "UPDATE tasks SET status = 'pending', lease_id = NULL "
+                "WHERE lease_id = ?",
+                (lease.lease_id,),
+            )
+
+    def is_finished(self) -> bool:
+        """Whether no task is pending or leased"""
+
+        row = self.connection.execute(
+            "SELECT 1 FROM tasks WHERE status IN ('pending', 'leased') LIMIT 1"
+        ).fetchone()
+        return row is None
+
+    def get_counts(self) -> dict[str, int]:
+        return dict(
+            self.connection.execute(
+                "SELECT status, COUNT(*) FROM tasks GROUP BY status"
+            ).fetchall()
+        )
+
+
+def get_worker_name() -> str:
+    return f"{socket.gethostname()}-{threading.get_native_id()}"
+
+
+@contextlib.contextmanager
+def heartbeat(db_path: Path, lease: Lease) -> Iterator[None]:
+    """Renews a lease in the background until the block exits or the lease is lost"""
+
+    stopped = threading.Event()
+
+    def renew() -> None:
+        # Connections can't be shared between threads
+        with WorkQueue(db_path) as work_queue:
+            while not stopped.wait(lease_seconds / 3):
+                if not work_queue.renew(lease):
+                    return
+
+    renewer = threading.Thread(target=renew, daemon=True)
+    renewer.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        renewer.join()
+
+
+def run_worker(db_path: Path, process: Callable[[str], None]) -> None:
+    """Calls `process` with the leased tasks until every task is done or failed.
+    A task whose `process` raises is released before the exception propagates."""
+
+    with WorkQueue(db_path) as work_queue:
+        while True:
+            lease = work_queue.lease()
+            if lease is None:
+                if work_queue.is_finished():
+                    return
+                # Tasks of other workers are still leased, and may expire
+                time.sleep(poll_interval)
+                continue
+
+            with heartbeat(db_path, lease):
+                try:
+                    process(lease.key)
+                except BaseException:
+                    work_queue.release(lease)
+                    raise
+            work_queue.complete(lease)
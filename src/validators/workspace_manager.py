@@ -0,0 +1,271 @@
+"""Scratch directories of the validator workers, on RAM-backed storage when possible.
+
+Validators copy projects and buggy source files for every bug and rewrite or delete
+files for every candidate. Each worker process gets its own workspace directory for
+them, under `ram_dir` (a tmpfs) when the tmpfs has room for the expected size of the
+workspace and the memory left after it is at least `min_free_memory`, and under a
+directory on disk otherwise. Workspaces in `ram_dir` are placed one at a time, each
+counting the expected sizes of the ones placed before that aren't filled yet, so
+workers starting together don't all count the same free space. On a tmpfs, the
+per-candidate loop doesn't wait for disk syncs and metadata updates.
+
+A workspace has a lock file next to it that its process keeps locked. The lock is
+released when the process exits, even if it crashes, so workspaces with a free lock
+are stale and are removed by `WorkspaceManager.clean` and when another workspace is
+created next to them.
+"""
+
+import atexit
+import contextlib
+import json
+import os
+import platform
+import shutil
+import socket
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, Optional
+
+if platform.system() != "Windows":
+    import fcntl
+else:
+    fcntl = None
+
+ram_dir = Path("/dev/shm/multimend")
+# File locked while a workspace is placed in `ram_dir`, in the directory of the
+# validator's workspaces
+allocation_lock_name = ".allocation"
+# Memory that must stay available after a workspace is filled
+min_free_memory = 4 << 30
+# Seconds between samples of the size of a workspace while a bug is tracked
+usage_sample_interval = 1.0
+
+
+def get_available_memory() -> Optional[int]:
+    """Memory available for new allocations without swapping, `None` if unknown"""
+
+    try:
+        with open("/proc/meminfo") as file:
+            for line in file:
+                name, value, *_ = line.split()
+                if name == "MemAvailable:":
+                    return int(value) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def get_tree_size(path: Path) -> int:
+    """Total size of the files under `path`, skipping files removed meanwhile"""
+
+    size = 0
+    with contextlib.suppress(FileNotFoundError):
+        with os.scandir(path) as entries:
+            for entry in entries:
+                with contextlib.suppress(FileNotFoundError):
+                    if entry.is_dir(follow_symlinks=False):
+                        size += get_tree_size(Path(entry.path))
+                    else:
+                        size += entry.stat(follow_symlinks=False).st_size
+    return size
+
+
+def lock_file(lock_file_path: Path) -> Optional[int]:
+    """Locks a file, creating it if missing. Returns the descriptor holding the lock,
+    or `None` if another process holds it."""
+
+    while True:
+        fd = os.open(lock_file_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+
+        # Retry if a cleaner removed the file between opening and locking it
+        try:
+            if os.stat(lock_file_path).st_ino == os.fstat(fd).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+
+def get_lock_file_path(workspace_dir: Path) -> Path:
+    return workspace_dir.with_name(f"{workspace_dir.name}.lock")
+
+
+def get_free_space(path: Path) -> int:
+    """Space that unprivileged processes can still write to the file system of
+    `path`, e.g., up to the size limit of a tmpfs"""
+
+    stats = os.statvfs(path)
+    return stats.f_bavail * stats.f_frsize
+
+
+def clean_stale_workspaces(base_dir: Path) -> None:
+    """Removes the workspaces in `base_dir` whose process has exited"""
+
+    if not base_dir.is_dir():
+        return
+
+    for lock_file_path in base_dir.glob("*.lock"):
+        fd = lock_file(lock_file_path)
+        if fd is None:
+            continue
+        try:
+            shutil.rmtree(
+                lock_file_path.with_name(lock_file_path.name.removesuffix(".lock")),
+                ignore_errors=True,
+            )
+            lock_file_path.unlink()
+        finally:
+            os.close(fd)
+
+
+class WorkspaceManager:
+    """Workspaces of the processes of a validator, named `name` in `ram_dir` or
+    placed in `disk_dir`. `expected_bytes` is the size a workspace may grow to. The
+    sizes of the workspace while validating each bug are appended to
+    `usage_file_path`, if given."""
+
+    def __init__(
+        self,
+        name: str,
+        disk_dir: Path,
+        expected_bytes: int,
+        usage_file_path: Optional[Path] = None,
+    ):
+        self.base_dirs = [ram_dir / name, disk_dir]
+        self.expected_bytes = expected_bytes
+        self.usage_file_path = usage_file_path
+
+        self.pid = None
+        self.workspace_dir = None
+        self.lock_fd = None
+
+    def is_ram_available(self) -> bool:
+        """Whether a workspace fits in `ram_dir`, with the workspaces already there
+        filled to their expected size. Called with the allocation lock held and the
+        stale workspaces removed."""
+
+        ram_base_dir = self.base_dirs[0]
+        unfilled_bytes = sum(
+            max(0, self.expected_bytes - get_tree_size(workspace_dir))
+            for workspace_dir in (
+                lock_file_path.with_name(lock_file_path.name.removesuffix(".lock"))
+                for lock_file_path in ram_base_dir.glob("*.lock")
+            )
+        )
+        required_bytes = self.expected_bytes + unfilled_bytes
+
+        available_memory = get_available_memory()
+        return (
+            available_memory is not None
+            and available_memory - required_bytes >= min_free_memory
+            and get_free_space(ram_base_dir) >= required_bytes
+        )
+
+    @property
+    def path(self) -> Path:
+        """Workspace of the current process, created on first use"""
+
+        if self.pid != os.getpid():
+            self.create()
+        return self.workspace_dir
+
+    def create(self) -> None:
+        if fcntl is not None and os.access(ram_dir.parent, os.W_OK):
+            ram_base_dir = self.base_dirs[0]
+            ram_base_dir.mkdir(parents=True, exist_ok=True)
+            allocation_fd = os.open(
+                ram_base_dir / allocation_lock_name, os.O_RDWR | os.O_CREAT, 0o644
+            )
+            try:
+                fcntl.flock(allocation_fd, fcntl.LOCK_EX)
+                clean_stale_workspaces(ram_base_dir)
+                if self.is_ram_available():
+                    # Locked before the allocation lock is released, so the next
+                    # workspaces count it
+                    self.create_in(ram_base_dir)
+                    return
+            finally:
+                os.close(allocation_fd)
+
+        self.create_in(self.base_dirs[1])
+
+    def create_in(self, base_dir: Path) -> None:
+        base_dir.mkdir(parents=True, exist_ok=True)
+        # Disk workspaces may be on storage shared with processes on other hosts
+        workspace_dir = base_dir / f"{socket.gethostname()}-{os.getpid()}"
+
+        if fcntl is not None:
+            clean_stale_workspaces(base_dir)
+            self.lock_fd = lock_file(get_lock_file_path(workspace_dir))
+
+        shutil.rmtree(workspace_dir, ignore_errors=True)
+        workspace_dir.mkdir()
+        self.pid = os.getpid()
+        self.workspace_dir = workspace_dir
+        atexit.register(self.close)
+
+    def close(self) -> None:
+        # Forked processes inherit the manager, but not the workspace
+        if self.pid != os.getpid():
+            return
+
+        shutil.rmtree(self.workspace_dir, ignore_errors=True)
+        if self.lock_fd is not None:
+            get_lock_file_path(self.workspace_dir).unlink(missing_ok=True)
+            os.close(self.lock_fd)
+        self.pid = self.workspace_dir = self.lock_fd = None
+
+    def clean(self) -> None:
+        """Removes the workspaces of exited processes. Without file locks, all
+        workspaces on disk are removed, so no other run may be using them."""
+
+        if fcntl is None:
+            shutil.rmtree(self.base_dirs[1], ignore_errors=True)
+            return
+
+        for base_dir in self.base_dirs:
+            clean_stale_workspaces(base_dir)
+
+    @contextlib.contextmanager
+    def track(self, bugid: str) -> Iterator[None]:
+        """Samples the size of the workspace while validating a bug and records the
+        largest one"""
+
+        if self.usage_file_path is None:
+            yield
+            return
+
+        workspace_dir = self.path
+        peak_bytes = get_tree_size(workspace_dir)
+        stopped = threading.Event()
+
+        def sample() -> None:
+            nonlocal peak_bytes
+            while not stopped.wait(usage_sample_interval):
+                peak_bytes = max(peak_bytes, get_tree_size(workspace_dir))
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        start_timer = time.monotonic()
+        try:
+            yield
+        finally:
+            stopped.set()
+            sampler.join()
+            record = {
+                "bugid": bugid,
+                "in_ram": workspace_dir.parent == self.base_dirs[0],
+                "peak_bytes": max(peak_bytes, get_tree_size(workspace_dir)),
+                "seconds": time.monotonic() - start_timer,
+            }
+
+            # Single appends of a line don't interleave between processes
+            self.usage_file_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.usage_file_path, "a") as file:
+                file.write(json.dumps(record) + "\n")